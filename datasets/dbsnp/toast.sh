@@ -22,22 +22,24 @@ eggo-data dnload_raw \
     --output hdfs:///user/ec2-user/dbsnp/raw
 
 
+# Parquet codec from the datapackage (empty if unset)
+ADAM_CODEC_ARGS=$(eggo-data codec_args --input datapackage.json --tool adam)
+HIVE_CODEC_ARGS=$(eggo-data codec_args --input datapackage.json --tool hive)
+
+
 # ADAM PROCESSING
+# executors are sized per workload (see eggo-data plan_resources)
 # convert to ADAM format
-~/adam/bin/adam-submit --master yarn-client --driver-memory 8g \
-    --num-executors $TOTAL_EXECUTORS --executor-cores $CORES_PER_EXECUTOR \
-    --executor-memory $MEMORY_PER_EXECUTOR \
+~/adam/bin/adam-submit --master yarn-client $VCF2ADAM_SPARK_ARGS \
     -- \
-    vcf2adam -onlyvariants \
+    vcf2adam -onlyvariants $ADAM_CODEC_ARGS \
     hdfs:///user/ec2-user/dbsnp/raw \
     hdfs:///user/ec2-user/dbsnp/adam_variants
 
 # flatten parquet data
-~/adam/bin/adam-submit --master yarn-client --driver-memory 8g \
-    --num-executors $TOTAL_EXECUTORS --executor-cores $CORES_PER_EXECUTOR \
-    --executor-memory $MEMORY_PER_EXECUTOR \
+~/adam/bin/adam-submit --master yarn-client $FLATTEN_SPARK_ARGS \
     -- \
-    flatten \
+    flatten $ADAM_CODEC_ARGS \
     hdfs:///user/ec2-user/dbsnp/adam_variants \
     hdfs:///user/ec2-user/dbsnp/adam_flat_variants
 
@@ -49,12 +51,26 @@ NUM_REDUCERS=300
 TABLE_SCHEMA='`variantErrorProbability` INT, `contig__contigName` STRING, `contig__contigLength` BIGINT, `contig__contigMD5` STRING, `contig__referenceURL` STRING, `contig__assembly` STRING, `contig__species` STRING, `contig__referenceIndex` INT, `start` BIGINT, `end` BIGINT, `referenceAllele` STRING, `alternateAllele` STRING, `svAllele__type` BINARY, `svAllele__assembly` STRING, `svAllele__precise` BOOLEAN, `svAllele__startWindow` INT, `svAllele__endWindow` INT, `isSomatic` BOOLEAN'
 hive -e "CREATE EXTERNAL TABLE prepartition ($TABLE_SCHEMA) STORED AS PARQUET LOCATION 'hdfs:///user/ec2-user/dbsnp/adam_flat_variants'"
 hive -e "CREATE EXTERNAL TABLE postpartition ($TABLE_SCHEMA) PARTITIONED BY (chr STRING, pos BIGINT) STORED AS PARQUET LOCATION 'hdfs:///user/ec2-user/dbsnp/adam_flat_variants_locuspart'"
-export HIVE_OPTS="--hiveconf mapreduce.job.reduces=$NUM_REDUCERS --hiveconf mapreduce.map.memory.mb=8192 --hiveconf mapreduce.reduce.memory.mb=8192 --hiveconf mapreduce.reduce.java.opts=-Xmx8192m --hiveconf hive.exec.dynamic.partition.mode=nonstrict --hiveconf hive.exec.max.dynamic.partitions=3000"
+export HIVE_OPTS="--hiveconf mapreduce.job.reduces=$NUM_REDUCERS --hiveconf mapreduce.map.memory.mb=8192 --hiveconf mapreduce.reduce.memory.mb=8192 --hiveconf mapreduce.reduce.java.opts=-Xmx8192m --hiveconf hive.exec.dynamic.partition.mode=nonstrict --hiveconf hive.exec.max.dynamic.partitions=3000 $HIVE_CODEC_ARGS"
 hive  -e "INSERT OVERWRITE TABLE postpartition PARTITION (chr, pos) SELECT *, contig__contigName, floor(start / $SEGMENT_SIZE) * $SEGMENT_SIZE FROM prepartition DISTRIBUTE BY contig__contigName, floor(start / $SEGMENT_SIZE) * $SEGMENT_SIZE"
+eggo-data compact \
+    --table postpartition \
+    --location hdfs:///user/ec2-user/dbsnp/adam_flat_variants_locuspart \
+    --segment-size $SEGMENT_SIZE \
+    --datapackage datapackage.json
 hive -e "DROP TABLE prepartition"
 hive -e "DROP TABLE postpartition"
 
 
+# EDITION STATISTICS (from the counts gathered during download)
+mkdir -p stats
+eggo-data edition_stats \
+    --source hdfs:///user/ec2-user/dbsnp/raw \
+    --edition-path hdfs:///user/ec2-user/dbsnp/adam_flat_variants_locuspart \
+    --partition-depth 2 \
+    --output stats/flat_locuspart.json
+
+
 # TRANSFER TO S3
 hadoop distcp \
     hdfs:///user/ec2-user/dbsnp/adam_flat_variants_locuspart \
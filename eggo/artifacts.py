@@ -0,0 +1,202 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module caches the build output of the tools that config_cluster builds
+# from source (ADAM, GATK, quince, OpenCB).  Builds are keyed by
+# fork/branch/commit, so a cluster only builds a tool if nobody has built that
+# exact commit before.  The cache lives either in a local dir (transferred with
+# Fabric put/get) or in S3 (transferred by the node itself using presigned
+# URLs, so the nodes don't need AWS credentials).  The functions that touch a
+# node are meant to be run with Fabric's execute.
+
+
+import os
+import calendar
+import os.path as osp
+from os.path import join as pjoin
+from datetime import datetime
+
+from fabric.api import run, put, get, cd
+
+from eggo.error import EggoError
+from eggo.compat import check_output
+from eggo.util import sanitize
+from eggo.trace import traced
+
+
+PRESIGNED_URL_EXPIRY = 3600
+
+
+def artifact_key(repo, fork, branch, commit):
+    return '{0}/{1}/{2}/{3}.tar.gz'.format(repo, fork, sanitize(branch),
+                                           commit)
+
+
+def resolve_commit(fork, repo, branch):
+    # resolved from wherever eggo runs, so the node doesn't need git yet
+    url = 'https://github.com/{0}/{1}.git'.format(fork, repo)
+    raw = check_output(['git', 'ls-remote', url,
+                        'refs/heads/{0}'.format(branch)])
+    if not raw.strip():
+        raise EggoError('branch {0} not found in {1}'.format(branch, url))
+    return raw.split()[0]
+
+
+class LocalArtifactStore(object):
+
+    def __init__(self, path):
+        self.path = osp.abspath(osp.expanduser(path))
+
+    def _path(self, key):
+        return pjoin(self.path, key)
+
+    def list(self):
+        """Return [(key, num_bytes, mtime)]"""
+        entries = []
+        for (dirpath, _, filenames) in os.walk(self.path):
+            for filename in filenames:
+                path = pjoin(dirpath, filename)
+                st = os.stat(path)
+                entries.append((osp.relpath(path, self.path), st.st_size,
+                                st.st_mtime))
+        return entries
+
+    def exists(self, key):
+        return osp.isfile(self._path(key))
+
+    def fetch_to_host(self, key, remote_path):
+        put(self._path(key), remote_path)
+        # refresh the mtime so eviction is least-recently-used
+        os.utime(self._path(key), None)
+
+    def store_from_host(self, key, remote_path):
+        path = self._path(key)
+        if not osp.isdir(osp.dirname(path)):
+            os.makedirs(osp.dirname(path))
+        get(remote_path, path)
+
+    def delete(self, key):
+        os.remove(self._path(key))
+
+
+class S3ArtifactStore(object):
+
+    def __init__(self, bucket_name, prefix, s3_conn=None):
+        if s3_conn is None:
+            from eggo.aws import create_s3_connection
+            s3_conn = create_s3_connection()
+        self.conn = s3_conn
+        self.bucket = s3_conn.get_bucket(bucket_name)
+        self.prefix = prefix.strip('/')
+
+    def _name(self, key):
+        return '/'.join(filter(None, [self.prefix, key]))
+
+    def list(self):
+        entries = []
+        prefix = self._name('')
+        for k in self.bucket.list(prefix=prefix):
+            mtime = datetime.strptime(k.last_modified,
+                                      '%Y-%m-%dT%H:%M:%S.%fZ')
+            entries.append((k.name[len(prefix):].lstrip('/'), k.size,
+                            calendar.timegm(mtime.timetuple())))
+        return entries
+
+    def exists(self, key):
+        return self.bucket.get_key(self._name(key)) is not None
+
+    def fetch_to_host(self, key, remote_path):
+        s3_key = self.bucket.get_key(self._name(key))
+        url = s3_key.generate_url(PRESIGNED_URL_EXPIRY)
+        run('curl -sSf -o {0} "{1}"'.format(remote_path, url))
+        # refresh the last-modified time so eviction is least-recently-used
+        # (S3 only allows an in-place copy if the metadata changes)
+        last_used = datetime.utcnow().isoformat()
+        s3_key.copy(self.bucket.name, s3_key.name, preserve_acl=True,
+                    metadata={'eggo-last-used': last_used})
+
+    def store_from_host(self, key, remote_path):
+        url = self.conn.generate_url(PRESIGNED_URL_EXPIRY, 'PUT',
+                                     self.bucket.name, self._name(key))
+        run('curl -sSf -T {0} "{1}"'.format(remote_path, url))
+
+    def delete(self, key):
+        self.bucket.delete_key(self._name(key))
+
+
+def open_store(uri):
+    """Open an artifact cache from s3://bucket/prefix or a local path"""
+    if uri.startswith('s3://'):
+        (bucket_name, _, prefix) = uri[len('s3://'):].partition('/')
+        return S3ArtifactStore(bucket_name, prefix)
+    return LocalArtifactStore(uri)
+
+
+def evict(store, max_bytes):
+    """Delete the least recently used artifacts beyond the size budget"""
+    total = 0
+    evicted = []
+    for (key, num_bytes, _) in sorted(store.list(), key=lambda e: -e[2]):
+        total += num_bytes
+        if total > max_bytes:
+            store.delete(key)
+            evicted.append(key)
+    return evicted
+
+
+def build_from_source(repo, fork, branch, default_branch, build_cmd,
+                      commit=None):
+    # a failed earlier run may have left a partial checkout
+    run('rm -rf {0}'.format(repo))
+    run('git clone https://github.com/{0}/{1}.git'.format(fork, repo))
+    with cd(repo):
+        if commit is not None:
+            run('git checkout {0}'.format(commit))
+        elif branch != default_branch:
+            run('git checkout origin/{0}'.format(branch))
+        run(build_cmd)
+
+
+@traced
+def install_from_source(repo, fork, branch, default_branch, build_cmd,
+                        cache=None, m2_paths=()):
+    """Build a GitHub project on the current host, reusing a cached build
+
+    `cache` is an artifact cache URI (or None to always build).  `m2_paths`
+    are dirs under ~/.m2/repository that a `mvn install` build adds, and that
+    are cached along with the project dir.
+    """
+    if cache is None:
+        build_from_source(repo, fork, branch, default_branch, build_cmd)
+        return
+    store = open_store(cache)
+    commit = resolve_commit(fork, repo, branch)
+    key = artifact_key(repo, fork, branch, commit)
+    archive = '{0}-{1}.tar.gz'.format(repo, commit)
+    if store.exists(key):
+        print('Artifact cache hit for {0}'.format(key))
+        store.fetch_to_host(key, archive)
+        run('tar -xzf {0}'.format(archive))
+    else:
+        print('Artifact cache miss for {0}; building'.format(key))
+        build_from_source(repo, fork, branch, default_branch, build_cmd,
+                          commit)
+        paths = [repo] + ['.m2/repository/{0}'.format(p) for p in m2_paths]
+        run('tar --ignore-failed-read -czf {0} {1}'.format(archive,
+                                                           ' '.join(paths)))
+        store.store_from_host(key, archive)
+    run('rm -f {0}'.format(archive))
@@ -0,0 +1,165 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module grows and shrinks the worker group of a running cluster to follow
+# the YARN load.  Every tick, the ResourceManager REST API is polled (through
+# an ssh tunnel to the master) for the pending and allocated resources and the
+# per-node containers.  Sustained pending memory adds as many workers as it
+# takes to run it; workers added this way that stay idle are decommissioned
+# through CM (so HDFS blocks are re-replicated and no running containers are
+# lost) and then terminated.  The workers Director launched are never removed.
+# The decision itself is a pure function of the observations, so it can be
+# replayed.
+
+
+import json
+import time
+import math
+from urllib2 import urlopen
+from datetime import datetime
+
+from eggo import director
+from eggo.error import EggoError
+from eggo.config import get_ec2_private_key_file
+from eggo.util import tunnel_ctx
+
+
+RM_PORT = 8088
+
+
+def get_yarn_metrics(rm_url):
+    """Return the RM cluster metrics (appsPending, pendingMB, ...)"""
+    response = urlopen('{0}/ws/v1/cluster/metrics'.format(rm_url))
+    return json.load(response)['clusterMetrics']
+
+
+def get_yarn_nodes(rm_url):
+    """Return the running NodeManagers (nodeHostName, numContainers, ...)"""
+    response = urlopen('{0}/ws/v1/cluster/nodes?states=RUNNING'.format(rm_url))
+    nodes = json.load(response)['nodes']
+    # no nodes at all comes back as null
+    return (nodes or {}).get('node', [])
+
+
+class ScalingState(object):
+    """What the policy remembers between ticks"""
+
+    def __init__(self):
+        self.pending_ticks = 0
+        self.idle_ticks = {}
+        self.last_action = None
+
+
+def observe(state, metrics, nodes, autoscaled_hostnames):
+    # pending means YARN has requests it can't place right now
+    if metrics['containersPending'] > 0 or metrics['appsPending'] > 0:
+        state.pending_ticks += 1
+    else:
+        state.pending_ticks = 0
+    idle_ticks = {}
+    for node in nodes:
+        hostname = node['nodeHostName']
+        if hostname in autoscaled_hostnames and node['numContainers'] == 0:
+            idle_ticks[hostname] = state.idle_ticks.get(hostname, 0) + 1
+    state.idle_ticks = idle_ticks
+
+
+def decide(state, metrics, nodes, num_workers, min_workers, max_workers,
+           patience=3):
+    """Return ('grow', count), ('shrink', [hostname]), or None
+
+    A change is only made once the condition has held for `patience` ticks.
+    Only the autoscaled workers tracked by `observe` are shrink candidates,
+    and `min_workers` should be at least the number Director launched.
+    """
+    if state.pending_ticks >= patience and num_workers < max_workers:
+        node_mb = max([n['availMemoryMB'] + n['usedMemoryMB']
+                       for n in nodes] or [0])
+        if node_mb == 0:
+            return ('grow', 1)
+        needed = int(math.ceil(float(metrics['pendingMB']) / node_mb))
+        return ('grow', min(max(needed, 1), max_workers - num_workers))
+    if state.pending_ticks == 0 and num_workers > min_workers:
+        idle = sorted(h for (h, ticks) in state.idle_ticks.iteritems()
+                      if ticks >= patience)
+        if idle:
+            return ('shrink', idle[:num_workers - min_workers])
+    return None
+
+
+def autoscaled_workers(topology):
+    """The workers launched by grow_workers (not by Director)"""
+    return [w for w in topology.workers if w.tags.get('eggo_autoscaled')]
+
+
+def autoscaled_hostnames(session, topology):
+    """The CM (and so YARN) hostnames of the autoscaled workers"""
+    ips = set(w.private_ip_address for w in autoscaled_workers(topology))
+    session.invalidate('hosts')
+    return set(h.hostname for h in session.hosts() if h.ipAddress in ips)
+
+
+def autoscale(region, stack_name, min_workers=3, max_workers=20,
+              cooldown=300, interval=60, patience=3, dry_run=False):
+    """Poll YARN and resize the worker group until interrupted"""
+    if min_workers < 1 or min_workers > max_workers:
+        raise EggoError('need 1 <= min workers <= max workers')
+    ec2_conn = director.create_ec2_connection(region)
+    topology = director.get_topology(ec2_conn, stack_name)
+    master = topology.master
+    state = ScalingState()
+    try:
+        with tunnel_ctx(master.ip_address, master.private_ip_address, RM_PORT,
+                        None, 'ec2-user', get_ec2_private_key_file()) as port:
+            rm_url = 'http://localhost:{0}'.format(port)
+            while True:
+                topology = director.get_topology(ec2_conn, stack_name)
+                with director.cm_session_ctx(topology.manager) as session:
+                    hostnames = autoscaled_hostnames(session, topology)
+                metrics = get_yarn_metrics(rm_url)
+                nodes = get_yarn_nodes(rm_url)
+                observe(state, metrics, nodes, hostnames)
+                num_workers = len(topology.workers)
+                # never shrink into the workers Director launched
+                floor = max(min_workers, num_workers -
+                            len(autoscaled_workers(topology)))
+                print('{0}  workers={1} pendingMB={2} containersPending={3} '
+                      'idle={4}'.format(
+                          datetime.now().strftime('%H:%M:%S'), num_workers,
+                          metrics['pendingMB'], metrics['containersPending'],
+                          len(state.idle_ticks)))
+                cooling = (state.last_action is not None and
+                           time.time() - state.last_action < cooldown)
+                action = None
+                if not cooling:
+                    action = decide(state, metrics, nodes, num_workers,
+                                    floor, max_workers, patience)
+                if action is not None:
+                    print('Autoscale: {0} {1}{2}'.format(
+                        action[0], action[1], ' (dry run)' if dry_run else ''))
+                    if not dry_run:
+                        if action[0] == 'grow':
+                            director.grow_workers(region, stack_name,
+                                                  action[1])
+                        else:
+                            director.shrink_workers(region, stack_name,
+                                                    action[1])
+                    state = ScalingState()
+                    state.last_action = time.time()
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
@@ -22,50 +22,83 @@
 
 
 import sys
-from datetime import datetime
 from getpass import getuser
 
 import boto.ec2
 import boto.cloudformation
+from boto.s3.connection import S3Connection
 from boto.exception import BotoServerError
 
-from eggo.util import sleep_progressive
 from eggo.config import get_ec2_key_pair
+from eggo.waiter import Waiter
+from eggo.trace import traced
 
 
 # CLOUDFORMATION UTIL
 
 
+def stack_missing(error):
+    # CloudFormation answers for an unknown (or deleted) stack name with a
+    # 400 ValidationError; throttling and 5xx errors say nothing of the stack
+    return (error.status == 400 and
+            'does not exist' in (error.message or str(error.body)))
+
+
+def describe_stack_statuses(cf_conn):
+    """Return a Waiter describe fn: {stack name: stack status}"""
+    def describe(stack_names):
+        observed = {}
+        for name in stack_names:
+            try:
+                observed[name] = cf_conn.describe_stacks(name)[0].stack_status
+            except BotoServerError as e:
+                if stack_missing(e):
+                    observed[name] = None
+                elif e.status >= 500 or e.error_code == 'Throttling':
+                    # unknown for now; the next tick asks again
+                    observed[name] = 'UNKNOWN'
+                else:
+                    raise
+        return observed
+    return describe
+
+
+@traced
 def wait_for_stack_status(cf_conn, stack_name, stack_status):
     sys.stdout.write(
         "Waiting for stack to enter '{s}' state.".format(s=stack_status))
     sys.stdout.flush()
-    start_time = datetime.now()
-    while True:
-        sleep_progressive(start_time)
-        stack = cf_conn.describe_stacks(stack_name)[0]
-        if stack.stack_status == stack_status:
-            break
-        sys.stdout.write(".")
-        sys.stdout.flush()
-    sys.stdout.write("\n")
-    end_time = datetime.now()
+
+    def done(observed):
+        if observed is None:
+            return stack_status == 'DELETE_COMPLETE'
+        return observed == stack_status
+
+    def failed(observed):
+        # e.g., CREATE_FAILED or ROLLBACK_COMPLETE while waiting for a create
+        return (observed is not None and observed != stack_status and
+                (observed.endswith('_FAILED') or
+                 observed.endswith('ROLLBACK_COMPLETE')))
+
+    waited = Waiter(describe_stack_statuses(cf_conn)).wait(
+        [stack_name], done, failed)
     print "Stack is now in '{s}' state. Waited {t} seconds.".format(
-        s=stack_status, t=(end_time - start_time).seconds)
+        s=stack_status, t=int(waited[stack_name]))
 
 
 def create_cf_connection(region):
     return boto.cloudformation.connect_to_region(region)
 
 
+@traced
 def create_cf_stack(cf_conn, stack_name, cf_template_path, availability_zone):
     try:
         if len(cf_conn.describe_stacks(stack_name)) > 0:
             print "Stack '{n}' already exists. Reusing.".format(n=stack_name)
             return
-    except BotoServerError:
-        # stack does not exist
-        pass
+    except BotoServerError as e:
+        if not stack_missing(e):
+            raise
 
     print "Creating stack with name '{n}'.".format(n=stack_name)
     with open(cf_template_path, 'r') as template_file:
@@ -93,6 +126,7 @@ def get_security_group_id(cf_conn, stack_name):
     return get_stack_resource_id(cf_conn, stack_name, 'ClusterSG')
 
 
+@traced
 def delete_stack(cf_conn, stack_name):
     print "Deleting stack with name '{n}'.".format(n=stack_name)
     cf_conn.delete_stack(stack_name)
@@ -102,10 +136,26 @@ def delete_stack(cf_conn, stack_name):
 # EC2 UTIL
 
 
+# the instance APIs take at most this many ids per call
+MAX_IDS_PER_CALL = 100
+LIVE_INSTANCE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+# instance store disks per instance type; the types not listed (e.g., m4, c4)
+# only have EBS
+INSTANCE_STORE_DISKS = {
+    'm3.medium': 1, 'm3.large': 1, 'm3.xlarge': 2, 'm3.2xlarge': 2,
+    'c3.large': 2, 'c3.xlarge': 2, 'c3.2xlarge': 2, 'c3.4xlarge': 2,
+    'c3.8xlarge': 2, 'r3.large': 1, 'r3.xlarge': 1, 'r3.2xlarge': 1,
+    'r3.4xlarge': 1, 'r3.8xlarge': 2, 'i2.xlarge': 1, 'i2.2xlarge': 2,
+    'i2.4xlarge': 4, 'i2.8xlarge': 8, 'd2.xlarge': 3, 'd2.2xlarge': 6,
+    'd2.4xlarge': 12, 'd2.8xlarge': 24}
+
+
 def create_ec2_connection(region):
     return boto.ec2.connect_to_region(region)
 
 
+@traced
 def get_tagged_instances(ec2_conn, tags):
     filters = [('tag:' + k, v) for (k, v) in tags.iteritems()]
     instances = ec2_conn.get_only_instances(filters=filters)
@@ -113,25 +163,153 @@ def get_tagged_instances(ec2_conn, tags):
             if i.state not in ["shutting-down", "terminated"]]
 
 
-def wait_for_instance_state(ec2_conn, instance, state='running'):
+def instance_store_devices(instance_type):
+    """[(device name, virtual name)] of the instance store disks of a type"""
+    # ephemeral disks are only attached if they're in the launch mapping
+    return [('/dev/sd{0}'.format(chr(ord('b') + i)), 'ephemeral{0}'.format(i))
+            for i in xrange(INSTANCE_STORE_DISKS.get(instance_type, 0))]
+
+
+def get_image(ec2_conn, image_id):
+    return ec2_conn.get_all_images(image_ids=[image_id])[0]
+
+
+def find_tagged_image(ec2_conn, tags):
+    # newest available image owned by us with all the tags
+    filters = dict(('tag:' + k, v) for (k, v) in tags.iteritems())
+    filters['state'] = 'available'
+    images = ec2_conn.get_all_images(owners=['self'], filters=filters)
+    if len(images) == 0:
+        return None
+    return max(images, key=lambda i: i.creationDate)
+
+
+@traced
+def create_image(ec2_conn, instance_id, name, tags, no_reboot=True):
+    print "Creating image '{n}' from instance {i}.".format(n=name,
+                                                           i=instance_id)
+    image_id = ec2_conn.create_image(instance_id, name, no_reboot=no_reboot)
+    sys.stdout.write("Waiting for image to become available.")
+    sys.stdout.flush()
+
+    def describe(image_ids):
+        # new images may not be visible right away; those are left out
+        return dict((i.id, i.state) for i in ec2_conn.get_all_images(
+            filters={'image-id': list(image_ids)}))
+
+    # images take minutes, so poll less eagerly
+    waited = Waiter(describe, max_delay=30.).wait(
+        [image_id], lambda s: s == 'available', lambda s: s == 'failed')
+    ec2_conn.create_tags([image_id], tags)
+    print "Image {i} is available. Waited {t} seconds.".format(
+        i=image_id, t=int(waited[image_id]))
+    return image_id
+
+
+def instance_missing(error):
+    # EC2 fails the whole call if any id is unknown, which new instances are
+    # for a while after run_instances (and terminated ones are, eventually)
+    return error.error_code == 'InvalidInstanceID.NotFound'
+
+
+def describe_instance_states(ec2_conn):
+    """Return a Waiter describe fn: {id: (state, system, instance status)}"""
+    def describe_batch(instance_ids):
+        try:
+            return ec2_conn.get_all_instance_status(
+                instance_ids=instance_ids, include_all_instances=True)
+        except BotoServerError as e:
+            if not instance_missing(e):
+                raise
+        if len(instance_ids) == 1:
+            # not observed yet; the next tick asks again
+            return []
+        # find out which ones are missing, one at a time
+        statuses = []
+        for instance_id in instance_ids:
+            statuses.extend(describe_batch([instance_id]))
+        return statuses
+
+    def describe(instance_ids):
+        observed = {}
+        instance_ids = list(instance_ids)
+        for i in xrange(0, len(instance_ids), MAX_IDS_PER_CALL):
+            for status in describe_batch(
+                    instance_ids[i:i + MAX_IDS_PER_CALL]):
+                observed[status.id] = (status.state_name,
+                                       status.system_status.status,
+                                       status.instance_status.status)
+        return observed
+    return describe
+
+
+def instance_in_state(state):
+    def done(observed):
+        if observed is None:
+            # terminated instances eventually drop out of the results
+            return state == 'terminated'
+        (instance_state, system_status, instance_status) = observed
+        if instance_state != state:
+            return False
+        if state != 'running':
+            return True
+        # running instances must also pass the status checks
+        return (system_status in ['ok', 'not-applicable'] and
+                instance_status in ['ok', 'not-applicable'])
+    return done
+
+
+@traced
+def wait_for_instance_ids_state(ec2_conn, instance_ids, state='running'):
     sys.stdout.write(
-        "Waiting for instance to enter '{s}' state.".format(s=state))
+        "Waiting for {n} instance(s) to enter '{s}' state.".format(
+            n=len(instance_ids), s=state))
     sys.stdout.flush()
-    start_time = datetime.now()
-    while True:
-        sleep_progressive(start_time)
+    waited = Waiter(describe_instance_states(ec2_conn)).wait(
+        instance_ids, instance_in_state(state))
+    print "Instances are now in '{s}' state. Waited {t} seconds.".format(
+        s=state, t=int(max(waited.itervalues())))
+
+
+@traced
+def wait_for_instances_state(ec2_conn, instances, state='running'):
+    wait_for_instance_ids_state(ec2_conn, [i.id for i in instances], state)
+    # e.g., the public IP is only known once an instance is running
+    for instance in instances:
         instance.update()
-        statuses = ec2_conn.get_all_instance_status(instance.id,
-                                                    include_all_instances=True)
-        if len(statuses) > 0:
-            status = statuses[0]
-            if (instance.state == state and
-                    status.system_status.status in ['ok', 'not-applicable'] and
-                    status.instance_status.status in ['ok', 'not-applicable']):
-                break
-        sys.stdout.write(".")
-        sys.stdout.flush()
-    sys.stdout.write("\n")
-    end_time = datetime.now()
-    print "Instance is now in '{s}' state. Waited {t} seconds.".format(
-        s=state, t=(end_time - start_time).seconds)
+
+
+def wait_for_instance_state(ec2_conn, instance, state='running'):
+    wait_for_instances_state(ec2_conn, [instance], state)
+
+
+def get_stack_instances(ec2_conn, stack_name):
+    """All the live instances tagged with the stack name, in one call"""
+    return ec2_conn.get_only_instances(
+        filters={'tag:eggo_stack_name': stack_name,
+                 'instance-state-name': LIVE_INSTANCE_STATES})
+
+
+@traced
+def terminate_instance_ids(ec2_conn, instance_ids):
+    instance_ids = list(instance_ids)
+    for i in xrange(0, len(instance_ids), MAX_IDS_PER_CALL):
+        ec2_conn.terminate_instances(instance_ids[i:i + MAX_IDS_PER_CALL])
+
+
+def terminate_instances(ec2_conn, instances, wait=True):
+    """Terminate the instances in batches and wait for all of them at once"""
+    instance_ids = [i.id for i in instances]
+    if not instance_ids:
+        return instances
+    terminate_instance_ids(ec2_conn, instance_ids)
+    if wait:
+        wait_for_instance_ids_state(ec2_conn, instance_ids, 'terminated')
+    return instances
+
+
+# S3 UTIL
+
+
+def create_s3_connection():
+    return S3Connection()
@@ -0,0 +1,212 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module compiles the dataset registry (the `datasets/*/datapackage.json`
+# and `meta.json` descriptors) into a single catalog index file.  Every
+# descriptor is normalized to the same shape, so listing and searching the
+# registry only needs to read the index.  Entries are rebuilt only when the
+# descriptor (or one of its edition statistics sidecars) changes on disk.
+
+
+import os
+import json
+import os.path as osp
+from os.path import join as pjoin
+
+from eggo.error import EggoError
+
+
+CATALOG_VERSION = 1
+CATALOG_FILENAME = 'catalog.json'
+
+# in order of preference, if a dataset dir happens to contain several
+DESCRIPTOR_FILENAMES = ['datapackage.json', 'meta.json']
+
+# edition statistics sidecars live at <dataset_dir>/stats/<edition>.json
+STATS_DIRNAME = 'stats'
+
+
+def default_catalog_path(registry_dir):
+    return pjoin(registry_dir, CATALOG_FILENAME)
+
+
+def find_descriptor(dataset_dir):
+    for filename in DESCRIPTOR_FILENAMES:
+        path = pjoin(dataset_dir, filename)
+        if osp.isfile(path):
+            return path
+    return None
+
+
+def find_descriptors(registry_dir):
+    """Return {dataset_dir_name: descriptor_path} for the registry"""
+    descriptors = {}
+    for name in sorted(os.listdir(registry_dir)):
+        dataset_dir = pjoin(registry_dir, name)
+        if not osp.isdir(dataset_dir):
+            continue
+        path = find_descriptor(dataset_dir)
+        if path is not None:
+            descriptors[name] = path
+    return descriptors
+
+
+def _stat_fingerprint(path):
+    st = os.stat(path)
+    return [st.st_mtime, st.st_size]
+
+
+def _stats_sidecars(dataset_dir):
+    stats_dir = pjoin(dataset_dir, STATS_DIRNAME)
+    if not osp.isdir(stats_dir):
+        return {}
+    return dict((osp.splitext(f)[0], pjoin(stats_dir, f))
+                for f in sorted(os.listdir(stats_dir)) if f.endswith('.json'))
+
+
+def descriptor_fingerprint(descriptor_path):
+    # cheap staleness check: only stats the files, never parses them
+    dataset_dir = osp.dirname(descriptor_path)
+    sidecars = _stats_sidecars(dataset_dir)
+    return {'descriptor': _stat_fingerprint(descriptor_path),
+            'stats': dict((edition, _stat_fingerprint(path))
+                          for (edition, path) in sidecars.iteritems())}
+
+
+def normalize_resource(resource):
+    # meta.json-style descriptors use a boolean for compression
+    compression = resource.get('compression')
+    if compression is True:
+        compression = 'gzip' if resource['url'].endswith('.gz') else None
+    elif compression is False:
+        compression = None
+    return {'url': resource['url'],
+            'format': resource.get('format'),
+            'compression': compression,
+            'bytes': resource.get('bytes')}
+
+
+def normalize_descriptor(raw, dataset_dir=None):
+    """Normalize a datapackage.json/meta.json dict into a catalog entry"""
+    if 'name' not in raw:
+        raise EggoError('dataset descriptor is missing a "name"')
+    # older descriptors call the resources "sources"
+    resources = [normalize_resource(r)
+                 for r in raw.get('resources', raw.get('sources', []))]
+    sizes = [r['bytes'] for r in resources]
+    total_bytes = sum(sizes) if None not in sizes else None
+    statistics = {}
+    if dataset_dir is not None:
+        for (edition, path) in _stats_sidecars(dataset_dir).iteritems():
+            with open(path) as ip:
+                statistics[edition] = json.load(ip)
+    editions = list(raw.get('editions', []))
+    editions.extend(sorted(e for e in statistics if e not in editions))
+    return {'name': raw['name'],
+            'description': raw.get('description', ''),
+            'dag': raw.get('dag'),
+            'codec': raw.get('codec'),
+            'formats': sorted(set(r['format'] for r in resources
+                                  if r['format'])),
+            'num_resources': len(resources),
+            'total_bytes': total_bytes,
+            'resources': resources,
+            'editions': [{'name': e, 'statistics': statistics.get(e)}
+                         for e in editions]}
+
+
+def load_descriptor(descriptor_path):
+    with open(descriptor_path) as ip:
+        raw = json.load(ip)
+    return normalize_descriptor(raw, osp.dirname(descriptor_path))
+
+
+def read_catalog(catalog_path):
+    if not osp.isfile(catalog_path):
+        return {'version': CATALOG_VERSION, 'datasets': {}}
+    with open(catalog_path) as ip:
+        catalog = json.load(ip)
+    if catalog.get('version') != CATALOG_VERSION:
+        # index format changed; rebuild everything
+        return {'version': CATALOG_VERSION, 'datasets': {}}
+    return catalog
+
+
+def write_catalog(catalog, catalog_path):
+    # write-then-rename so concurrent readers never see a partial index
+    tmp_path = catalog_path + '.tmp'
+    with open(tmp_path, 'w') as op:
+        json.dump(catalog, op, indent=2, sort_keys=True)
+    os.rename(tmp_path, catalog_path)
+
+
+def build_catalog(registry_dir, catalog_path=None, force=False):
+    """Incrementally (re)build the catalog index for a registry dir
+
+    Returns a tuple of the catalog and the list of dataset dirs that were
+    re-parsed.  The index is only rewritten if something changed.
+    """
+    if catalog_path is None:
+        catalog_path = default_catalog_path(registry_dir)
+    catalog = read_catalog(catalog_path)
+    old_entries = {} if force else catalog['datasets']
+    new_entries = {}
+    rebuilt = []
+    for (dirname, path) in find_descriptors(registry_dir).iteritems():
+        fingerprint = descriptor_fingerprint(path)
+        entry = old_entries.get(dirname)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            entry = load_descriptor(path)
+            entry['fingerprint'] = fingerprint
+            entry['descriptor'] = osp.relpath(path, registry_dir)
+            rebuilt.append(dirname)
+        new_entries[dirname] = entry
+    changed = (len(rebuilt) > 0 or
+               set(new_entries) != set(catalog['datasets']))
+    catalog = {'version': CATALOG_VERSION, 'datasets': new_entries}
+    if changed or not osp.isfile(catalog_path):
+        write_catalog(catalog, catalog_path)
+    return (catalog, sorted(rebuilt))
+
+
+def list_datasets(catalog, query=None):
+    entries = sorted(catalog['datasets'].itervalues(),
+                     key=lambda e: e['name'])
+    if query is None:
+        return entries
+    query = query.lower()
+    return [e for e in entries
+            if query in e['name'].lower() or
+            query in e['description'].lower() or
+            query in [f.lower() for f in e['formats']]]
+
+
+def get_dataset(catalog, name):
+    for entry in catalog['datasets'].itervalues():
+        if entry['name'] == name:
+            return entry
+    raise EggoError('dataset "{0}" is not in the catalog'.format(name))
+
+
+def format_bytes(num_bytes):
+    if num_bytes is None:
+        return '?'
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(num_bytes) < 1024.:
+            return '{0:.1f}{1}'.format(num_bytes, unit)
+        num_bytes /= 1024.
+    return '{0:.1f}PB'.format(num_bytes)
@@ -0,0 +1,75 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module records which config_cluster steps have finished, so a rerun
+# after a failure picks up where the last run stopped.  The records are marker
+# files in a state dir on a cluster node (one file per step, holding the step's
+# key, e.g. the fork/branch it built), so they go away with the cluster and
+# concurrent steps never write the same file.  The marker functions are Fabric
+# tasks; HostCheckpoint runs them against its host.
+
+
+from fabric.api import run, settings, hide
+
+from eggo.remote import remote_execute
+
+
+STATE_DIR = '/home/ec2-user/.eggo-state'
+
+
+def read_markers():
+    with settings(hide('everything'), warn_only=True):
+        out = run('for f in {0}/*; do test -f "$f" && '
+                  'echo "$(basename $f) $(cat $f)"; done'.format(STATE_DIR))
+    markers = {}
+    for line in out.splitlines():
+        (name, _, key) = line.strip().partition(' ')
+        if name:
+            markers[name] = '' if key == '-' else key
+    return markers
+
+
+def write_marker(name, key):
+    # written to a temp file first, so a marker is never half-written
+    run("mkdir -p {0} && echo '{2}' > {0}/.{1} && mv {0}/.{1} {0}/{1}".format(
+        STATE_DIR, name, key or '-'))
+
+
+def clear_markers():
+    run('rm -rf {0}'.format(STATE_DIR))
+
+
+def command_succeeds(command):
+    """Whether a (probe) command succeeds on the current host"""
+    with settings(hide('everything'), warn_only=True):
+        return run(command).succeeded
+
+
+class HostCheckpoint(object):
+
+    def __init__(self, host):
+        self.host = host
+
+    def load(self):
+        """Return {step name: key} for the steps finished so far"""
+        return remote_execute(read_markers, hosts=[self.host])[self.host]
+
+    def mark(self, name, key=''):
+        remote_execute(write_marker, name, key, hosts=[self.host])
+
+    def clear(self):
+        remote_execute(clear_markers, hosts=[self.host])
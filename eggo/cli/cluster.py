@@ -16,10 +16,10 @@
 
 import os.path as osp
 
-from click import group, option, Choice
-from fabric.api import execute, get
+from click import group, option, Choice, pass_context
+from fabric.api import get
 
-from eggo import director
+from eggo import director, trace, remote, autoscale as autoscale_
 from eggo.util import resource_dir
 
 
@@ -41,10 +41,58 @@ option_stack_name = option(
     help='Stack name for CloudFormation and cluster name')
 
 
+def options_install_choices(f):
+    # what config_cluster installs; also used to fingerprint baked AMIs
+    options = [
+        option('--adam/--no-adam', default=True, show_default=True,
+               help='Install ADAM?'),
+        option('--adam-fork', default='bigdatagenomics', show_default=True,
+               help='GitHub fork to use for ADAM'),
+        option('--adam-branch', default='master', show_default=True,
+               help='GitHub branch to use for ADAM'),
+        option('--opencb/--no-opencb', default=False, show_default=True,
+               help='Install OpenCB?'),
+        option('--gatk/--no-gatk', default=True, show_default=True,
+               help='Install GATK? (v4 aka Hellbender)'),
+        option('--quince/--no-quince', default=True, show_default=True,
+               help='Install quince?'),
+        option('--quince-fork', default='cloudera', show_default=True,
+               help='GitHub fork to use for Quince'),
+        option('--quince-branch', default='master', show_default=True,
+               help='GitHub branch to use for Quince')]
+    for o in reversed(options):
+        f = o(f)
+    return f
+
+
+def install_choices(adam, adam_fork, adam_branch, opencb, gatk, quince,
+                    quince_fork, quince_branch):
+    return {'adam': adam, 'adam_fork': adam_fork, 'adam_branch': adam_branch,
+            'opencb': opencb, 'gatk': gatk, 'quince': quince,
+            'quince_fork': quince_fork, 'quince_branch': quince_branch}
+
+
 @group(context_settings={'help_option_names': ['-h', '--help']})
-def main():
+@option('--trace', 'trace_path', default=None,
+        help='Record tracing spans to this JSON-lines file (and write a '
+             'Chrome trace next to it)')
+@option('--pool-size', default=16, show_default=True,
+        help='Max number of hosts to run a remote task on at once')
+@option('--task-timeout', default=None, type=int,
+        help='Seconds a remote task may take on a host  [default: no limit]')
+@option('--retries', default=0, show_default=True,
+        help='Times to retry a remote task that failed on a host')
+@pass_context
+def main(ctx, trace_path, pool_size, task_timeout, retries):
     """eggo-cluster -- provisions Hadoop clusters using Cloudera Director"""
-    pass
+    remote.configure(pool_size, task_timeout, retries)
+    if trace_path is not None:
+        trace.start_trace(trace_path)
+
+        def finish():
+            print('Wrote Chrome trace to {0}'.format(
+                trace.write_chrome_trace(trace_path)))
+        ctx.call_on_close(finish)
 
 
 @main.command()
@@ -66,48 +114,133 @@ def main():
         help='The AMI to use for the worker nodes')
 @option('-n', '--num-workers', default=3, show_default=True,
         help='The total number of worker nodes to provision')
+@option('--use-baked-ami/--no-use-baked-ami', default=True, show_default=True,
+        help='Use an AMI baked for the same install choices, if any')
+@options_install_choices
 def provision(region, availability_zone, stack_name, cf_template_path,
               launcher_ami, launcher_instance_type, worker_instance_type,
-              director_conf_path, cluster_ami, num_workers):
+              director_conf_path, cluster_ami, num_workers, use_baked_ami,
+              adam, adam_fork, adam_branch, opencb, gatk, quince, quince_fork,
+              quince_branch):
     """Provision a new cluster on AWS"""
+    choices = None
+    if use_baked_ami:
+        choices = install_choices(adam, adam_fork, adam_branch, opencb, gatk,
+                                  quince, quince_fork, quince_branch)
     director.provision(
         region, availability_zone, stack_name, cf_template_path, launcher_ami,
         launcher_instance_type, worker_instance_type, director_conf_path,
-        cluster_ami, num_workers)
+        cluster_ami, num_workers, choices)
 
 
 @main.command()
 @option_region
 @option_stack_name
-@option('--adam/--no-adam', default=True, show_default=True,
-        help='Install ADAM?')
-@option('--adam-fork', default='bigdatagenomics', show_default=True,
-        help='GitHub fork to use for ADAM')
-@option('--adam-branch', default='master', show_default=True,
-        help='GitHub branch to use for ADAM')
-@option('--opencb/--no-opencb', default=False, show_default=True,
-        help='Install OpenCB?')
-@option('--gatk/--no-gatk', default=True, show_default=True,
-        help='Install GATK? (v4 aka Hellbender)')
-@option('--quince/--no-quince', default=True, show_default=True,
-        help='Install quince?')
-@option('--quince-fork', default='cloudera', show_default=True,
-        help='GitHub fork to use for Quince')
-@option('--quince-branch', default='master', show_default=True,
-        help='GitHub branch to use for Quince')
+@options_install_choices
+@option('--max-parallel', default=4, show_default=True,
+        help='Max number of install steps to run at once on a host')
+@option('--artifact-cache', default=None,
+        help='Local dir or s3://bucket/prefix to cache tool builds in')
+@option('--artifact-cache-max-gb', default=20, show_default=True,
+        help='Evict least recently used builds beyond this size')
+@option('--mirror/--no-mirror', default=True, show_default=True,
+        help='Download packages/artifacts once, through the launcher')
+@option('--resume/--no-resume', default=True, show_default=True,
+        help='Skip the steps that finished in an earlier run')
 def config_cluster(region, stack_name, adam, adam_fork, adam_branch, opencb,
-                   gatk, quince, quince_fork, quince_branch):
+                   gatk, quince, quince_fork, quince_branch, max_parallel,
+                   artifact_cache, artifact_cache_max_gb, mirror, resume):
     """Configure cluster for genomics, incl. ADAM, OpenCB, Quince, etc"""
     director.config_cluster(region, stack_name, adam, adam_fork, adam_branch,
-                            opencb, gatk, quince, quince_fork, quince_branch)
+                            opencb, gatk, quince, quince_fork, quince_branch,
+                            max_parallel, artifact_cache,
+                            artifact_cache_max_gb * 1024 ** 3, mirror,
+                            resume)
 
 
 @main.command()
 @option_region
 @option_stack_name
-def teardown(region, stack_name):
+@options_install_choices
+@option('--reboot/--no-reboot', default=False, show_default=True,
+        help='Reboot the master for a consistent snapshot?')
+def bake_ami(region, stack_name, adam, adam_fork, adam_branch, opencb, gatk,
+             quince, quince_fork, quince_branch, reboot):
+    """Snapshot the configured master node into a reusable AMI"""
+    director.bake_ami(
+        region, stack_name,
+        install_choices(adam, adam_fork, adam_branch, opencb, gatk, quince,
+                        quince_fork, quince_branch),
+        no_reboot=not reboot)
+
+
+@main.command()
+@option_region
+@option_stack_name
+@option('--rolling/--no-rolling', default=False, show_default=True,
+        help='Upgrade a batch of nodes at a time, keeping the cluster up')
+@option('--batch-size', default=1, show_default=True,
+        help='Number of worker nodes to upgrade at once when rolling')
+def upgrade_java(region, stack_name, rolling, batch_size):
+    """Upgrade the cluster to JDK 1.8, skipping nodes that already have it"""
+    director.install_java_8(region, stack_name, rolling=rolling,
+                            batch_size=batch_size)
+
+
+@main.command()
+@option_region
+@option_stack_name
+@option('--block-size-mb', default=256, show_default=True,
+        help='HDFS block size for new files, e.g. the Parquet editions')
+@option('--restart/--no-restart', default=True, show_default=True,
+        help='Restart the cluster so the settings take effect')
+def tune_hdfs(region, stack_name, block_size_mb, restart):
+    """Set HDFS block size, short-circuit reads, and data dirs through CM"""
+    director.tune_hdfs(region, stack_name, block_size_mb, restart)
+
+
+@main.command()
+@option_region
+@option_stack_name
+@option('--min-workers', default=3, show_default=True,
+        help='Never shrink below this many workers (HDFS needs 3)')
+@option('--max-workers', default=20, show_default=True,
+        help='Never grow beyond this many workers')
+@option('--cooldown', default=300, show_default=True,
+        help='Seconds to wait after resizing before resizing again')
+@option('--interval', default=60, show_default=True,
+        help='Seconds between polls of the YARN ResourceManager')
+@option('--patience', default=3, show_default=True,
+        help='Polls a condition must hold for before acting on it')
+@option('--dry-run/--no-dry-run', default=False, show_default=True,
+        help='Only print what would be resized')
+def autoscale(region, stack_name, min_workers, max_workers, cooldown,
+              interval, patience, dry_run):
+    """Grow/shrink the workers to follow YARN pending resources"""
+    autoscale_.autoscale(region, stack_name, min_workers, max_workers,
+                         cooldown, interval, patience, dry_run)
+
+
+@main.command()
+@option_region
+@option_stack_name
+@option('--director-terminate/--no-director-terminate', default=True,
+        show_default=True,
+        help='Have Director terminate the cluster (else terminate all the '
+             'instances directly, which is faster)')
+def teardown(region, stack_name, director_terminate):
     """Tear down a cluster and stack on AWS"""
-    director.teardown(region, stack_name)
+    director.teardown(region, stack_name, director_terminate)
+
+
+@main.command()
+@option('--trace', 'trace_path', required=True,
+        help='JSON-lines trace file recorded with --trace')
+@option('--baseline', default=None,
+        help='Trace file of an earlier run to compare with')
+def trace_report(trace_path, baseline):
+    """Summarize where the time went in a traced run"""
+    trace.print_summary(trace_path, baseline)
 
 
 @main.command()
@@ -144,11 +277,29 @@ def get_director_log(region, stack_name):
     """DEBUG: get the Director application log from the launcher instance"""
     ec2_conn = director.create_ec2_connection(region)
     hosts = [director.get_launcher_instance(ec2_conn, stack_name).ip_address]
-    execute(
+    remote.remote_execute(
         get, hosts=hosts, local_path='application.log',
         remote_path='/home/ec2-user/.cloudera-director/logs/application.log')
 
 
+@main.command()
+@option_region
+@option_stack_name
+@option('--output-dir', default=None,
+        help='Where to put the logs  [default: logs-<stack>-<timestamp>]')
+@option('--since', default=None,
+        help='Only logs modified since, e.g. "2015-08-01 12:00" or '
+             '"2 hours ago"')
+@option('--until', default=None, help='Only logs modified before')
+@option('--app-id', default=None,
+        help='Only the container logs of this YARN application (plus its '
+             'aggregated logs)')
+def collect_logs(region, stack_name, output_dir, since, until, app_id):
+    """Fetch the Director, CM, Hadoop, and container logs of all nodes"""
+    director.collect_logs(region, stack_name, output_dir, since, until,
+                          app_id)
+
+
 @main.command()
 @option_region
 @option_stack_name
@@ -158,6 +309,6 @@ def reinstall_eggo(region, stack_name, fork, branch):
     """DEBUG: reinstall a specific version of eggo"""
     ec2_conn = director.create_ec2_connection(region)
     hosts = [director.get_master_instance(ec2_conn, stack_name).ip_address]
-    execute(
+    remote.remote_execute(
         director.install_eggo, hosts=hosts, fork=fork, branch=branch,
         reinstall=True)
@@ -16,15 +16,34 @@
 
 import json
 
-from click import group, option, File
+from click import group, option, File, Choice, pass_context
 
-from eggo import operations
+from eggo import operations, catalog, merge, planner, trace
+
+
+# reusable options
+option_registry = option(
+    '--registry', default='datasets', show_default=True,
+    help='Path to the dataset registry dir')
+option_catalog = option(
+    '--catalog', 'catalog_path', default=None,
+    help='Path to the catalog index  [default: <registry>/catalog.json]')
 
 
 @group(context_settings={'help_option_names': ['-h', '--help']})
-def main():
+@option('--trace', 'trace_path', default=None,
+        help='Record tracing spans to this JSON-lines file (and write a '
+             'Chrome trace next to it)')
+@pass_context
+def main(ctx, trace_path):
     """eggo-data -- operations on common genomics datasets"""
-    pass
+    if trace_path is not None:
+        trace.start_trace(trace_path)
+
+        def finish():
+            print('Wrote Chrome trace to {0}'.format(
+                trace.write_chrome_trace(trace_path)))
+        ctx.call_on_close(finish)
 
 
 @main.command()
@@ -34,7 +53,98 @@ def dnload_raw(input, output):
     """Parallel download raw dataset from datapackage.json using Hadoop"""
     with open(input) as ip:
         datapackage = json.load(ip)
-    operations.download_dataset_with_hadoop(datapackage, output)
+    stats = operations.download_dataset_with_hadoop(datapackage, output)
+    print('Downloaded {0} records ({1} distinct variants)'.format(
+        stats.row_count, stats.distinct_variants.count()))
+
+
+@main.command()
+@option('--source', help='HDFS path of the raw data written by dnload_raw')
+@option('--edition-path', help='HDFS path of the converted edition')
+@option('--partition-depth', default=0, show_default=True,
+        help='Depth of the partition dirs (2 for chr=/pos= locuspart)')
+@option('--output', type=File(mode='w'), default=None,
+        help='Also write the sidecar here, e.g. '
+             'datasets/<name>/stats/<edition>.json for the catalog')
+def edition_stats(source, edition_path, partition_depth, output):
+    """Write the statistics sidecar for a converted edition"""
+    stats = operations.compute_edition_stats(source, edition_path,
+                                             partition_depth)
+    if output is not None:
+        json.dump(stats.to_dict(), output, indent=2, sort_keys=True)
+
+
+@main.command()
+@option('--table', help='Name of the locus-partitioned Hive table')
+@option('--location', help='HDFS location of the table')
+@option('--target-size-mb', default=256, show_default=True,
+        help='Target size of the compacted files')
+@option('--threshold-mb', default=64, show_default=True,
+        help='Only rewrite partitions whose average file size is below this')
+@option('--parallelism', default=8, show_default=True,
+        help='Number of partitions to rewrite concurrently')
+@option('--segment-size', default=1000000, show_default=True,
+        help='Width of the pos= partitions')
+@option('--datapackage', default=None,
+        help='datapackage.json to take the Parquet codec from')
+def compact(table, location, target_size_mb, threshold_mb, parallelism,
+            segment_size, datapackage):
+    """Merge the small files in a locus-partitioned table"""
+    codec = None
+    if datapackage is not None:
+        with open(datapackage) as ip:
+            codec = operations.get_parquet_codec(json.load(ip))
+    operations.compact_partitions(
+        table, location, target_size_mb * 1024 * 1024,
+        threshold_mb * 1024 * 1024, parallelism, segment_size, codec)
+
+
+@main.command()
+@option('--input', help='Path to datapackage.json file for dataset')
+@option('--tool', type=Choice(['adam', 'hive']), default='adam',
+        show_default=True, help='Which writing stage to generate args for')
+def codec_args(input, tool):
+    """Print the args that make a writing stage use the dataset's codec"""
+    with open(input) as ip:
+        codec = operations.get_parquet_codec(json.load(ip))
+    if tool == 'adam':
+        print(operations.adam_codec_args(codec))
+    else:
+        print(operations.hive_codec_args(codec))
+
+
+@main.command()
+@option('--input', help='HDFS path of a raw VCF sample of the dataset')
+@option('-c', '--codec', multiple=True, type=Choice(operations.PARQUET_CODECS),
+        help='Codec to benchmark; repeat for several  [default: all]')
+@option('--adam-args', default='--master yarn-client', show_default=True,
+        help='Extra args for adam-submit')
+def benchmark_codecs(input, codec, adam_args):
+    """Report compression ratio and write/read throughput per codec"""
+    codecs = list(codec) if codec else operations.PARQUET_CODECS
+    results = operations.benchmark_codecs(input, codecs, adam_args)
+    ts = '{0:<14}{1:>14}{2:>8}{3:>12}{4:>12}'
+    print(ts.format('codec', 'bytes', 'ratio', 'write MB/s', 'read MB/s'))
+    for r in results:
+        print(ts.format(r['codec'], r['bytes'], '{0:.2f}'.format(r['ratio']),
+                        '{0:.1f}'.format(r['write_mb_per_sec']),
+                        '{0:.1f}'.format(r['read_mb_per_sec'])))
+
+
+@main.command()
+@option('-i', '--input', multiple=True,
+        help='VCF to merge (local, .gz, or hdfs://); repeat for each source')
+@option('--output', type=File(mode='w'), default='-', show_default=True,
+        help='Output destination ("-" for stdout)')
+@option('--presorted/--unsorted', default=True, show_default=True,
+        help='Are the inputs already sorted? (else external sort each one)')
+@option('--buffer-mb', default=256, show_default=True,
+        help='Memory for the external sort runs')
+@option('--tmp-dir', default=None, help='Where to spill external sort runs')
+def merge_sorted(input, output, presorted, buffer_mb, tmp_dir):
+    """Merge VCFs into one contig-then-position ordered stream"""
+    merge.merge_vcfs(list(input), output, presorted, buffer_mb * 1024 * 1024,
+                     tmp_dir)
 
 
 @main.command()
@@ -51,3 +161,67 @@ def gen_env_vars(cm_host, cm_port, username, password, output):
                                                  password)
     for (k, v) in env_vars.iteritems():
         output.write("export {0}={1}\n".format(k, v))
+
+
+@main.command()
+@option('--cm-host', help='Hostname for Cloudera Manager')
+@option('--cm-port', default=7180, show_default=True,
+        help='Port for Cloudera Manager')
+@option('--username', default='admin', show_default=True, help='CM username')
+@option('--password', default='admin', show_default=True, help='CM password')
+@option('--facts', type=File(mode='r'), default=None,
+        help='Plan for recorded cluster facts (JSON) instead of asking CM')
+@option('--save-facts', type=File(mode='w'), default=None,
+        help='Record the cluster facts from CM to this JSON file')
+@option('--profile', default=planner.DEFAULT_PROFILE, show_default=True,
+        type=Choice(sorted(planner.PROFILES)), help='Workload profile')
+def plan_resources(cm_host, cm_port, username, password, facts, save_facts,
+                   profile):
+    """Print the spark-submit resource options for a workload"""
+    if facts is not None:
+        info = json.load(facts)
+    else:
+        info = operations.get_cluster_info(cm_host, cm_port, username,
+                                           password)
+    if save_facts is not None:
+        json.dump(info, save_facts, indent=2, sort_keys=True)
+    print(planner.spark_args(planner.plan(info, profile)))
+
+
+@main.command()
+@option_registry
+@option_catalog
+@option('--force', is_flag=True, default=False,
+        help='Re-parse every descriptor instead of only the changed ones')
+def build_catalog(registry, catalog_path, force):
+    """Compile the dataset registry into a catalog index"""
+    (_, rebuilt) = catalog.build_catalog(registry, catalog_path, force)
+    print('Rebuilt {0} catalog entries: {1}'.format(len(rebuilt),
+                                                    ', '.join(rebuilt)))
+
+
+@main.command('list')
+@option_registry
+@option_catalog
+@option('-q', '--query', default=None,
+        help='Only list datasets matching this name/description/format')
+def list_(registry, catalog_path, query):
+    """List the datasets in the registry"""
+    (index, _) = catalog.build_catalog(registry, catalog_path)
+    ts = '{0:<24}{1:>10}{2:>10}  {3}'
+    print(ts.format('name', 'resources', 'size', 'editions'))
+    for entry in catalog.list_datasets(index, query):
+        print(ts.format(entry['name'], entry['num_resources'],
+                        catalog.format_bytes(entry['total_bytes']),
+                        ','.join(e['name'] for e in entry['editions'])))
+
+
+@main.command()
+@option_registry
+@option_catalog
+@option('-d', '--dataset', help='Name of the dataset')
+def info(registry, catalog_path, dataset):
+    """Print the catalog entry for a dataset"""
+    (index, _) = catalog.build_catalog(registry, catalog_path)
+    entry = catalog.get_dataset(index, dataset)
+    print(json.dumps(entry, indent=2, sort_keys=True))
@@ -0,0 +1,259 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module wraps the Cloudera Manager API in a session that keeps one
+# authenticated ApiResource and caches the lookups that eggo does over and over
+# (the cluster, its hosts, services, roles, role config groups, and configs).
+# Anything that changes the cluster goes through the session, which drops the
+# cached entries the change may have made stale.
+
+
+from datetime import datetime
+
+from cm_api.api_client import ApiResource
+
+from eggo.error import EggoError
+from eggo.util import sleep_progressive
+
+
+def config_value(config, name):
+    """The set value of a config from a 'full' view, else its default"""
+    if name not in config:
+        return None
+    item = config[name]
+    return item.value if item.value is not None else item.default
+
+
+class CMSession(object):
+
+    def __init__(self, host, port=7180, username='admin', password='admin',
+                 version=9):
+        self.api = ApiResource(host, username=username, password=password,
+                               server_port=port, version=version)
+        self._cache = {}
+
+    def _cached(self, key, fn):
+        if key not in self._cache:
+            self._cache[key] = fn()
+        return self._cache[key]
+
+    def invalidate(self, *prefixes):
+        """Drop the cached lookups under the given prefixes (default: all)"""
+        if not prefixes:
+            self._cache.clear()
+            return
+        for key in list(self._cache):
+            if key[0] in prefixes:
+                del self._cache[key]
+
+    def wait_until_up(self):
+        # e.g., after restarting the CM server; it fails in many ways while
+        # it is starting up
+        start_time = datetime.now()
+        while True:
+            try:
+                self.api.get_cloudera_manager().get_config()
+                break
+            except Exception:
+                sleep_progressive(start_time)
+        self.invalidate()
+
+    # LOOKUPS
+
+    @property
+    def cluster(self):
+        return self._cached(('cluster',),
+                            lambda: list(self.api.get_all_clusters())[0])
+
+    @property
+    def mgmt_service(self):
+        return self._cached(
+            ('mgmt',), lambda: self.api.get_cloudera_manager().get_service())
+
+    def hosts(self):
+        # full view includes the role refs
+        return self._cached(('hosts',),
+                            lambda: list(self.api.get_all_hosts(view='full')))
+
+    def host(self, host_id):
+        for host in self.hosts():
+            if host.hostId == host_id:
+                return host
+        raise EggoError('CM has no host {0}'.format(host_id))
+
+    def services(self):
+        return self._cached(('services',),
+                            lambda: list(self.cluster.get_all_services()))
+
+    def service(self, service_type):
+        for service in self.services():
+            if service.type == service_type:
+                return service
+        raise EggoError('cluster has no {0} service'.format(service_type))
+
+    def service_by_name(self, name):
+        for service in self.services():
+            if service.name == name:
+                return service
+        raise EggoError('cluster has no service named {0}'.format(name))
+
+    def roles(self, service_type, role_type=None):
+        roles = self._cached(
+            ('roles', service_type),
+            lambda: list(self.service(service_type).get_all_roles()))
+        return [r for r in roles if role_type is None or r.type == role_type]
+
+    def role_config(self, role, view='full'):
+        return self._cached(('role_config', role.name, view),
+                            lambda: role.get_config(view))
+
+    def role_config_groups(self, service_type, role_type=None):
+        groups = self._cached(
+            ('role_config_groups', service_type),
+            lambda: list(
+                self.service(service_type).get_all_role_config_groups()))
+        return [g for g in groups
+                if role_type is None or g.roleType == role_type]
+
+    def base_role_config_group(self, service_type, role_type):
+        for group in self.role_config_groups(service_type, role_type):
+            if group.base:
+                return group
+        raise EggoError('no base {0} config group in {1}'.format(
+            role_type, service_type))
+
+    def role_config_group(self, service_type, name):
+        for group in self.role_config_groups(service_type):
+            if group.name == name:
+                return group
+        return None
+
+    def role_config_group_config(self, group, view='full'):
+        return self._cached(('group_config', group.name, view),
+                            lambda: group.get_config(view))
+
+    def service_config(self, service_type, view='full'):
+        return self._cached(
+            ('service_config', service_type, view),
+            lambda: self.service(service_type).get_config(view))
+
+    # WRITES
+
+    def update_service_config(self, service_type, config):
+        result = self.service(service_type).update_config(config)
+        self.invalidate('service_config')
+        return result
+
+    def update_role_config_group(self, group, config):
+        result = group.update_config(config)
+        self.invalidate('role_config_groups', 'group_config', 'role_config')
+        return result
+
+    def create_role_config_group(self, service_type, name, display_name,
+                                 role_type):
+        group = self.service(service_type).create_role_config_group(
+            name, display_name, role_type)
+        self.invalidate('role_config_groups')
+        return group
+
+    def move_roles(self, group, role_names):
+        """Move roles (of the group's service) into a role config group"""
+        group.move_roles(role_names)
+        self.invalidate('roles', 'role_config_groups')
+
+    def deploy_client_config(self):
+        return self.cluster.deploy_client_config().wait()
+
+    def restart(self):
+        result = self.cluster.restart().wait()
+        self.invalidate('roles', 'services')
+        return result
+
+    def stop(self):
+        result = self.cluster.stop().wait()
+        self.invalidate('roles', 'services')
+        return result
+
+    def start(self):
+        result = self.cluster.start().wait()
+        self.invalidate('roles', 'services')
+        return result
+
+    def stop_roles(self, service_name, role_names):
+        for cmd in self.service_by_name(service_name).stop_roles(*role_names):
+            cmd.wait()
+        self.invalidate('roles')
+
+    def start_roles(self, service_name, role_names):
+        for cmd in self.service_by_name(service_name).start_roles(
+                *role_names):
+            cmd.wait()
+        self.invalidate('roles')
+
+    # HOSTS
+
+    def wait_for_hosts(self, ip_addresses):
+        """Wait until the agents on the given hosts have registered with CM"""
+        start_time = datetime.now()
+        while True:
+            self.invalidate('hosts')
+            hosts = [h for h in self.hosts() if h.ipAddress in ip_addresses]
+            if len(hosts) == len(ip_addresses):
+                return hosts
+            sleep_progressive(start_time)
+
+    def add_hosts_like(self, reference_host_id, host_ids,
+                       template_name='eggo-worker'):
+        """Add hosts to the cluster with the same roles as a reference host
+
+        The roles are assigned (and started) through a host template built
+        from the role config groups of the reference host's roles.
+        """
+        groups = []
+        for ref in self.host(reference_host_id).roleRefs:
+            role = self.service_by_name(ref.serviceName).get_role(ref.roleName)
+            groups.append(role.roleConfigGroupRef)
+        self.cluster.add_hosts(host_ids)
+        template = self.cluster.create_host_template(template_name)
+        try:
+            template.set_role_config_groups(groups)
+            template.apply_host_template(host_ids, True).wait()
+        finally:
+            self.cluster.delete_host_template(template_name)
+        self.invalidate('hosts', 'roles')
+
+    def decommission_hosts(self, hostnames):
+        """Gracefully decommission all roles on the hosts
+
+        DataNodes finish re-replicating their blocks and NodeManagers finish
+        their running containers before this returns.
+        """
+        cmd = self.api.get_cloudera_manager().hosts_decommission(
+            hostnames).wait()
+        if not cmd.success:
+            raise EggoError('decommissioning {0} failed: {1}'.format(
+                ', '.join(hostnames), cmd.resultMessage))
+
+    def remove_hosts(self, host_ids):
+        """Delete the roles on the hosts and remove them from CM"""
+        for host_id in host_ids:
+            for ref in self.host(host_id).roleRefs:
+                self.service_by_name(ref.serviceName).delete_role(
+                    ref.roleName)
+            self.cluster.remove_host(host_id)
+            self.api.delete_host(host_id)
+        self.invalidate('hosts', 'roles')
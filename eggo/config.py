@@ -43,3 +43,8 @@ def get_ec2_key_pair():
 
 def get_ec2_private_key_file():
     return _get_env_var('EC2_PRIVATE_KEY_FILE')
+
+
+def get_eggo_cache_dir():
+    # local state kept between eggo-cluster invocations
+    return os.path.expanduser(os.environ.get('EGGO_CACHE_DIR', '~/.eggo'))
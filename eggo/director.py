@@ -22,16 +22,22 @@
 # that could be implemented on multiple clouds.
 
 
+import json
+import time
 from getpass import getuser
+from hashlib import md5
 from datetime import datetime
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from cStringIO import StringIO
+from contextlib import contextmanager
 
 from boto.ec2.networkinterface import (
     NetworkInterfaceCollection, NetworkInterfaceSpecification)
+from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType
 from fabric.api import (
-    sudo, run, execute, put, open_shell, env, parallel, cd)
+    sudo, run, execute, put, open_shell, env, cd, settings)
 from fabric.contrib.files import append, exists
-from cm_api.api_client import ApiResource
 
 from eggo.error import EggoError
 from eggo.config import (
@@ -40,9 +46,23 @@ from eggo.config import (
 from eggo.aws import (
     create_cf_connection, create_cf_stack, get_subnet_id, delete_stack,
     get_security_group_id, create_ec2_connection, get_tagged_instances,
-    wait_for_instance_state)
-from eggo.util import non_blocking_tunnel, tunnel_ctx
-from eggo.operations import generate_eggo_env_vars
+    wait_for_instance_state, wait_for_instances_state, get_image,
+    find_tagged_image, create_image, get_stack_instances, terminate_instances,
+    instance_store_devices)
+from eggo.util import (
+    tunnel_ctx, add_forward, cancel_forward, control_master_alive)
+from eggo.operations import generate_eggo_env_vars, get_worker_facts
+from eggo.planner import os_reserve_mb
+from eggo.scheduler import Step, run_steps, critical_path
+from eggo.artifacts import install_from_source, open_store, evict
+from eggo.mirror import (
+    install_mirror, use_mirror, configure_node, unconfigure_node, download)
+from eggo.logs import collect_logs as collect_host_logs
+from eggo.topology import get_topology, invalidate_topology
+from eggo.cm import CMSession, config_value
+from eggo.checkpoint import HostCheckpoint, command_succeeds, clear_markers
+from eggo.trace import traced, span
+from eggo.remote import remote_execute
 
 
 env.user = 'ec2-user'
@@ -50,24 +70,33 @@ env.key_filename = get_ec2_private_key_file()
 
 
 def cm_tunnel_ctx(manager_instance):
-    # shortcut fn returns a context object that sets up a tunnel on
-    # localhost:64999
+    # shortcut fn returns a context object that sets up a tunnel to CM on a
+    # free local port; concurrent steps each get their own port
     return tunnel_ctx(manager_instance.ip_address,
-                      manager_instance.private_ip_address, 7180, 64999,
+                      manager_instance.private_ip_address, 7180, None,
                       'ec2-user', get_ec2_private_key_file())
 
 
+@contextmanager
+def cm_session_ctx(manager_instance):
+    with cm_tunnel_ctx(manager_instance) as local_port:
+        yield CMSession('localhost', local_port)
+
+
+@traced
 def install_private_key():
     put(get_ec2_private_key_file(), 'id.pem')
     run('chmod 600 id.pem')
 
 
+@traced
 def install_director_client():
     sudo('wget http://archive.cloudera.com/director/redhat/6/x86_64/director/'
          'cloudera-director.repo -O /etc/yum.repos.d/cloudera-director.repo')
     sudo('yum -y install cloudera-director-client')
 
 
+@traced
 def create_launcher_instance(ec2_conn, cf_conn, stack_name, launcher_ami,
                              launcher_instance_type):
     launcher_instances = get_tagged_instances(
@@ -97,11 +126,15 @@ def create_launcher_instance(ec2_conn, cf_conn, stack_name, launcher_ami,
     launcher_instance.add_tag('eggo_stack_name', stack_name)
     launcher_instance.add_tag('eggo_node_type', 'launcher')
     wait_for_instance_state(ec2_conn, launcher_instance)
-    execute(install_director_client, hosts=[launcher_instance.ip_address])
-    execute(install_private_key, hosts=[launcher_instance.ip_address])
+    launcher_host = launcher_instance.ip_address
+    remote_execute(install_director_client, hosts=[launcher_host])
+    remote_execute(install_mirror, hosts=[launcher_host])
+    remote_execute(install_private_key, hosts=[launcher_host])
+    invalidate_topology(ec2_conn, stack_name)
     return launcher_instance
 
 
+@traced
 def run_director_bootstrap(director_conf_path, region, cluster_ami,
                            num_workers, stack_name, worker_instance_type):
     # replace variables in conf template and copy to launcher
@@ -125,59 +158,147 @@ def run_director_bootstrap(director_conf_path, region, cluster_ami,
     run('cloudera-director bootstrap director.conf')
 
 
+@traced
 def provision(region, availability_zone, stack_name, cf_template_path,
               launcher_ami, launcher_instance_type, worker_instance_type,
-              director_conf_path, cluster_ami, num_workers):
+              director_conf_path, cluster_ami, num_workers,
+              install_choices=None):
     start_time = datetime.now()
 
     # create cloudformation stack (VPC etc)
     cf_conn = create_cf_connection(region)
     create_cf_stack(cf_conn, stack_name, cf_template_path, availability_zone)
 
-    # create launcher instance
+    # use a baked AMI if one was made for the same install choices
     ec2_conn = create_ec2_connection(region)
+    if install_choices is not None:
+        baked_ami = find_baked_ami(
+            ec2_conn, install_fingerprint(cluster_ami, install_choices))
+        if baked_ami is not None:
+            print "Using baked AMI {i} for the cluster nodes.".format(
+                i=baked_ami.id)
+            cluster_ami = baked_ami.id
+
+    # create launcher instance
     launcher_instance = create_launcher_instance(
         ec2_conn, cf_conn, stack_name, launcher_ami, launcher_instance_type)
 
     # run bootstrap on launcher
-    execute(
+    remote_execute(
         run_director_bootstrap,
         director_conf_path=director_conf_path, region=region,
         cluster_ami=cluster_ami, num_workers=num_workers,
         stack_name=stack_name, worker_instance_type=worker_instance_type,
         hosts=[launcher_instance.ip_address])
+    # the stack has new nodes
+    invalidate_topology(ec2_conn, stack_name)
 
     end_time = datetime.now()
     print "Cluster has started. Took {t} minutes.".format(
         t=(end_time - start_time).seconds / 60)
 
 
+def install_fingerprint(base_ami, install_choices):
+    # identifies what config_cluster installs on top of a base AMI
+    choices = dict(install_choices, base_ami=base_ami)
+    return md5(json.dumps(choices, sort_keys=True)).hexdigest()[:16]
+
+
+def find_baked_ami(ec2_conn, fingerprint):
+    return find_tagged_image(ec2_conn, {'eggo_fingerprint': fingerprint})
+
+
+def get_base_ami(ec2_conn, image_id):
+    # baked AMIs remember the AMI they were baked on top of
+    return get_image(ec2_conn, image_id).tags.get('eggo_base_ami', image_id)
+
+
+def is_baked_ami(ec2_conn, image_id, install_choices):
+    image = get_image(ec2_conn, image_id)
+    base_ami = image.tags.get('eggo_base_ami', image_id)
+    return (image.tags.get('eggo_fingerprint') ==
+            install_fingerprint(base_ami, install_choices))
+
+
+@traced
+def prepare_for_baking(metadata_dirs=()):
+    """Remove what belongs to this cluster from the master before imaging it
+
+    Returns whether the node was using the launcher mirror.
+    """
+    # a snapshot can't leave out files, and deleting the namespace would take
+    # down this cluster's HDFS; instance store dirs aren't in the image anyway
+    on_root = [d for d in metadata_dirs if run(
+        "df -P {0} 2>/dev/null | awk 'NR == 2 {{print $6}}'".format(d)) == '/']
+    if on_root:
+        raise EggoError(
+            'The HDFS metadata in {0} is on the root volume and would be '
+            'baked into the image; bake from a cluster that keeps it on '
+            'instance store.'.format(', '.join(on_root)))
+    sudo('yum clean all')
+    # the config_cluster checkpoint belongs to this cluster, not the image
+    clear_markers()
+    # so do the launcher mirror, the key, and the cluster's hostnames
+    mirrored = unconfigure_node()
+    run('rm -f id.pem eggo_env_vars.sh')
+    run("sed -i '/eggo_env_vars.sh/d' .bash_profile")
+    # make sure the builds are on disk before the snapshot
+    run('sync')
+    return mirrored
+
+
+@traced
+def bake_ami(region, stack_name, install_choices, no_reboot=True):
+    ec2_conn = create_ec2_connection(region)
+    topology = get_topology(ec2_conn, stack_name)
+    master_instance = topology.master
+    master_host = master_instance.ip_address
+    base_ami = get_base_ami(ec2_conn, master_instance.image_id)
+    fingerprint = install_fingerprint(base_ami, install_choices)
+    with cm_session_ctx(topology.manager) as session:
+        metadata_dirs = hdfs_metadata_dirs(session)
+    mirrored = remote_execute(prepare_for_baking, metadata_dirs,
+                              hosts=[master_host])[master_host]
+    name = 'eggo-{0}-{1}'.format(fingerprint,
+                                 datetime.now().strftime('%Y%m%d%H%M%S'))
+    tags = dict(('eggo_' + k, str(v)) for (k, v) in install_choices.items())
+    tags.update({'owner': getuser(), 'eggo_fingerprint': fingerprint,
+                 'eggo_base_ami': base_ami})
+    try:
+        return create_image(ec2_conn, master_instance.id, name, tags,
+                            no_reboot)
+    finally:
+        # this cluster keeps using the master
+        remote_execute(install_private_key, hosts=[master_host])
+        if mirrored:
+            use_mirror(topology.launcher)
+            remote_execute(configure_node, hosts=[master_host])
+        install_env_vars(region, stack_name)
+
+
 def get_launcher_instance(ec2_conn, stack_name):
-    return get_tagged_instances(ec2_conn, {'eggo_stack_name': stack_name,
-                                           'eggo_node_type': 'launcher'})[0]
+    return get_topology(ec2_conn, stack_name).launcher
 
 
 def get_manager_instance(ec2_conn, stack_name):
-    return get_tagged_instances(ec2_conn, {'eggo_stack_name': stack_name,
-                                           'eggo_node_type': 'manager'})[0]
+    return get_topology(ec2_conn, stack_name).manager
 
 
 def get_master_instance(ec2_conn, stack_name):
-    return get_tagged_instances(ec2_conn, {'eggo_stack_name': stack_name,
-                                           'eggo_node_type': 'master'})[0]
+    return get_topology(ec2_conn, stack_name).master
 
 
 def get_worker_instances(ec2_conn, stack_name):
-    return get_tagged_instances(ec2_conn, {'eggo_stack_name': stack_name,
-                                           'eggo_node_type': 'worker'})
+    return get_topology(ec2_conn, stack_name).workers
 
 
 def describe(region, stack_name):
     ec2_conn = create_ec2_connection(region)
-    print 'Launcher', get_launcher_instance(ec2_conn, stack_name).ip_address
-    print 'Manager', get_manager_instance(ec2_conn, stack_name).ip_address
-    print 'Master', get_master_instance(ec2_conn, stack_name).ip_address
-    for instance in get_worker_instances(ec2_conn, stack_name):
+    topology = get_topology(ec2_conn, stack_name)
+    print 'Launcher', topology.launcher.ip_address
+    print 'Manager', topology.manager.ip_address
+    print 'Master', topology.master.ip_address
+    for instance in topology.workers:
         print 'Worker', instance.ip_address
 
 
@@ -197,261 +318,461 @@ def login(region, stack_name, node):
 
 def web_proxy(region, stack_name):
     ec2_conn = create_ec2_connection(region)
-    manager_instance = get_manager_instance(ec2_conn, stack_name)
-    master_instance = get_master_instance(ec2_conn, stack_name)
-    worker_instances = get_worker_instances(ec2_conn, stack_name)
-
-    tunnels = []
+    topology = get_topology(ec2_conn, stack_name)
+    manager_instance = topology.manager
+    master_instance = topology.master
+
+    # (name, tunnel host, remote port, local port)
+    forwards = [('CM WebUI', manager_instance, 7180, 7180),
+                ('YARN RM', master_instance, 8088, 8088),
+                ('YARN JobHistory', master_instance, 19888, 19888)]
     ts = '{0:<22}{1:<17}{2:<17}{3:<7}localhost:{4}'
     print(ts.format('name', 'public', 'private', 'remote', 'local'))
-
-    # CM
-    tunnels.append(non_blocking_tunnel(manager_instance.ip_address,
-                                       manager_instance.private_ip_address,
-                                       7180, 7180, 'ec2-user',
-                                       get_ec2_private_key_file()))
-    print(ts.format(
-        'CM WebUI', manager_instance.ip_address,
-        manager_instance.private_ip_address, 7180, 7180))
-
-    # YARN RM
-    tunnels.append(non_blocking_tunnel(master_instance.ip_address,
-                                       master_instance.private_ip_address,
-                                       8088, 8088, 'ec2-user',
-                                       get_ec2_private_key_file()))
-    print(ts.format(
-        'YARN RM', master_instance.ip_address,
-        master_instance.private_ip_address, 8088, 8088))
-
-    # YARN JobHistory
-    tunnels.append(non_blocking_tunnel(master_instance.ip_address,
-                                       master_instance.private_ip_address,
-                                       19888, 19888, 'ec2-user',
-                                       get_ec2_private_key_file()))
-    print(ts.format(
-        'YARN JobHistory', master_instance.ip_address,
-        master_instance.private_ip_address, 19888, 19888))
-
     try:
-        # block on an arbitrary ssh tunnel
-        tunnels[-1].wait()
+        # all the forwards to a host share one ssh connection
+        for (name, instance, remote_port, local_port) in forwards:
+            add_forward(instance.ip_address, instance.private_ip_address,
+                        remote_port, local_port, 'ec2-user',
+                        get_ec2_private_key_file())
+            print(ts.format(name, instance.ip_address,
+                            instance.private_ip_address, remote_port,
+                            local_port))
+        while True:
+            time.sleep(60)
+            # an idle ssh master exits after its ControlPersist, and the
+            # forwards with it; bring them back on a new one
+            dead = [instance.ip_address for (_, instance, _, _) in forwards
+                    if not control_master_alive(instance.ip_address,
+                                                'ec2-user',
+                                                get_ec2_private_key_file())]
+            for (_, instance, remote_port, local_port) in forwards:
+                if instance.ip_address in dead:
+                    add_forward(instance.ip_address,
+                                instance.private_ip_address, remote_port,
+                                local_port, 'ec2-user',
+                                get_ec2_private_key_file())
+    except KeyboardInterrupt:
+        pass
     finally:
-        for tunnel in tunnels:
-            tunnel.terminate()
+        for (_, instance, remote_port, local_port) in forwards:
+            cancel_forward(instance.ip_address, instance.private_ip_address,
+                           remote_port, local_port, 'ec2-user',
+                           get_ec2_private_key_file())
 
 
+@traced
+def collect_logs(region, stack_name, local_dir=None, since=None, until=None,
+                 app_id=None):
+    ec2_conn = create_ec2_connection(region)
+    topology = get_topology(ec2_conn, stack_name)
+    if local_dir is None:
+        local_dir = 'logs-{0}-{1}'.format(
+            stack_name, datetime.now().strftime('%Y%m%d%H%M%S'))
+    nodes = topology.of_type('launcher') + topology.cluster_nodes
+    sizes = collect_host_logs(
+        [n.ip_address for n in nodes], local_dir, since, until, app_id,
+        yarn_host=topology.master.ip_address)
+    ts = '{0:<10}{1:<17}{2:>10}'
+    print ts.format('type', 'public', 'MB')
+    for node in nodes:
+        print ts.format(node.node_type, node.ip_address,
+                        '{0:.1f}'.format(sizes[node.ip_address] / 1e6))
+    print "Logs are in {d}".format(d=local_dir)
+
+
+@traced
 def run_director_terminate():
     run('cloudera-director terminate --lp.terminate.assumeYes=true '
         'director.conf')
 
 
-def terminate_launcher_instance(ec2_conn, stack_name):
-    launcher_instance = get_launcher_instance(ec2_conn, stack_name)
-    launcher_instance.terminate()
-    wait_for_instance_state(ec2_conn, launcher_instance, 'terminated')
+def timed(timings, phase, fn, *args, **kwargs):
+    start = time.time()
+    try:
+        with span('teardown.{0}'.format(phase)):
+            return fn(*args, **kwargs)
+    finally:
+        timings.append((phase, time.time() - start))
 
 
-def teardown(region, stack_name):
-    # terminate Hadoop cluster (prompts for confirmation)
+@traced
+def teardown(region, stack_name, director_terminate=True):
+    start_time = datetime.now()
     ec2_conn = create_ec2_connection(region)
-    execute(run_director_terminate,
-            hosts=[get_launcher_instance(ec2_conn, stack_name).ip_address])
+    cf_conn = create_cf_connection(region)
+    timings = []
+    removed = []
+
+    # one describe call for everything tagged with the stack
+    instances = get_stack_instances(ec2_conn, stack_name)
+    launchers = [i for i in instances
+                 if i.tags.get('eggo_node_type') == 'launcher']
+    if director_terminate and launchers:
+        # Director doesn't know about autoscaled workers, so they go at the
+        # same time as the nodes Director terminates
+        pool = ThreadPool(1)
+        try:
+            autoscaled = pool.apply_async(
+                timed, (timings, 'autoscaled workers', terminate_instances,
+                        ec2_conn, [i for i in instances
+                                   if i.tags.get('eggo_autoscaled')]))
+            try:
+                timed(timings, 'director terminate', remote_execute,
+                      run_director_terminate,
+                      hosts=[launchers[0].ip_address])
+            except Exception as e:
+                # whatever Director left running goes in the sweep below
+                print "Director terminate failed: {e}".format(e=e)
+            removed.extend(autoscaled.get())
+        finally:
+            pool.close()
+        remaining = get_stack_instances(ec2_conn, stack_name)
+        remaining_ids = set(i.id for i in remaining)
+        removed.extend(i for i in instances if i.id not in remaining_ids and
+                       not i.tags.get('eggo_autoscaled'))
+        instances = remaining
+
+    # the launcher and anything left over (Director disabled or failed,
+    # stray nodes from earlier runs) go in one batch
+    removed.extend(timed(timings, 'terminate instances', terminate_instances,
+                         ec2_conn, instances))
+    invalidate_topology(ec2_conn, stack_name)
+
+    # the VPC can only go once nothing runs in it
+    timed(timings, 'delete stack', delete_stack, cf_conn, stack_name)
+
+    ts = '{0:<22}{1:<10}{2:<17}{3}'
+    print ts.format('removed', 'type', 'private', 'instance type')
+    for instance in removed:
+        print ts.format(instance.id, instance.tags.get('eggo_node_type', '?'),
+                        instance.private_ip_address, instance.instance_type)
+    for (phase, seconds) in timings:
+        print "{p:<22}{t:.0f} seconds".format(p=phase, t=seconds)
+    end_time = datetime.now()
+    print "Teardown complete. Took {t} minutes.".format(
+        t=(end_time - start_time).seconds / 60)
 
-    # terminate launcher instance
-    terminate_launcher_instance(ec2_conn, stack_name)
 
-    # delete stack
-    cf_conn = create_cf_connection(region)
-    delete_stack(cf_conn, stack_name)
+JDK_PACKAGE = 'jdk1.8.0_51'
+JDK_RPM = 'jdk-8-linux-x64.rpm'
+JDK_RPM_URL = ('http://download.oracle.com/otn-pub/java/jdk/8u51-b16/'
+               'jdk-8u51-linux-x64.rpm')
 
 
-def install_java_8(region, stack_name):
-    # following general protocol for upgrading to JDK 1.8 here:
-    # http://www.cloudera.com/content/cloudera/en/documentation/core/v5-3-x/topics/cdh_cm_upgrading_to_jdk8.html
-    ec2_conn = create_ec2_connection(region)
-    manager_instance = get_manager_instance(ec2_conn, stack_name)
-    cluster_instances = (
-        get_worker_instances(ec2_conn, stack_name) +
-        [manager_instance, get_master_instance(ec2_conn, stack_name)])
-    cluster_hosts = [i.ip_address for i in cluster_instances]
+def has_jdk_8():
+    with settings(warn_only=True):
+        return run('rpm -q {0}'.format(JDK_PACKAGE)).succeeded
 
-    with cm_tunnel_ctx(manager_instance) as local_port:
-        # Connect to CM API
-        cm_api = ApiResource('localhost', username='admin', password='admin',
-                             server_port=local_port, version=9)
-        cloudera_manager = cm_api.get_cloudera_manager()
 
+@traced
+def fetch_jdk_rpm(private_ips):
+    # download once (on the master) and copy to the other nodes over the VPC
+    if not exists(JDK_RPM):
+        download(JDK_RPM_URL, JDK_RPM,
+                 headers=['Cookie: oraclelicense=accept-securebackup-cookie'])
+    if private_ips:
+        run('echo {ips} | tr " " "\\n" | xargs -P 16 -I IP '
+            'scp -i id.pem -o UserKnownHostsFile=/dev/null '
+            '-o StrictHostKeyChecking=no {rpm} ec2-user@IP:'.format(
+                ips=' '.join(private_ips), rpm=JDK_RPM))
+
+
+@traced
+def stop_cm_agent():
+    sudo('service cloudera-scm-agent stop')
+
+
+@traced
+def start_cm_agent():
+    sudo('service cloudera-scm-agent start')
+
+
+@traced
+def stop_cm_server():
+    sudo('service cloudera-scm-server stop')
+
+
+@traced
+def start_cm_server():
+    sudo('service cloudera-scm-server start')
+
+
+@traced
+def swap_jdks():
+    # Cleanup other Java versions and install JDK 1.8 from the fetched RPM
+    sudo('rpm -qa | grep jdk | xargs rpm -e')
+    sudo('rm -rf /usr/java/jdk1.6*')
+    sudo('rm -rf /usr/java/jdk1.7*')
+    sudo('yum install -y {0}'.format(JDK_RPM))
+    append('/home/ec2-user/.bash_profile',
+           'export JAVA_HOME=`find /usr/java -name "jdk1.8*"`')
+
+
+def get_host_roles(session):
+    """Return {private ip: {service name: [role names]}} for the cluster"""
+    roles = {}
+    cluster_name = session.cluster.name
+    for host in session.hosts():
+        by_service = roles.setdefault(host.ipAddress, {})
+        for ref in host.roleRefs:
+            if getattr(ref, 'clusterName', None) == cluster_name:
+                by_service.setdefault(ref.serviceName, []).append(
+                    ref.roleName)
+    return roles
+
+
+def stop_roles(session, by_service):
+    for (service_name, role_names) in by_service.iteritems():
+        session.stop_roles(service_name, role_names)
+
+
+def start_roles(session, by_service):
+    for (service_name, role_names) in by_service.iteritems():
+        session.start_roles(service_name, role_names)
+
+
+def apply_pending_config(session):
+    """Start whatever is stopped, and restart if config awaits a restart"""
+    session.invalidate('services', 'mgmt')
+    if session.mgmt_service.serviceState != 'STARTED':
+        print "Starting the Cloudera Management Service"
+        session.mgmt_service.start().wait()
+    pending = [s.name for s in session.services()
+               if s.serviceState != 'STARTED' or
+               s.configStalenessStatus != 'FRESH']
+    if pending:
+        print "Restarting the cluster for {s}".format(s=', '.join(pending))
+        session.restart()
+
+
+@traced
+def swap_jdks_full_stop(manager_instance, hosts):
+    # the tunnel (and session) survive the CM server restart
+    with cm_session_ctx(manager_instance) as session:
         # Stop Cloudera Management Service
         print "Stopping Cloudera Management Service"
-        mgmt_service = cloudera_manager.get_service()
-        mgmt_service.stop().wait()
+        session.mgmt_service.stop().wait()
 
         # Stop cluster
         print "Stopping the cluster"
-        clusters = cm_api.get_all_clusters()
-        cluster = clusters.objects[0]
-        cluster.stop().wait()
-
-    # Stop all Cloudera Manager Agents
-    @parallel
-    def stop_cm_agents():
-        sudo('service cloudera-scm-agent stop')
-    execute(stop_cm_agents, hosts=cluster_hosts)
-
-    # Stop the Cloudera Manager Server
-    def stop_cm_server():
-        sudo('service cloudera-scm-server stop')
-    execute(stop_cm_server, hosts=[manager_instance.ip_address])
-
-    # Cleanup other Java versions and install JDK 1.8
-    @parallel
-    def swap_jdks():
-        sudo('rpm -qa | grep jdk | xargs rpm -e')
-        sudo('rm -rf /usr/java/jdk1.6*')
-        sudo('rm -rf /usr/java/jdk1.7*')
-        run('wget -O jdk-8-linux-x64.rpm --no-cookies --no-check-certificate '
-            '--header "Cookie: oraclelicense=accept-securebackup-cookie" '
-            'http://download.oracle.com/otn-pub/java/jdk/8u51-b16/'
-            'jdk-8u51-linux-x64.rpm')
-        sudo('yum install -y jdk-8-linux-x64.rpm')
-        append('/home/ec2-user/.bash_profile',
-               'export JAVA_HOME=`find /usr/java -name "jdk1.8*"`')
-    execute(swap_jdks, hosts=cluster_hosts)
-
-    # Start the Cloudera Manager Server
-    def start_cm_server():
-        sudo('service cloudera-scm-server start')
-    execute(start_cm_server, hosts=[manager_instance.ip_address])
-
-    # Start all Cloudera Manager Agents
-    @parallel
-    def start_cm_agents():
-        sudo('service cloudera-scm-agent start')
-    execute(start_cm_agents, hosts=cluster_hosts)
+        session.stop()
 
-    with cm_tunnel_ctx(manager_instance) as local_port:
-        # Connect to CM API
-        cm_api = ApiResource('localhost', username='admin', password='admin',
-                             server_port=local_port, version=9)
-        cloudera_manager = cm_api.get_cloudera_manager()
+        remote_execute(stop_cm_agent, hosts=hosts)
+        remote_execute(stop_cm_server, hosts=[manager_instance.ip_address])
+        remote_execute(swap_jdks, hosts=hosts)
+        remote_execute(start_cm_server, hosts=[manager_instance.ip_address])
+        remote_execute(start_cm_agent, hosts=hosts)
+        session.wait_until_up()
 
         # Start the cluster and the mgmt service
         print "Starting the cluster"
-        cluster.start().wait()
+        session.start()
         print "Starting the Cloudera Management Service"
-        cloudera_manager = cm_api.get_cloudera_manager()
-        mgmt_service = cloudera_manager.get_service()
-        mgmt_service.start().wait()
+        session.mgmt_service.start().wait()
+
+
+@traced
+def swap_jdks_rolling(manager_instance, master_instance, instances,
+                      batch_size):
+    # workers go in batches while HDFS/YARN keep serving; the master roles
+    # and CM itself have to go down briefly, so they go last
+    last = [i for i in instances
+            if i.id in (manager_instance.id, master_instance.id)]
+    workers = [i for i in instances if i not in last]
+    with cm_session_ctx(manager_instance) as session:
+        host_roles = get_host_roles(session)
+
+        for i in xrange(0, len(workers), batch_size):
+            batch = workers[i:i + batch_size]
+            print "Upgrading JDK on {h}".format(
+                h=', '.join(w.ip_address for w in batch))
+            for instance in batch:
+                stop_roles(session,
+                           host_roles.get(instance.private_ip_address, {}))
+            hosts = [w.ip_address for w in batch]
+            remote_execute(stop_cm_agent, hosts=hosts)
+            remote_execute(swap_jdks, hosts=hosts)
+            remote_execute(start_cm_agent, hosts=hosts)
+            for instance in batch:
+                start_roles(session,
+                            host_roles.get(instance.private_ip_address, {}))
+
+        if last:
+            print "Upgrading JDK on the master and Cloudera Manager nodes"
+            hosts = [i.ip_address for i in last]
+            with_manager = manager_instance.id in [i.id for i in last]
+            for instance in last:
+                stop_roles(session,
+                           host_roles.get(instance.private_ip_address, {}))
+            if with_manager:
+                session.mgmt_service.stop().wait()
+            remote_execute(stop_cm_agent, hosts=hosts)
+            if with_manager:
+                remote_execute(stop_cm_server,
+                               hosts=[manager_instance.ip_address])
+            remote_execute(swap_jdks, hosts=hosts)
+            if with_manager:
+                remote_execute(start_cm_server,
+                               hosts=[manager_instance.ip_address])
+            remote_execute(start_cm_agent, hosts=hosts)
+            if with_manager:
+                session.wait_until_up()
+            for instance in last:
+                start_roles(session,
+                            host_roles.get(instance.private_ip_address, {}))
+            if with_manager:
+                session.mgmt_service.start().wait()
+
+
+@traced
+def install_java_8(region, stack_name, rolling=False, batch_size=1):
+    # following general protocol for upgrading to JDK 1.8 here:
+    # http://www.cloudera.com/content/cloudera/en/documentation/core/v5-3-x/topics/cdh_cm_upgrading_to_jdk8.html
+    ec2_conn = create_ec2_connection(region)
+    topology = get_topology(ec2_conn, stack_name)
+    manager_instance = topology.manager
+    master_instance = topology.master
+    cluster_instances = topology.cluster_nodes
+
+    # skip the hosts that already have the target JDK
+    has_jdk = remote_execute(has_jdk_8,
+                             hosts=[i.ip_address for i in cluster_instances])
+    instances = [i for i in cluster_instances if not has_jdk[i.ip_address]]
+    if len(instances) == 0:
+        print "All hosts already have {p}; skipping.".format(p=JDK_PACKAGE)
+        # the config steps before this one leave the restart to it, and an
+        # earlier run may have stopped the cluster before failing
+        with cm_session_ctx(manager_instance) as session:
+            apply_pending_config(session)
+        return
+
+    remote_execute(fetch_jdk_rpm,
+                   private_ips=[i.private_ip_address for i in instances
+                                if i.id != master_instance.id],
+                   hosts=[master_instance.ip_address])
+
+    if rolling:
+        swap_jdks_rolling(manager_instance, master_instance, instances,
+                          batch_size)
+    else:
+        swap_jdks_full_stop(manager_instance,
+                            [i.ip_address for i in instances])
 
 
+@traced
 def create_hdfs_home():
-    sudo('hadoop fs -mkdir /user/ec2-user', user='hdfs')
+    sudo('hadoop fs -mkdir -p /user/ec2-user', user='hdfs')
     sudo('hadoop fs -chown ec2-user:supergroup /user/ec2-user', user='hdfs')
     sudo('hadoop fs -chmod 777 /user/ec2-user', user='hdfs')
 
 
+@traced
 def install_dev_tools():
     sudo("yum groupinstall -y 'Development Tools'")
     sudo('yum install -y cmake xz-devel ncurses ncurses-devel')
     sudo('yum install -y zlib zlib-devel snappy snappy-devel')
     sudo('yum install -y python-devel')
-    sudo('curl https://bootstrap.pypa.io/get-pip.py | python')
+    download('https://bootstrap.pypa.io/get-pip.py')
+    sudo('python get-pip.py')
     sudo('pip install -U pip setuptools')
 
 
-def install_parquet_tools(version='1.8.1'):
-    run('curl -L -O http://search.maven.org/remotecontent?filepath=org/apache/'
-        'parquet/parquet-tools/{0}/parquet-tools-{0}.jar'.format(version))
+PARQUET_TOOLS_VERSION = '1.8.1'
+MAVEN_VERSION = '3.3.3'
+GRADLE_VERSION = '2.6'
+
+
+@traced
+def install_parquet_tools(version=PARQUET_TOOLS_VERSION):
+    download('http://search.maven.org/remotecontent?filepath=org/apache/'
+             'parquet/parquet-tools/{0}/parquet-tools-{0}.jar'.format(version),
+             'parquet-tools-{0}.jar'.format(version))
 
 
+@traced
 def install_git():
     sudo('yum install -y git')
 
 
-def install_maven(version='3.3.3'):
+@traced
+def install_maven(version=MAVEN_VERSION):
     url = ('http://apache.mesi.com.ar/maven/maven-3/{0}/binaries/'
            'apache-maven-{0}-bin.tar.gz'.format(version))
-    run('wget {0}'.format(url))
+    download(url)
     run('tar -xzf apache-maven-{0}-bin.tar.gz'.format(version))
     append('/home/ec2-user/.bash_profile',
            'export PATH=/home/ec2-user/apache-maven-{0}/bin:$PATH'.format(
                version))
 
 
-def install_gradle(version='2.6'):
+@traced
+def install_gradle(version=GRADLE_VERSION):
     url = ('https://services.gradle.org/distributions/'
            'gradle-{0}-bin.zip'.format(version))
-    run('wget {0}'.format(url))
-    run('unzip gradle-{0}-bin.zip'.format(version))
+    download(url)
+    run('unzip -o gradle-{0}-bin.zip'.format(version))
     append('/home/ec2-user/.bash_profile',
            'export PATH=/home/ec2-user/gradle-{0}/bin:$PATH'.format(version))
 
 
-def install_adam(fork='bigdatagenomics', branch='master'):
-    run('git clone https://github.com/{0}/adam.git'.format(fork))
-    with cd('adam'):
-        if branch != 'master':
-            run('git checkout origin/{0}'.format(branch))
-        run('mvn clean package -DskipTests')
+@traced
+def install_adam(fork='bigdatagenomics', branch='master', cache=None):
+    install_from_source('adam', fork, branch, 'master',
+                        'mvn clean package -DskipTests', cache)
 
 
-def install_opencb_ga4gh(fork='opencb', branch='master'):
-    run('git clone https://github.com/{0}/ga4gh.git'.format(fork))
-    with cd('ga4gh'):
-        if branch != 'master':
-            run('git checkout origin/{0}'.format(branch))
-        run('mvn clean install -DskipTests')
+@traced
+def install_opencb_ga4gh(fork='opencb', branch='master', cache=None):
+    install_from_source('ga4gh', fork, branch, 'master',
+                        'mvn clean install -DskipTests', cache,
+                        m2_paths=['org/opencb', 'org/ga4gh'])
 
 
-def install_opencb_java_common(fork='opencb', branch='develop'):
-    run('git clone https://github.com/{0}/java-common-libs.git'.format(fork))
-    with cd('java-common-libs'):
-        if branch != 'develop':
-            run('git checkout origin/{0}'.format(branch))
-        run('mvn clean install -DskipTests')
+@traced
+def install_opencb_java_common(fork='opencb', branch='develop', cache=None):
+    install_from_source('java-common-libs', fork, branch, 'develop',
+                        'mvn clean install -DskipTests', cache,
+                        m2_paths=['org/opencb'])
 
 
-def install_opencb_biodata(fork='opencb', branch='develop'):
-    run('git clone https://github.com/{0}/biodata.git'.format(fork))
-    with cd('biodata'):
-        if branch != 'develop':
-            run('git checkout origin/{0}'.format(branch))
-        run('mvn clean install -DskipTests')
+@traced
+def install_opencb_biodata(fork='opencb', branch='develop', cache=None):
+    install_from_source('biodata', fork, branch, 'develop',
+                        'mvn clean install -DskipTests', cache,
+                        m2_paths=['org/opencb'])
 
 
-def install_opencb_hpg_bigdata(fork='opencb', branch='develop'):
-    run('git clone https://github.com/{0}/hpg-bigdata.git'.format(fork))
-    with cd('hpg-bigdata'):
-        if branch != 'develop':
-            run('git checkout origin/{0}'.format(branch))
-        run('./build.sh')
+@traced
+def install_opencb_hpg_bigdata(fork='opencb', branch='develop', cache=None):
+    install_from_source('hpg-bigdata', fork, branch, 'develop', './build.sh',
+                        cache)
 
 
-def install_opencb(hosts):
-    execute(install_opencb_ga4gh, hosts=hosts)
-    execute(install_opencb_java_common, hosts=hosts)
-    execute(install_opencb_biodata, hosts=hosts)
-    execute(install_opencb_hpg_bigdata, hosts=hosts)
+def install_opencb(hosts, cache=None):
+    remote_execute(install_opencb_ga4gh, cache=cache, hosts=hosts)
+    remote_execute(install_opencb_java_common, cache=cache, hosts=hosts)
+    remote_execute(install_opencb_biodata, cache=cache, hosts=hosts)
+    remote_execute(install_opencb_hpg_bigdata, cache=cache, hosts=hosts)
 
 
-def install_quince(fork='cloudera', branch='master'):
-    run('git clone https://github.com/{0}/quince.git'.format(fork))
-    with cd('quince'):
-        if branch != 'master':
-            run('git checkout origin/{0}'.format(branch))
-        run('mvn clean package -DskipTests')
+@traced
+def install_quince(fork='cloudera', branch='master', cache=None):
+    install_from_source('quince', fork, branch, 'master',
+                        'mvn clean package -DskipTests', cache)
 
 
-def install_gatk(fork='broadinstitute', branch='master'):
-    run('git clone https://github.com/{0}/gatk.git'.format(fork))
-    with cd('gatk'):
-        if branch != 'master':
-            run('git checkout origin/{0}'.format(branch))
-        run('gradle sparkJar')
+@traced
+def install_gatk(fork='broadinstitute', branch='master', cache=None):
+    install_from_source('gatk', fork, branch, 'master', 'gradle sparkJar',
+                        cache)
 
 
+@traced
 def install_eggo(fork='bigdatagenomics', branch='master', reinstall=False):
-    if reinstall and exists('/home/ec2-user/eggo'):
+    if not reinstall and command_succeeds('python -c "import eggo"'):
+        return
+    # e.g., left over from a failed run
+    if exists('/home/ec2-user/eggo'):
         sudo('rm -rf /home/ec2-user/eggo')
     run('git clone https://github.com/{0}/eggo.git'.format(fork))
     with cd('eggo'):
@@ -460,41 +781,161 @@ def install_eggo(fork='bigdatagenomics', branch='master', reinstall=False):
         sudo('python setup.py install')
 
 
+def get_shape_config_group(session, cores, memory_gb):
+    name = 'yarn-NODEMANAGER-{0}c-{1}g'.format(cores, memory_gb)
+    group = session.role_config_group('YARN', name)
+    if group is None:
+        group = session.create_role_config_group(
+            'YARN', name, 'NodeManager {0} cores {1} GB'.format(cores,
+                                                                memory_gb),
+            'NODEMANAGER')
+    return group
+
+
+@traced
 def adjust_yarn_memory_limits(region, stack_name, restart=True):
     ec2_conn = create_ec2_connection(region)
     manager_instance = get_manager_instance(ec2_conn, stack_name)
-    with cm_tunnel_ctx(manager_instance) as local_port:
-        cm_api = ApiResource('localhost', username='admin', password='admin',
-                             server_port=local_port, version=9)
-        cluster = list(cm_api.get_all_clusters())[0]
-        host = list(cm_api.get_all_hosts())[0]  # all hosts same instance type
-        yarn = filter(lambda x: x.type == 'YARN',
-                      list(cluster.get_all_services()))[0]
-        rm_cg = filter(lambda x: x.roleType == 'RESOURCEMANAGER',
-                       list(yarn.get_all_role_config_groups()))[0]
-        nm_cg = filter(lambda x: x.roleType == 'NODEMANAGER',
-                       list(yarn.get_all_role_config_groups()))[0]
-        rm_cg.update_config({
-            'yarn_scheduler_maximum_allocation_mb': (
-                int(host.totalPhysMemBytes / 1024. / 1024.)),
-            'yarn_scheduler_maximum_allocation_vcores': host.numCores})
-        nm_cg.update_config({
-            'yarn_nodemanager_resource_memory_mb': (
-                int(host.totalPhysMemBytes / 1024. / 1024.)),
-            'yarn_nodemanager_resource_cpu_vcores': host.numCores})
-        cluster.deploy_client_config().wait()
+    with cm_session_ctx(manager_instance) as session:
+        # NodeManagers on the same instance shape share a role config group,
+        # so each shape gets limits that use its full capacity
+        shapes = {}
+        for worker in get_worker_facts(session):
+            shape = (worker['cores'], worker['memory'] // 1024 ** 3)
+            shapes.setdefault(shape, []).append(worker)
+        max_memory_mb = 0
+        max_vcores = 0
+        for ((cores, memory_gb), workers) in sorted(shapes.iteritems()):
+            if len(shapes) == 1:
+                nm_cg = session.base_role_config_group('YARN', 'NODEMANAGER')
+            else:
+                nm_cg = get_shape_config_group(session, cores, memory_gb)
+                # on a rerun, the roles are already in their groups
+                role_names = [w['role'] for w in workers
+                              if w['group'] != nm_cg.name]
+                if role_names:
+                    session.move_roles(nm_cg, role_names)
+            physical_mb = min(w['memory'] for w in workers) // 1024 ** 2
+            memory_mb = physical_mb - os_reserve_mb(physical_mb)
+            session.update_role_config_group(nm_cg, {
+                'yarn_nodemanager_resource_memory_mb': memory_mb,
+                'yarn_nodemanager_resource_cpu_vcores': cores})
+            max_memory_mb = max(max_memory_mb, memory_mb)
+            max_vcores = max(max_vcores, cores)
+        rm_cg = session.base_role_config_group('YARN', 'RESOURCEMANAGER')
+        session.update_role_config_group(rm_cg, {
+            'yarn_scheduler_maximum_allocation_mb': max_memory_mb,
+            'yarn_scheduler_maximum_allocation_vcores': max_vcores})
+        session.deploy_client_config()
         if restart:
-            cluster.restart().wait()
+            session.restart()
+
+
+def get_data_mounts():
+    """The instance store mounts (/data0, /data1, ...) of the current node"""
+    # Director formats and mounts each instance store disk as /dataN
+    out = run("df -P | awk '$6 ~ /^\\/data[0-9]+$/ {print $6}'")
+    return sorted(out.split(), key=lambda m: int(m[len('/data'):]))
+
+
+def get_disk_config_group(session, num_disks):
+    name = 'hdfs-DATANODE-{0}d'.format(num_disks)
+    group = session.role_config_group('HDFS', name)
+    if group is None:
+        group = session.create_role_config_group(
+            'HDFS', name, 'DataNode {0} disks'.format(num_disks), 'DATANODE')
+    return group
+
+
+def data_dirs_for(mounts):
+    return ['{0}/dfs/dn'.format(m) for m in mounts]
 
 
+def role_dirs(session, role, name):
+    """An HDFS role's dir list `name`: its own setting, else its group's"""
+    value = config_value(session.role_config(role), name)
+    if value is None:
+        group = session.role_config_group(
+            'HDFS', role.roleConfigGroupRef.roleConfigGroupName)
+        value = config_value(session.role_config_group_config(group), name)
+    return [d for d in (value or '').split(',') if d]
+
+
+def current_data_dirs(session, role):
+    """The data dirs a DataNode uses now"""
+    return role_dirs(session, role, 'dfs_data_dir_list')
+
+
+def hdfs_metadata_dirs(session):
+    """The dirs the NameNode and SecondaryNameNode keep the namespace in"""
+    dirs = []
+    for (role_type, name) in [('NAMENODE', 'dfs_name_dir_list'),
+                              ('SECONDARYNAMENODE', 'fs_checkpoint_dir_list')]:
+        for role in session.roles('HDFS', role_type):
+            dirs.extend(role_dirs(session, role, name))
+    return dirs
+
+
+@traced
+def tune_hdfs(region, stack_name, block_size_mb=256, restart=True):
+    """Set the HDFS block size, short-circuit reads, and DataNode data dirs"""
+    ec2_conn = create_ec2_connection(region)
+    topology = get_topology(ec2_conn, stack_name)
+    public_ips = dict((i.private_ip_address, i.ip_address)
+                      for i in topology.cluster_nodes)
+    with cm_session_ctx(topology.manager) as session:
+        # one data dir per instance store disk, so the DataNode spreads the
+        # blocks over all the spindles
+        datanodes = {}
+        for role in session.roles('HDFS', 'DATANODE'):
+            host = session.host(role.hostRef.hostId)
+            datanodes[public_ips[host.ipAddress]] = role
+        mounts = remote_execute(get_data_mounts, hosts=sorted(datanodes))
+        layouts = {}
+        for (host, host_mounts) in mounts.iteritems():
+            if not host_mounts:
+                raise EggoError('no instance store mounts on {0}'.format(host))
+            layouts.setdefault(tuple(host_mounts), []).append(datanodes[host])
+        # never drop a dir that may already hold blocks
+        for (layout, roles) in layouts.iteritems():
+            for role in roles:
+                dropped = set(current_data_dirs(session, role)) - set(
+                    data_dirs_for(layout))
+                if dropped:
+                    raise EggoError('{0} would lose data dirs {1}'.format(
+                        role.name, ', '.join(sorted(dropped))))
+        for (layout, roles) in sorted(layouts.iteritems()):
+            if len(layouts) == 1:
+                dn_cg = session.base_role_config_group('HDFS', 'DATANODE')
+            else:
+                dn_cg = get_disk_config_group(session, len(layout))
+                role_names = [r.name for r in roles
+                              if r.roleConfigGroupRef.roleConfigGroupName !=
+                              dn_cg.name]
+                if role_names:
+                    session.move_roles(dn_cg, role_names)
+            session.update_role_config_group(
+                dn_cg, {'dfs_data_dir_list': ','.join(data_dirs_for(layout))})
+
+        # large blocks for the Parquet editions: a block holds whole row
+        # groups and a scan task reads long sequential runs off each disk;
+        # the block size reaches the writers through the client config
+        session.update_service_config('HDFS', {
+            'dfs_block_size': block_size_mb * 1024 ** 2,
+            'dfs_datanode_read_shortcircuit': 'true'})
+        session.deploy_client_config()
+        if restart:
+            session.restart()
+
+
+@traced
 def install_env_vars(region, stack_name):
     ec2_conn = create_ec2_connection(region)
+    topology = get_topology(ec2_conn, stack_name)
 
     # get information about the cluster
-    manager_instance = get_manager_instance(ec2_conn, stack_name)
-    with cm_tunnel_ctx(manager_instance) as local_port:
-        env_vars = generate_eggo_env_vars('localhost', local_port, 'admin',
-                                          'admin')
+    with cm_session_ctx(topology.manager) as session:
+        env_vars = generate_eggo_env_vars(session=session)
     env_var_exports = ['export {0}={1}'.format(k, v)
                        for (k, v) in env_vars.iteritems()]
 
@@ -503,44 +944,325 @@ def install_env_vars(region, stack_name):
         append('/home/ec2-user/.bash_profile',
                'source /home/ec2-user/eggo_env_vars.sh')
 
-    master_host = get_master_instance(ec2_conn, stack_name).ip_address
-    execute(do, hosts=[master_host])
-
-
+    remote_execute(do, hosts=[topology.master.ip_address])
+
+
+def install_steps(region, stack_name, master_host, install_choices,
+                  artifact_cache=None, mirror_hosts=None):
+    """The config_cluster steps for a node started from a stock AMI
+
+    `mirror_hosts` is a (launcher host, cluster hosts) tuple to set up the
+    download mirror on, or None to download everything from the nodes.
+    """
+    def on_master(task, **kwargs):
+        return partial(remote_execute, task, hosts=[master_host], **kwargs)
+
+    def probe(command):
+        # true if the step's work is already on the master
+        return lambda: remote_execute(command_succeeds, command,
+                                      hosts=[master_host])[master_host]
+
+    # each step lists what it needs to have finished first; the builds need
+    # git, their build tool, and the JDK
+    # without a mirror, 'mirror' is a no-op the download steps can depend on
+    steps = [Step('mirror', lambda: None)]
+    if mirror_hosts is not None:
+        (launcher_host, cluster_hosts) = mirror_hosts
+        steps = [
+            Step('mirror_server',
+                 partial(remote_execute, install_mirror,
+                         hosts=[launcher_host]),
+                 host=launcher_host),
+            Step('mirror',
+                 partial(remote_execute, configure_node,
+                         hosts=cluster_hosts),
+                 deps=['mirror_server'])]
+    steps += [
+        Step('private_key', on_master(install_private_key), host=master_host,
+             probe=probe('test -f id.pem')),
+        Step('hdfs_home', on_master(create_hdfs_home), host=master_host,
+             probe=probe('hadoop fs -test -d /user/ec2-user')),
+        Step('yarn_memory_limits',
+             partial(adjust_yarn_memory_limits, region, stack_name,
+                     restart=False)),
+        # one CM client config deploy at a time
+        Step('hdfs_tuning',
+             partial(tune_hdfs, region, stack_name, restart=False),
+             deps=['yarn_memory_limits']),
+        # the probes check for what the step installs last
+        Step('dev_tools', on_master(install_dev_tools), deps=['mirror'],
+             host=master_host,
+             probe=probe('rpm -q gcc cmake xz-devel ncurses-devel '
+                         'snappy-devel python-devel && which pip')),
+        # yum holds a global lock, so don't overlap the yum installs: the
+        # dev tools, git, and the JDK (on all nodes, the master included) go
+        # one after the other
+        Step('git', on_master(install_git), deps=['dev_tools'],
+             host=master_host, probe=probe('which git')),
+        # java 8 install will restart the cluster
+        Step('java_8', partial(install_java_8, region, stack_name),
+             deps=['mirror', 'private_key', 'hdfs_home',
+                   'yarn_memory_limits', 'hdfs_tuning', 'git']),
+        Step('maven', on_master(install_maven), deps=['mirror'],
+             host=master_host,
+             probe=probe('grep -q apache-maven-{0}/bin .bash_profile'.format(
+                 MAVEN_VERSION))),
+        Step('gradle', on_master(install_gradle), deps=['mirror'],
+             host=master_host,
+             probe=probe('grep -q gradle-{0}/bin .bash_profile'.format(
+                 GRADLE_VERSION))),
+        Step('parquet_tools', on_master(install_parquet_tools),
+             deps=['mirror'], host=master_host,
+             probe=probe('unzip -tq parquet-tools-{0}.jar'.format(
+                 PARQUET_TOOLS_VERSION))),
+        Step('eggo', on_master(install_eggo), deps=['dev_tools', 'git'],
+             host=master_host),
+        # environment vars for use on the cluster
+        Step('env_vars', partial(install_env_vars, region, stack_name),
+             deps=['java_8'])]
+    build_deps = ['git', 'maven', 'java_8']
+    if install_choices['adam']:
+        steps.append(Step(
+            'adam', on_master(install_adam, fork=install_choices['adam_fork'],
+                              branch=install_choices['adam_branch'],
+                              cache=artifact_cache),
+            deps=build_deps, host=master_host,
+            key='{0}/{1}'.format(install_choices['adam_fork'],
+                                 install_choices['adam_branch'])))
+    if install_choices['opencb']:
+        # each OpenCB project installs into the local Maven repo for the next
+        steps.extend([
+            Step('opencb_ga4gh',
+                 on_master(install_opencb_ga4gh, cache=artifact_cache),
+                 deps=build_deps, host=master_host),
+            Step('opencb_java_common',
+                 on_master(install_opencb_java_common, cache=artifact_cache),
+                 deps=['opencb_ga4gh'], host=master_host),
+            Step('opencb_biodata',
+                 on_master(install_opencb_biodata, cache=artifact_cache),
+                 deps=['opencb_java_common'], host=master_host),
+            Step('opencb_hpg_bigdata',
+                 on_master(install_opencb_hpg_bigdata, cache=artifact_cache),
+                 deps=['opencb_biodata'], host=master_host)])
+    if install_choices['gatk']:
+        steps.append(Step(
+            'gatk', on_master(install_gatk, cache=artifact_cache),
+            deps=['git', 'gradle', 'java_8'], host=master_host))
+    if install_choices['quince']:
+        steps.append(Step(
+            'quince', on_master(install_quince,
+                                fork=install_choices['quince_fork'],
+                                branch=install_choices['quince_branch'],
+                                cache=artifact_cache),
+            deps=build_deps, host=master_host,
+            key='{0}/{1}'.format(install_choices['quince_fork'],
+                                 install_choices['quince_branch'])))
+    return steps
+
+
+def baked_install_steps(region, stack_name, master_host):
+    """The config_cluster steps for a node started from a baked AMI"""
+    # JDK 8 and the tools are already on the nodes; only the cluster specific
+    # steps are left, and the YARN limits and HDFS tuning need a restart to
+    # take effect
+    return [
+        Step('private_key',
+             partial(remote_execute, install_private_key, hosts=[master_host]),
+             host=master_host),
+        Step('hdfs_home',
+             partial(remote_execute, create_hdfs_home, hosts=[master_host]),
+             host=master_host),
+        Step('hdfs_tuning',
+             partial(tune_hdfs, region, stack_name, restart=False)),
+        Step('yarn_memory_limits',
+             partial(adjust_yarn_memory_limits, region, stack_name),
+             deps=['hdfs_home', 'hdfs_tuning']),
+        Step('env_vars', partial(install_env_vars, region, stack_name),
+             deps=['yarn_memory_limits'])]
+
+
+@traced
 def config_cluster(region, stack_name, adam, adam_fork, adam_branch, opencb,
-                   gatk, quince, quince_fork, quince_branch):
+                   gatk, quince, quince_fork, quince_branch,
+                   max_parallel_per_host=4, artifact_cache=None,
+                   artifact_cache_max_bytes=20 * 1024 ** 3, mirror=True,
+                   resume=True):
     start_time = datetime.now()
 
     ec2_conn = create_ec2_connection(region)
-    master_host = get_master_instance(ec2_conn, stack_name).ip_address
-
-    execute(install_private_key, hosts=[master_host])
-    execute(create_hdfs_home, hosts=[master_host])
-    # java 8 install will restart the cluster
-    adjust_yarn_memory_limits(region, stack_name, restart=False)
-    install_java_8(region, stack_name)
-
-    # install software tools
-    execute(install_dev_tools, hosts=[master_host])
-    execute(install_git, hosts=[master_host])
-    execute(install_maven, hosts=[master_host])
-    execute(install_gradle, hosts=[master_host])
-    execute(install_parquet_tools, hosts=[master_host])
-    if adam:
-        execute(install_adam, fork=adam_fork, branch=adam_branch,
-                hosts=[master_host])
-    if opencb:
-        install_opencb([master_host])
-    if gatk:
-        execute(install_gatk, hosts=[master_host])
-    if quince:
-        execute(install_quince, fork=quince_fork, branch=quince_branch,
-                hosts=[master_host])
-    execute(install_eggo, hosts=[master_host])
-
-    # install environment vars for use on the cluster
-    install_env_vars(region, stack_name)
+    topology = get_topology(ec2_conn, stack_name)
+    master_instance = topology.master
+    master_host = master_instance.ip_address
+    install_choices = {
+        'adam': adam, 'adam_fork': adam_fork, 'adam_branch': adam_branch,
+        'opencb': opencb, 'gatk': gatk, 'quince': quince,
+        'quince_fork': quince_fork, 'quince_branch': quince_branch}
+    if is_baked_ami(ec2_conn, master_instance.image_id, install_choices):
+        print "Cluster nodes use a baked AMI; skipping the installs."
+        steps = baked_install_steps(region, stack_name, master_host)
+    else:
+        mirror_hosts = None
+        if mirror:
+            use_mirror(topology.launcher)
+            mirror_hosts = (topology.launcher.ip_address,
+                            [i.ip_address for i in topology.cluster_nodes])
+        steps = install_steps(region, stack_name, master_host,
+                              install_choices, artifact_cache, mirror_hosts)
+
+    # finished steps are recorded on the master, so a rerun resumes
+    checkpoint = HostCheckpoint(master_host)
+    if not resume:
+        checkpoint.clear()
+    durations = run_steps(steps, max_parallel_per_host, checkpoint)
+    if artifact_cache is not None:
+        for key in evict(open_store(artifact_cache),
+                         artifact_cache_max_bytes):
+            print "Evicted {k} from the artifact cache.".format(k=key)
+    (path, path_seconds) = critical_path(steps, durations)
+    print "Critical path ({t} minutes): {p}".format(
+        t=int(path_seconds / 60), p=' -> '.join(path))
 
     end_time = datetime.now()
     print "Cluster configured. Took {t} minutes.".format(
         t=(end_time - start_time).seconds / 60)
+
+
+CM_REPO_URL = ('http://archive.cloudera.com/cm5/redhat/6/x86_64/cm/'
+               'cloudera-manager.repo')
+
+
+@traced
+def launch_workers(ec2_conn, stack_name, count):
+    """Launch EC2 instances configured like the existing workers"""
+    # the standalone Director client can't resize a running cluster, so new
+    # workers are launched directly, using a current worker as the template
+    worker = ec2_conn.get_only_instances(
+        [get_worker_instances(ec2_conn, stack_name)[0].id])[0]
+    # the mapping of a described instance has no sizes, so ask the volume;
+    # aws.conf asks Director for 100 GB
+    root_size = 100
+    if worker.root_device_name in worker.block_device_mapping:
+        volume_id = worker.block_device_mapping[
+            worker.root_device_name].volume_id
+        root_size = ec2_conn.get_all_volumes([volume_id])[0].size
+    mapping = BlockDeviceMapping()
+    mapping[worker.root_device_name] = BlockDeviceType(
+        size=root_size, delete_on_termination=True)
+    for (device, ephemeral_name) in instance_store_devices(
+            worker.instance_type):
+        mapping[device] = BlockDeviceType(ephemeral_name=ephemeral_name)
+    interfaces = NetworkInterfaceCollection(NetworkInterfaceSpecification(
+        subnet_id=worker.subnet_id, groups=[g.id for g in worker.groups],
+        associate_public_ip_address=True))
+    reservation = ec2_conn.run_instances(
+        worker.image_id, min_count=count, max_count=count,
+        key_name=worker.key_name, instance_type=worker.instance_type,
+        network_interfaces=interfaces, block_device_map=mapping)
+    instances = reservation.instances
+    tags = dict((k, v) for (k, v) in worker.tags.iteritems()
+                if not k.startswith('aws:'))
+    # Director doesn't know about these, so teardown terminates them itself
+    tags['eggo_autoscaled'] = 'true'
+    ec2_conn.create_tags([i.id for i in instances], tags)
+    wait_for_instances_state(ec2_conn, instances)
+    invalidate_topology(ec2_conn, stack_name)
+    return instances
+
+
+@traced
+def mount_instance_store(num_disks):
+    """Format and mount the instance store disks as /data0, /data1, ...
+
+    What Director does for the nodes it bootstraps; the disks mapped as
+    /dev/sdb, /dev/sdc, ... show up as /dev/xvdb, /dev/xvdc, ... on RHEL.
+    """
+    for i in xrange(num_disks):
+        device = '/dev/xvd{0}'.format(chr(ord('b') + i))
+        mount = '/data{0}'.format(i)
+        if command_succeeds('mountpoint -q {0}'.format(mount)):
+            continue
+        # some AMIs mount the first disk elsewhere
+        sudo('umount {0} || true'.format(device))
+        sudo('mkfs.ext4 -F -m 0 {0}'.format(device))
+        sudo('mkdir -p {0}'.format(mount))
+        sudo('mount -o noatime {0} {1}'.format(device, mount))
+        append('/etc/fstab', '{0} {1} ext4 defaults,noatime,nofail 0 0'.format(
+            device, mount), use_sudo=True)
+
+
+@traced
+def install_cm_agent(manager_private_ip):
+    # what Director does for the nodes it bootstraps
+    sudo('rm -f /var/lib/cloudera-scm-agent/uuid')
+    sudo('wget {0} -O /etc/yum.repos.d/cloudera-manager.repo'.format(
+        CM_REPO_URL))
+    sudo('yum install -y cloudera-manager-agent cloudera-manager-daemons')
+    sudo('sed -i "s/^server_host=.*/server_host={0}/" '
+         '/etc/cloudera-scm-agent/config.ini'.format(manager_private_ip))
+    sudo('service cloudera-scm-agent restart')
+
+
+@traced
+def install_jdk_8():
+    if not has_jdk_8():
+        download(JDK_RPM_URL, JDK_RPM,
+                 headers=['Cookie: oraclelicense=accept-securebackup-cookie'])
+        sudo('yum install -y {0}'.format(JDK_RPM))
+
+
+@traced
+def grow_workers(region, stack_name, count):
+    """Add `count` workers to the cluster, with the same roles as the others"""
+    ec2_conn = create_ec2_connection(region)
+    topology = get_topology(ec2_conn, stack_name)
+    reference = topology.workers[0]
+    print "Launching {n} worker(s).".format(n=count)
+    instances = launch_workers(ec2_conn, stack_name, count)
+    hosts = [i.ip_address for i in instances]
+    # the DataNode/NodeManager dirs of the reference worker are on these
+    num_disks = len(instance_store_devices(reference.instance_type))
+    if num_disks > 0:
+        remote_execute(mount_instance_store, num_disks, hosts=hosts)
+    remote_execute(install_jdk_8, hosts=hosts)
+    remote_execute(install_cm_agent, topology.manager.private_ip_address,
+                   hosts=hosts)
+    with cm_session_ctx(topology.manager) as session:
+        new_hosts = session.wait_for_hosts(
+            [i.private_ip_address for i in instances])
+        reference_host = [h for h in session.hosts()
+                          if h.ipAddress == reference.private_ip_address][0]
+        print "Assigning worker roles to {h}.".format(
+            h=', '.join(h.hostname for h in new_hosts))
+        session.add_hosts_like(reference_host.hostId,
+                               [h.hostId for h in new_hosts])
+        session.deploy_client_config()
+    return instances
+
+
+@traced
+def shrink_workers(region, stack_name, hostnames):
+    """Gracefully decommission the autoscaled workers with the given hostnames
+
+    Only workers launched by grow_workers can be removed; the ones Director
+    launched are part of the cluster it manages.
+    """
+    ec2_conn = create_ec2_connection(region)
+    topology = get_topology(ec2_conn, stack_name)
+    with cm_session_ctx(topology.manager) as session:
+        hosts = [h for h in session.hosts() if h.hostname in hostnames]
+        ips = set(w.private_ip_address for w in topology.workers
+                  if w.tags.get('eggo_autoscaled'))
+        fixed = [h.hostname for h in hosts if h.ipAddress not in ips]
+        if fixed:
+            raise EggoError('not autoscaled workers: {0}'.format(
+                ', '.join(fixed)))
+        print "Decommissioning {h}.".format(h=', '.join(hostnames))
+        session.decommission_hosts([h.hostname for h in hosts])
+        session.remove_hosts([h.hostId for h in hosts])
+        session.deploy_client_config()
+    ips = set(h.ipAddress for h in hosts)
+    instance_ids = [w.id for w in topology.workers
+                    if w.private_ip_address in ips]
+    ec2_conn.terminate_instances(instance_ids)
+    invalidate_topology(ec2_conn, stack_name)
+    return instance_ids
@@ -0,0 +1,109 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module collects the logs of the cluster nodes for diagnosis: the
+# Director logs on the launcher, the CM server and agent logs, the Hadoop
+# daemon logs, and the YARN container logs.  Each node picks the files (by
+# modification time, and by application for the container logs) and tars them
+# up before the transfer, so only one compressed file per node comes back.
+# collect_node_logs is a Fabric task; collect_logs runs it on all the nodes at
+# once, with the bounded pool of eggo.remote.
+
+
+import os
+import os.path as osp
+
+from fabric.api import sudo, get, env, settings, hide
+
+from eggo.remote import remote_execute
+
+
+CONTAINER_LOG_DIR = '/var/log/hadoop-yarn/container'
+LOG_DIRS = [
+    # Director (launcher)
+    '/home/ec2-user/.cloudera-director/logs',
+    # CM
+    '/var/log/cloudera-scm-server',
+    '/var/log/cloudera-scm-agent',
+    # Hadoop daemons (and the container logs, under hadoop-yarn)
+    '/var/log/hadoop-hdfs',
+    '/var/log/hadoop-yarn',
+    '/var/log/spark']
+
+
+def find_logs_cmd(since=None, until=None, app_id=None):
+    """The shell command that lists the log files to collect"""
+    window = ''
+    if since is not None:
+        window += " -newermt '{0}'".format(since)
+    if until is not None:
+        window += " ! -newermt '{0}'".format(until)
+    # no node has all the dirs, and find fails for any that are missing
+    # (after listing the others)
+    if app_id is None:
+        return '{{ find {0} -type f{1} || true; }} 2>/dev/null'.format(
+            ' '.join(LOG_DIRS), window)
+    # only the containers of the application, but all the daemon logs
+    return ("{{ find {0} -type f -not -path '{1}/*'{2}; "
+            "find {1} -type f -path '*/{3}/*'{2} || true; }} "
+            "2>/dev/null".format(' '.join(LOG_DIRS), CONTAINER_LOG_DIR, window,
+                                 app_id))
+
+
+def collect_node_logs(local_dir, since=None, until=None, app_id=None,
+                      yarn_host=None):
+    """Tar up the current node's logs and fetch them to `local_dir`
+
+    With an `app_id`, the aggregated logs of the application are fetched
+    from HDFS too, on `yarn_host`.  Returns the number of bytes fetched (0 if
+    there were no matching logs).
+    """
+    name = env.host_string.replace(':', '_')
+    archive = '/tmp/eggo-logs-{0}.tar.gz'.format(name)
+    file_list = '/tmp/eggo-logs-{0}.list'.format(name)
+    with settings(hide('stdout')):
+        sudo('{0} > {1}'.format(find_logs_cmd(since, until, app_id),
+                                file_list))
+        if app_id is not None and env.host_string == yarn_host:
+            # aggregated logs of finished containers are only in HDFS
+            aggregated = sudo('yarn logs -applicationId {0} > /tmp/{0}.log '
+                              '2>/dev/null'.format(app_id), user='ec2-user',
+                              warn_only=True)
+            if aggregated.succeeded:
+                sudo('echo /tmp/{0}.log >> {1}'.format(app_id, file_list))
+        num_files = int(sudo('wc -l < {0}'.format(file_list)))
+        if num_files == 0:
+            sudo('rm -f {0}'.format(file_list))
+            return 0
+        # logs being written to may change under tar
+        sudo('tar -czf {0} --ignore-failed-read -T {1} 2>/dev/null || '
+             'test -f {0}'.format(archive, file_list))
+        sudo('chmod 644 {0}'.format(archive))
+    local_path = osp.join(local_dir, '{0}.tar.gz'.format(name))
+    get(archive, local_path)
+    sudo('rm -f {0} {1} /tmp/{2}.log'.format(archive, file_list,
+                                             app_id or 'none'))
+    return os.stat(local_path).st_size
+
+
+def collect_logs(hosts, local_dir, since=None, until=None, app_id=None,
+                 yarn_host=None, pool_size=None):
+    """Collect the logs of all the hosts concurrently; returns {host: bytes}"""
+    if not osp.isdir(local_dir):
+        os.makedirs(local_dir)
+    return remote_execute(collect_node_logs, local_dir, since, until, app_id,
+                          yarn_host, hosts=hosts, pool_size=pool_size)
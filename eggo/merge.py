@@ -0,0 +1,189 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module merges several individually sorted VCF sources (e.g., the
+# per-chromosome 1kg-genotypes files) into one contig-then-position ordered
+# stream.  Sources are read lazily and only the head record of each source is
+# held in memory, so the merge runs in bounded memory without a shuffle.
+# Unsorted sources can be put through an external sort first.
+
+
+import os
+import gzip
+import heapq
+import tempfile
+from subprocess import Popen, PIPE
+
+from eggo.error import EggoError
+
+
+class UnsortedInputError(EggoError):
+    pass
+
+
+# sex chromosomes and mitochondria sort after the autosomes
+_SPECIAL_CONTIGS = {'X': 0, 'Y': 1, 'M': 2, 'MT': 2}
+
+
+def contig_key(contig):
+    name = contig[3:] if contig.lower().startswith('chr') else contig
+    if name.isdigit():
+        return (0, int(name), '')
+    if name.upper() in _SPECIAL_CONTIGS:
+        return (1, _SPECIAL_CONTIGS[name.upper()], '')
+    return (2, 0, name)
+
+
+def vcf_record_key(line):
+    fields = line.split('\t', 2)
+    return (contig_key(fields[0]), int(fields[1]))
+
+
+def _read_hdfs(path):
+    # -text transparently decompresses
+    p = Popen(['hadoop', 'fs', '-text', path], stdout=PIPE)
+    for line in p.stdout:
+        yield line
+    # a failed read would otherwise look like a short source
+    if p.wait() != 0:
+        raise EggoError('hadoop fs -text {0} exited with {1}'.format(
+            path, p.returncode))
+
+
+def open_source(path):
+    """Open a local (optionally gzipped) or HDFS file as a line iterator"""
+    if path.startswith('hdfs://'):
+        return _read_hdfs(path)
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'r')
+
+
+def split_header(lines):
+    """Return (header_lines, record_iterator) for a VCF line iterator"""
+    lines = iter(lines)
+    header = []
+    for line in lines:
+        if not line.startswith('#'):
+            def records(first=line):
+                yield first
+                for rest in lines:
+                    yield rest
+            return (header, records())
+        header.append(line)
+    return (header, iter([]))
+
+
+def check_sorted(records, key, name='<input>'):
+    prev = None
+    for record in records:
+        k = key(record)
+        if prev is not None and k < prev:
+            raise UnsortedInputError(
+                '{0} is not sorted ({1} follows {2})'.format(name, k, prev))
+        prev = k
+        yield record
+
+
+def merge_sorted(iterables, key):
+    """Lazily k-way merge sorted iterables; ties keep the iterable order"""
+    heap = []
+    for (i, iterable) in enumerate(iterables):
+        it = iter(iterable)
+        for record in it:
+            heap.append((key(record), i, record, it))
+            break
+    heapq.heapify(heap)
+    while heap:
+        (_, i, record, it) = heap[0]
+        yield record
+        for nxt in it:
+            heapq.heapreplace(heap, (key(nxt), i, nxt, it))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+def _spill(records, tmp_dir):
+    (fd, path) = tempfile.mkstemp(prefix='tmp_eggo_run_', dir=tmp_dir)
+    with os.fdopen(fd, 'w') as op:
+        op.writelines(records)
+    return path
+
+
+def _read_run(path):
+    with open(path, 'r') as ip:
+        for line in ip:
+            yield line
+
+
+def external_sort(records, key, buffer_bytes=256 * 1024 * 1024,
+                  tmp_dir=None):
+    """Sort an arbitrarily large line iterator with sorted on-disk runs
+
+    At most `buffer_bytes` of records are held in memory while the runs are
+    being written; the runs are then k-way merged lazily.
+    """
+    runs = []
+    try:
+        chunk = []
+        size = 0
+        for record in records:
+            chunk.append(record)
+            size += len(record)
+            if size >= buffer_bytes:
+                chunk.sort(key=key)
+                runs.append(_spill(chunk, tmp_dir))
+                chunk = []
+                size = 0
+        if chunk:
+            chunk.sort(key=key)
+            runs.append(_spill(chunk, tmp_dir))
+            chunk = []
+        for record in merge_sorted([_read_run(r) for r in runs], key):
+            yield record
+    finally:
+        for run in runs:
+            os.remove(run)
+
+
+def merge_vcfs(paths, output, presorted=True, buffer_bytes=256 * 1024 * 1024,
+               tmp_dir=None):
+    """Write the records of several VCFs to `output` in global order
+
+    The header of the first VCF is used; all VCFs must have the same samples.
+    With `presorted`, each source is checked as it streams past and an
+    UnsortedInputError is raised on the first out-of-order record.
+    Otherwise, each source is externally sorted first.
+    """
+    sources = []
+    header = None
+    for path in paths:
+        (source_header, records) = split_header(open_source(path))
+        if header is None:
+            header = source_header
+            output.writelines(header)
+        elif source_header[-1:] != header[-1:]:
+            raise EggoError(
+                '{0} has different samples than {1}'.format(path, paths[0]))
+        if presorted:
+            sources.append(check_sorted(records, vcf_record_key, path))
+        else:
+            sources.append(external_sort(records, vcf_record_key,
+                                         buffer_bytes, tmp_dir))
+    for record in merge_sorted(sources, vcf_record_key):
+        output.write(record)
@@ -0,0 +1,164 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module runs a caching mirror on the launcher instance, so that each
+# package or artifact is downloaded from the internet once per cluster and then
+# served to the nodes over the VPC.  Plain HTTP traffic (the yum repos and
+# Maven Central) goes through a caching squid proxy.  Other artifacts (Oracle,
+# gradle.org, anything over HTTPS) are fetched by the launcher into a dir that
+# it serves over HTTP.  The functions that touch a node are meant to be run
+# with Fabric's execute.
+
+
+from hashlib import md5
+from cStringIO import StringIO
+
+from fabric.api import sudo, run, put, env, settings
+
+from eggo.trace import traced
+from eggo.checkpoint import command_succeeds
+
+
+PROXY_PORT = 3128
+ARTIFACT_PORT = 8080
+ARTIFACT_DIR = '/var/www/eggo-mirror'
+
+SQUID_CONF = """\
+acl localnet src 10.0.0.0/8
+acl localnet src 172.16.0.0/12
+acl localnet src 192.168.0.0/16
+http_access allow localnet
+http_access allow localhost
+http_access deny all
+http_port {port}
+cache_mem 256 MB
+maximum_object_size 2 GB
+cache_dir ufs /var/spool/squid {cache_mb} 16 256
+# packages and release artifacts never change under the same URL
+refresh_pattern -i \\.(rpm|jar|pom|tar\\.gz|tgz|zip)$ 10080 100% 525600 \
+override-expire override-lastmod ignore-reload ignore-no-cache
+refresh_pattern -i (/repodata/|maven-metadata\\.xml) 0 20% 60
+refresh_pattern . 0 20% 4320
+"""
+
+HTTPD_CONF = """\
+Listen {port}
+<VirtualHost *:{port}>
+    DocumentRoot {root}
+    <Directory {root}>
+        Options Indexes
+        Order allow,deny
+        Allow from all
+    </Directory>
+</VirtualHost>
+"""
+
+MAVEN_SETTINGS = """\
+<settings>
+  <proxies>
+    <proxy>
+      <id>eggo-mirror</id>
+      <active>true</active>
+      <protocol>http</protocol>
+      <host>{host}</host>
+      <port>{port}</port>
+    </proxy>
+  </proxies>
+</settings>
+"""
+
+
+@traced
+def install_mirror(cache_gb=40):
+    """Install the caching proxy and the artifact server (on the launcher)"""
+    sudo('yum install -y squid httpd')
+    put(StringIO(SQUID_CONF.format(port=PROXY_PORT,
+                                   cache_mb=cache_gb * 1024)),
+        '/etc/squid/squid.conf', use_sudo=True)
+    sudo('mkdir -p {0}'.format(ARTIFACT_DIR))
+    put(StringIO(HTTPD_CONF.format(port=ARTIFACT_PORT, root=ARTIFACT_DIR)),
+        '/etc/httpd/conf.d/eggo-mirror.conf', use_sudo=True)
+    # only serve the mirror dir
+    sudo('rm -f /etc/httpd/conf.d/welcome.conf')
+    sudo('sed -i "s/^Listen 80$/#Listen 80/" /etc/httpd/conf/httpd.conf')
+    for service in ['squid', 'httpd']:
+        sudo('chkconfig {0} on'.format(service))
+        sudo('service {0} restart'.format(service))
+
+
+def use_mirror(launcher_instance):
+    """Route the downloads of subsequent tasks through the launcher mirror"""
+    # Fabric tasks forked after this (e.g., the config_cluster steps) inherit
+    # the setting
+    env.eggo_mirror = {'public_ip': launcher_instance.ip_address,
+                       'private_ip': launcher_instance.private_ip_address}
+
+
+@traced
+def configure_node():
+    """Point yum and Maven on the current node at the launcher proxy"""
+    proxy = 'http://{0}:{1}'.format(env.eggo_mirror['private_ip'], PROXY_PORT)
+    sudo('grep -q "^proxy=" /etc/yum.conf || '
+         'echo "proxy={0}" >> /etc/yum.conf'.format(proxy))
+    # the repo files are left alone: the RHEL (RHUI) repos only have a
+    # mirrorlist, so the nodes share the cache only when they pick the same
+    # mirror
+    run('mkdir -p .m2')
+    put(StringIO(MAVEN_SETTINGS.format(host=env.eggo_mirror['private_ip'],
+                                       port=PROXY_PORT)),
+        '.m2/settings.xml')
+
+
+@traced
+def unconfigure_node():
+    """Undo configure_node; returns whether the node was configured"""
+    configured = command_succeeds('grep -q "^proxy=" /etc/yum.conf')
+    sudo('sed -i "/^proxy=/d" /etc/yum.conf')
+    run('rm -f .m2/settings.xml')
+    return configured
+
+
+def artifact_path(url, filename):
+    return '{0}/{1}'.format(md5(url).hexdigest()[:16], filename)
+
+
+@traced
+def download(url, filename=None, headers=()):
+    """Download `url` to `filename` on the current node, via the mirror
+
+    Without a mirror, the node downloads the URL itself.  With a mirror, the
+    launcher downloads it (only once, even with concurrent requests) and the
+    node gets it from the launcher.
+    """
+    if filename is None:
+        filename = url.rsplit('/', 1)[-1]
+    header_args = ' '.join('--header "{0}"'.format(h) for h in headers)
+    mirror = env.get('eggo_mirror')
+    if mirror is None:
+        run("wget -O {0} {1} '{2}'".format(filename, header_args, url))
+        return
+    path = artifact_path(url, filename)
+    target = '{0}/{1}'.format(ARTIFACT_DIR, path)
+    with settings(host_string=mirror['public_ip']):
+        sudo('mkdir -p $(dirname {0})'.format(target))
+        # the lock makes concurrent requests for the same URL wait for the
+        # first download instead of starting their own
+        sudo('flock {t}.lock sh -c "test -f {t} || '
+             '(wget -O {t}.part {h} \'{u}\' && mv {t}.part {t})"'.format(
+                 t=target, h=header_args.replace('"', '\\"'), u=url))
+    run('curl -sSf -o {0} http://{1}:{2}/{3}'.format(
+        filename, mirror['private_ip'], ARTIFACT_PORT, path))
@@ -17,14 +17,21 @@
 import os
 import re
 import json
+import math
+import time
 from getpass import getuser
 from os.path import join as pjoin
 from subprocess import check_call
+from multiprocessing.pool import ThreadPool
 
-from cm_api.api_client import ApiResource
-
-from eggo.util import make_local_tmp, make_hdfs_tmp
+from eggo.cm import CMSession, config_value
+from eggo.error import EggoError
+from eggo.util import make_local_tmp, make_hdfs_tmp, SCRATCH_HDFS_OPTS
 from eggo.compat import check_output
+from eggo.catalog import normalize_resource
+from eggo.stats import EditionStats, SIDECAR_NAME
+from eggo.planner import plan, spark_args, PROFILES, DEFAULT_PROFILE
+from eggo.trace import traced
 
 
 # This module includes operations to be performed on an actual Hadoop cluster
@@ -34,9 +41,40 @@ from eggo.compat import check_output
 
 STREAMING_JAR = ('/opt/cloudera/parcels/CDH-*/lib/hadoop-mapreduce/'
                  'hadoop-streaming.jar')
+ADAM_SUBMIT = '~/adam/bin/adam-submit'
+
+# the Parquet versions shipped with CDH5/ADAM predate zstd support, and LZO
+# needs the GPL Extras parcel, which the clusters don't install
+PARQUET_CODECS = ['uncompressed', 'snappy', 'gzip']
+
+
+def get_parquet_codec(datapackage):
+    """Return the Parquet codec set in a datapackage (None if unset)"""
+    codec = datapackage.get('codec')
+    if codec is None:
+        return None
+    codec = codec.lower()
+    if codec not in PARQUET_CODECS:
+        raise EggoError('unsupported Parquet codec "{0}"; choose from {1}'
+                        .format(codec, ', '.join(PARQUET_CODECS)))
+    return codec
+
+
+def adam_codec_args(codec):
+    if codec is None:
+        return ''
+    return '-parquet_compression_codec {0}'.format(codec.upper())
 
 
+def hive_codec_args(codec):
+    if codec is None:
+        return ''
+    return '--hiveconf parquet.compression={0}'.format(codec.upper())
+
+
+@traced
 def download_dataset_with_hadoop(datapackage, hdfs_path):
+    """Download the raw data; returns the EditionStats of the source files"""
     with make_local_tmp() as tmp_local_dir:
         with make_hdfs_tmp(permissions='777') as tmp_hdfs_dir:
             # NOTE: 777 used so user yarn can write to this dir
@@ -44,37 +82,52 @@ def download_dataset_with_hadoop(datapackage, hdfs_path):
             # them in HDFS
             local_resource_file = pjoin(tmp_local_dir, 'resource_file.txt')
             with open(local_resource_file, 'w') as op:
-                for resource in datapackage['resources']:
+                resources = datapackage.get('resources',
+                                            datapackage.get('sources', []))
+                for resource in map(normalize_resource, resources):
                     op.write('{0}\n'.format(json.dumps(resource)))
-            check_call('hadoop fs -put {0} {1}'.format(local_resource_file,
-                                                       tmp_hdfs_dir),
-                       shell=True)
+            check_call('hadoop fs {0} -put {1} {2}'.format(
+                SCRATCH_HDFS_OPTS, local_resource_file, tmp_hdfs_dir),
+                shell=True)
 
             # construct and execute hadoop streaming command to initiate dnload
+            # the job output (the stats) is scratch; the staged data is not,
+            # as it is moved to the final path, and the mappers write it with
+            # the cluster's replication
             cmd = ('hadoop jar {streaming_jar} '
+                   '{scratch_opts} '
                    '-D mapreduce.job.reduces=0 '
                    '-D mapreduce.map.speculative=false '
                    '-D mapreduce.task.timeout=12000000 '
-                   '-files {mapper_script_path} '
-                   '-input {resource_file} -output {dummy_output} '
+                   '-files {mapper_script_path},{stats_module_path} '
+                   '-input {resource_file} -output {stats_output} '
                    '-mapper {mapper_script_name} '
-                   '-inputformat {input_format} -outputformat {output_format} '
+                   '-inputformat {input_format} '
                    '-cmdenv STAGING_PATH={staging_path} ')
             args = {'streaming_jar': STREAMING_JAR,
+                    'scratch_opts': SCRATCH_HDFS_OPTS,
                     'resource_file': pjoin(tmp_hdfs_dir, 'resource_file.txt'),
-                    'dummy_output': pjoin(tmp_hdfs_dir, 'dummy_output'),
+                    'stats_output': pjoin(tmp_hdfs_dir, 'stats_output'),
                     'mapper_script_name': 'download_mapper.py',
                     'mapper_script_path': pjoin(
                         os.path.dirname(__file__), 'resources',
                         'download_mapper.py'),
+                    'stats_module_path': pjoin(
+                        os.path.dirname(__file__), 'stats.py'),
                     'input_format': (
                         'org.apache.hadoop.mapred.lib.NLineInputFormat'),
-                    'output_format': (
-                        'org.apache.hadoop.mapred.lib.NullOutputFormat'),
                     'staging_path': pjoin(tmp_hdfs_dir, 'staging')}
             print(cmd.format(**args))
             check_call(cmd.format(**args), shell=True)
 
+            # each map task emits the statistics for the file it downloaded
+            stats = EditionStats()
+            raw = check_output('hadoop fs -cat "{0}/part-*"'.format(
+                args['stats_output']), shell=True)
+            for line in raw.splitlines():
+                (_, file_stats) = line.split('\t', 1)
+                stats.merge(EditionStats.from_dict(json.loads(file_stats)))
+
             # move dnloaded data to final path
             check_call('hadoop fs -mkdir -p {0}'.format(hdfs_path), shell=True)
             check_call(
@@ -83,6 +136,198 @@ def download_dataset_with_hadoop(datapackage, hdfs_path):
             check_call(
                 'hadoop fs -mv "{0}/*" {1}'.format(
                     pjoin(tmp_hdfs_dir, 'staging'), hdfs_path), shell=True)
+            write_hdfs_json(stats.to_dict(), pjoin(hdfs_path, SIDECAR_NAME))
+            return stats
+
+
+def read_hdfs_json(path):
+    return json.loads(check_output('hadoop fs -cat {0}'.format(path),
+                                   shell=True))
+
+
+def write_hdfs_json(obj, path):
+    with make_local_tmp() as tmp_local_dir:
+        local_path = pjoin(tmp_local_dir, os.path.basename(path))
+        with open(local_path, 'w') as op:
+            json.dump(obj, op, indent=2, sort_keys=True)
+        check_call('hadoop fs -put -f {0} {1}'.format(local_path, path),
+                   shell=True)
+
+
+def get_partition_sizes(hdfs_path, partition_depth=0):
+    """Return [(path, num_files, num_bytes)] for each partition dir
+
+    Only the NameNode metadata is consulted (`hadoop fs -count`); the data
+    itself is not read.  A `partition_depth` of 0 treats the whole path as a
+    single partition, 2 is the chr=/pos= locus partitioning.
+    """
+    glob = '/'.join([hdfs_path.rstrip('/')] + ['*'] * partition_depth)
+    raw = check_output('hadoop fs -count "{0}"'.format(glob), shell=True)
+    partitions = []
+    for line in raw.splitlines():
+        fields = line.split()
+        if len(fields) != 4:
+            continue
+        (_, num_files, num_bytes, path) = fields
+        if os.path.basename(path).startswith(('_', '.')):
+            continue
+        partitions.append((path, int(num_files), int(num_bytes)))
+    return partitions
+
+
+@traced
+def compute_edition_stats(source_path, edition_path, partition_depth=0):
+    """Write the stats sidecar for an edition; returns the EditionStats
+
+    Row/contig counts come from the sidecar written while downloading the
+    source files, and partition sizes from the NameNode.
+    """
+    stats = EditionStats.from_dict(
+        read_hdfs_json(pjoin(source_path, SIDECAR_NAME)))
+    for (_, num_files, num_bytes) in get_partition_sizes(edition_path,
+                                                         partition_depth):
+        stats.add_partition(num_files, num_bytes)
+    write_hdfs_json(stats.to_dict(), pjoin(edition_path, SIDECAR_NAME))
+    return stats
+
+
+def parse_partition_spec(path):
+    """Return [(key, value)] for the Hive partition dirs in a path"""
+    return [tuple(part.split('=', 1)) for part in path.split('/')
+            if '=' in part]
+
+
+def plan_compaction(partitions, target_size, threshold):
+    """Choose the partitions worth compacting
+
+    `partitions` is a list of (path, num_files, num_bytes) as returned by
+    get_partition_sizes.  Only partitions whose average file size is below
+    `threshold` and that would end up with fewer files are rewritten.  Returns
+    a list of (path, num_output_files).
+    """
+    plan = []
+    for (path, num_files, num_bytes) in partitions:
+        if num_files == 0:
+            continue
+        num_output_files = max(
+            1, int(math.ceil(float(num_bytes) / target_size)))
+        if (num_bytes / num_files < threshold and
+                num_output_files < num_files):
+            plan.append((path, num_output_files))
+    return plan
+
+
+def get_hive_columns(table):
+    raw = check_output(['hive', '-S', '-e',
+                        'SHOW COLUMNS IN {0}'.format(table)])
+    return [c.strip() for c in raw.splitlines() if c.strip()]
+
+
+def compact_partition(table, columns, path, num_output_files,
+                      segment_size=1000000, codec=None):
+    # rewrite the partition in place; each reducer gets a contiguous range of
+    # start positions, so the files stay sorted by start both within and
+    # across files
+    spec = parse_partition_spec(path)
+    partition_cols = set(k for (k, _) in spec)
+    select_cols = ', '.join('`{0}`'.format(c) for c in columns
+                            if c not in partition_cols)
+    (_, pos) = spec[-1]
+    stride = int(math.ceil(float(segment_size) / num_output_files))
+    query = ('INSERT OVERWRITE TABLE {table} PARTITION ({partition}) '
+             'SELECT {cols} FROM {table} WHERE {where} '
+             'DISTRIBUTE BY floor((`start` - {pos}) / {stride}) '
+             'SORT BY `start`').format(
+                 table=table, cols=select_cols,
+                 partition=', '.join("{0}='{1}'".format(k, v)
+                                     for (k, v) in spec),
+                 where=' AND '.join("{0}='{1}'".format(k, v)
+                                    for (k, v) in spec),
+                 pos=pos, stride=stride)
+    # no shell, as the query is full of quotes and backticks
+    check_call(['hive', '--hiveconf',
+                'mapreduce.job.reduces={0}'.format(num_output_files)] +
+               hive_codec_args(codec).split() + ['-e', query])
+
+
+@traced
+def compact_partitions(table, hdfs_path, target_size=256 * 1024 * 1024,
+                       threshold=64 * 1024 * 1024, parallelism=8,
+                       segment_size=1000000, codec=None):
+    """Merge the small files in each chr=/pos= partition of a Hive table
+
+    Returns the list of (path, num_output_files) that were rewritten.
+    """
+    partitions = get_partition_sizes(hdfs_path, partition_depth=2)
+    plan = plan_compaction(partitions, target_size, threshold)
+    print('Compacting {0} of {1} partitions'.format(len(plan),
+                                                    len(partitions)))
+    if len(plan) == 0:
+        return plan
+    columns = get_hive_columns(table)
+
+    def compact(item):
+        (path, num_output_files) = item
+        compact_partition(table, columns, path, num_output_files,
+                          segment_size, codec)
+
+    pool = ThreadPool(parallelism)
+    try:
+        pool.map(compact, plan)
+    finally:
+        pool.close()
+        pool.join()
+    return plan
+
+
+def get_hdfs_size(path):
+    raw = check_output('hadoop fs -du -s {0}'.format(path), shell=True)
+    return int(raw.split()[0])
+
+
+def scan_parquet(path):
+    # decode every record of every file, which is what a scan pays for
+    raw = check_output('hadoop fs -ls {0}'.format(path), shell=True)
+    files = [line.split()[-1] for line in raw.splitlines()
+             if line.endswith('.parquet')]
+    for f in files:
+        check_call('hadoop jar parquet-tools-*.jar cat {0} > /dev/null'
+                   .format(f), shell=True)
+
+
+@traced
+def benchmark_codecs(sample_path, codecs=PARQUET_CODECS, adam_args=''):
+    """Convert a raw VCF sample with each codec; returns a list of dicts
+
+    Throughputs are in terms of the uncompressed Parquet size, so the codecs
+    are compared on the same logical amount of data.
+    """
+    codecs = ['uncompressed'] + [c for c in codecs if c != 'uncompressed']
+    results = []
+    with make_hdfs_tmp('tmp_eggo_codecs') as tmp_hdfs_dir:
+        for codec in codecs:
+            output = pjoin(tmp_hdfs_dir, codec)
+            start = time.time()
+            check_call('{adam} {adam_args} -- vcf2adam -onlyvariants '
+                       '{codec_args} {input} {output}'.format(
+                           adam=ADAM_SUBMIT, adam_args=adam_args,
+                           codec_args=adam_codec_args(codec),
+                           input=sample_path, output=output), shell=True)
+            write_secs = time.time() - start
+            start = time.time()
+            scan_parquet(output)
+            read_secs = time.time() - start
+            results.append({'codec': codec, 'bytes': get_hdfs_size(output),
+                            'write_secs': write_secs,
+                            'read_secs': read_secs})
+    logical_bytes = float(results[0]['bytes'])
+    for result in results:
+        result['ratio'] = logical_bytes / result['bytes']
+        result['write_mb_per_sec'] = (
+            logical_bytes / 1024 / 1024 / result['write_secs'])
+        result['read_mb_per_sec'] = (
+            logical_bytes / 1024 / 1024 / result['read_secs'])
+    return results
 
 
 def get_parquet_avro_schema(path):
@@ -96,42 +341,78 @@ def get_parquet_avro_schema(path):
     return schema
 
 
-def get_cluster_info(manager_host, server_port=7180, username='admin',
-                     password='admin'):
-    cm_api = ApiResource(manager_host, username=username, password=password,
-                         server_port=server_port, version=9)
-    host = list(cm_api.get_all_hosts())[0]  # all hosts same instance type
-    cluster = list(cm_api.get_all_clusters())[0]
-    yarn = filter(lambda x: x.type == 'YARN',
-                  list(cluster.get_all_services()))[0]
-    hive = filter(lambda x: x.type == 'HIVE',
-                  list(cluster.get_all_services()))[0]
-    impala = filter(lambda x: x.type == 'IMPALA',
-                    list(cluster.get_all_services()))[0]
-    hive_hs2 = hive.get_roles_by_type('HIVESERVER2')[0]
-    hive_host = cm_api.get_host(hive_hs2.hostRef.hostId).hostname
+@traced
+def get_worker_facts(session):
+    """Return the shape and NodeManager limits of each worker, in one pass"""
+    group_configs = dict(
+        (g.name, session.role_config_group_config(g))
+        for g in session.role_config_groups('YARN', 'NODEMANAGER'))
+    workers = []
+    for role in session.roles('YARN', 'NODEMANAGER'):
+        host = session.host(role.hostRef.hostId)
+        config = group_configs[role.roleConfigGroupRef.roleConfigGroupName]
+        workers.append({
+            'hostname': host.hostname, 'role': role.name,
+            'group': role.roleConfigGroupRef.roleConfigGroupName,
+            'cores': host.numCores, 'memory': host.totalPhysMemBytes,
+            'nm_memory_mb': _int_or_none(config_value(
+                config, 'yarn_nodemanager_resource_memory_mb')),
+            'nm_vcores': _int_or_none(config_value(
+                config, 'yarn_nodemanager_resource_cpu_vcores'))})
+    return workers
+
+
+@traced
+def get_cluster_info(manager_host=None, server_port=7180, username='admin',
+                     password='admin', session=None):
+    if session is None:
+        session = CMSession(manager_host, server_port, username, password)
+    workers = get_worker_facts(session)
+    # the node_* facts describe the smallest worker
+    smallest = min(workers, key=lambda w: (w['memory'], w['cores']))
+    hive_hs2 = session.roles('HIVE', 'HIVESERVER2')[0]
+    hive_host = session.host(hive_hs2.hostRef.hostId).hostname
     hive_port = int(
-        hive_hs2.get_config('full')['hs2_thrift_address_port'].default)
-    impala_hs2 = impala.get_roles_by_type('IMPALAD')[0]
-    impala_host = cm_api.get_host(impala_hs2.hostRef.hostId).hostname
-    impala_port = int(impala_hs2.get_config('full')['hs2_port'].default)
-    return {'num_worker_nodes': len(yarn.get_roles_by_type('NODEMANAGER')),
-            'node_cores': host.numCores, 'node_memory': host.totalPhysMemBytes,
+        session.role_config(hive_hs2)['hs2_thrift_address_port'].default)
+    impala_hs2 = session.roles('IMPALA', 'IMPALAD')[0]
+    impala_host = session.host(impala_hs2.hostRef.hostId).hostname
+    impala_port = int(session.role_config(impala_hs2)['hs2_port'].default)
+    rm_config = session.role_config_group_config(
+        session.base_role_config_group('YARN', 'RESOURCEMANAGER'))
+    return {'num_worker_nodes': len(workers),
+            'node_cores': smallest['cores'],
+            'node_memory': smallest['memory'],
+            'workers': workers,
+            'yarn_min_allocation_mb': _int_or_none(config_value(
+                rm_config, 'yarn_scheduler_minimum_allocation_mb')),
+            'yarn_max_allocation_mb': _int_or_none(config_value(
+                rm_config, 'yarn_scheduler_maximum_allocation_mb')),
             'hive_host': hive_host, 'hive_port': hive_port,
             'impala_host': impala_host, 'impala_port': impala_port}
 
 
-def generate_eggo_env_vars(cm_host, cm_port=7180, username='admin',
-                           password='admin'):
-    info = get_cluster_info(cm_host, cm_port, username, password)
-    cores_per_executor = min(4, info['node_cores'])
-    executors_per_node = info['node_cores'] / cores_per_executor
-    total_executors = executors_per_node * info['num_worker_nodes']
-    memory_per_executor = int(0.8 * info['node_memory'] / executors_per_node)
-    return {'NUM_WORKER_NODES': str(info['num_worker_nodes']),
-            'NODE_CORES': str(info['node_cores']),
-            'NODE_MEMORY': str(info['node_memory']),
-            'CORES_PER_EXECUTOR': str(cores_per_executor),
-            'EXECUTORS_PER_NODE': str(executors_per_node),
-            'TOTAL_EXECUTORS': str(total_executors),
-            'MEMORY_PER_EXECUTOR': str(memory_per_executor)}
+def _int_or_none(value):
+    return int(value) if value is not None else None
+
+
+@traced
+def generate_eggo_env_vars(cm_host=None, cm_port=7180, username='admin',
+                           password='admin', session=None):
+    info = get_cluster_info(cm_host, cm_port, username, password, session)
+    default = plan(info, DEFAULT_PROFILE)
+    env_vars = {
+        'NUM_WORKER_NODES': str(info['num_worker_nodes']),
+        'NODE_CORES': str(info['node_cores']),
+        'NODE_MEMORY': str(info['node_memory']),
+        'CORES_PER_EXECUTOR': str(default['executor_cores']),
+        'EXECUTORS_PER_NODE': str(
+            default['num_executors'] // max(1, info['num_worker_nodes'])),
+        'TOTAL_EXECUTORS': str(default['num_executors']),
+        'MEMORY_PER_EXECUTOR': '{0}m'.format(default['executor_memory_mb']),
+        'MEMORY_OVERHEAD': str(default['memory_overhead_mb']),
+        'DRIVER_MEMORY': '{0}m'.format(default['driver_memory_mb'])}
+    # e.g., $VCF2ADAM_SPARK_ARGS for the adam-submit/spark-submit options
+    for profile in PROFILES:
+        env_vars['{0}_SPARK_ARGS'.format(profile.upper())] = (
+            '"{0}"'.format(spark_args(plan(info, profile))))
+    return env_vars
@@ -0,0 +1,169 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module sizes Spark-on-YARN executors for the eggo workloads.  It takes
+# cluster facts (as returned by operations.get_cluster_info, so they can be
+# recorded as JSON and replayed) and a workload profile, and fits executors
+# into what the NodeManagers actually offer: the OS/daemon reserve, the YARN
+# container limits and allocation increments, the executor memoryOverhead, and
+# the ApplicationMaster container are all accounted for.  Only uses the
+# standard library.
+
+
+from eggo.error import EggoError
+
+
+# per-executor shape for each workload
+PROFILES = {
+    # VCF parsing is CPU-bound and keeps little in memory
+    'vcf2adam': {'cores': 5, 'memory_per_core_mb': 2048,
+                 'overhead_fraction': 0.10, 'driver_memory_mb': 4096},
+    # flatten is a map-only pass over Parquet
+    'flatten': {'cores': 4, 'memory_per_core_mb': 1536,
+                'overhead_fraction': 0.10, 'driver_memory_mb': 4096},
+    # transform (sort, markdup, BQSR) shuffles and caches
+    'transform': {'cores': 4, 'memory_per_core_mb': 4096,
+                  'overhead_fraction': 0.15, 'driver_memory_mb': 8192}}
+
+DEFAULT_PROFILE = 'transform'
+
+MIN_OVERHEAD_MB = 384
+# yarn-client mode ApplicationMaster (512 MB + overhead, rounded up)
+AM_CONTAINER_MB = 1024
+MB = 1024 * 1024
+
+
+def os_reserve_mb(node_memory_mb):
+    """Memory to leave to the OS, page cache, DataNode and NodeManager"""
+    return max(2048, int(0.1 * node_memory_mb)) + 2048
+
+
+def node_capacity(node):
+    """Return the (memory MB, vcores) that YARN will give out on a node
+
+    `node` has the node's physical 'memory' (bytes) and 'cores', and
+    optionally the NodeManager limits 'nm_memory_mb' and 'nm_vcores'.
+    """
+    physical_mb = node['memory'] // MB
+    memory_mb = physical_mb - os_reserve_mb(physical_mb)
+    if node.get('nm_memory_mb'):
+        memory_mb = min(memory_mb, node['nm_memory_mb'])
+    vcores = node['cores']
+    if node.get('nm_vcores'):
+        vcores = min(vcores, node['nm_vcores'])
+    return (memory_mb, vcores)
+
+
+def round_down(value, increment):
+    return value // increment * increment
+
+
+def plan_node(memory_mb, vcores, profile, min_allocation_mb=1024,
+              max_allocation_mb=None):
+    """Return (executors, cores, container MB) for a single node"""
+    cores = min(profile['cores'], vcores)
+    wanted_heap = profile['memory_per_core_mb'] * cores
+    wanted_mb = int(wanted_heap * (1 + profile['overhead_fraction']))
+    if max_allocation_mb is not None:
+        wanted_mb = min(wanted_mb, max_allocation_mb)
+    if cores == 0 or memory_mb < min_allocation_mb:
+        return (0, cores, 0)
+    # bounded by both cores and memory; any spare memory goes to the
+    # executors rather than sitting idle
+    executors = max(1, min(vcores // cores, memory_mb // wanted_mb))
+    container_mb = memory_mb // executors
+    if max_allocation_mb is not None:
+        container_mb = min(container_mb, max_allocation_mb)
+    # YARN rounds requests up to the allocation increment
+    container_mb = round_down(container_mb, min_allocation_mb)
+    return (executors, cores, container_mb)
+
+
+def split_container(container_mb, overhead_fraction):
+    """Split a container into (executor heap MB, memoryOverhead MB)"""
+    heap_mb = int(container_mb / (1 + overhead_fraction))
+    overhead_mb = max(MIN_OVERHEAD_MB, container_mb - heap_mb)
+    return (container_mb - overhead_mb, overhead_mb)
+
+
+def _plan(capacities, profile, min_allocation_mb, max_allocation_mb,
+          am_reserve_mb):
+    # executors are sized for the smallest worker, so they fit everywhere
+    smallest = min(c[0] for c in capacities) - am_reserve_mb
+    (_, cores, container_mb) = plan_node(
+        smallest, min(c[1] for c in capacities), profile, min_allocation_mb,
+        max_allocation_mb)
+    if container_mb == 0:
+        return (0, cores, 0)
+    total = 0
+    am_fits = False
+    for (memory_mb, vcores) in capacities:
+        n = min(vcores // cores, memory_mb // container_mb)
+        total += n
+        if memory_mb - n * container_mb >= AM_CONTAINER_MB:
+            am_fits = True
+    if not am_fits:
+        # the ApplicationMaster takes one executor's place
+        total -= 1
+    return (total, cores, container_mb)
+
+
+def plan(facts, profile_name=DEFAULT_PROFILE):
+    """Plan the Spark executors for a workload on a cluster
+
+    `facts` has 'workers' (list of nodes as for node_capacity), optionally
+    'yarn_min_allocation_mb' and 'yarn_max_allocation_mb'.
+    """
+    if profile_name not in PROFILES:
+        raise EggoError('unknown workload profile "{0}"; use one of '
+                        '{1}'.format(profile_name,
+                                     ', '.join(sorted(PROFILES))))
+    profile = PROFILES[profile_name]
+    workers = facts['workers']
+    if len(workers) == 0:
+        raise EggoError('the cluster has no worker nodes')
+    min_allocation_mb = facts.get('yarn_min_allocation_mb') or 1024
+    max_allocation_mb = facts.get('yarn_max_allocation_mb')
+    capacities = [node_capacity(n) for n in workers]
+    # either give up an executor to the ApplicationMaster, or make every
+    # executor a bit smaller so the AM fits next to them; take whichever
+    # leaves more executor memory
+    candidates = [
+        _plan(capacities, profile, min_allocation_mb, max_allocation_mb,
+              am_reserve) for am_reserve in [0, AM_CONTAINER_MB]]
+    (total, cores, container_mb) = max(candidates,
+                                       key=lambda c: (c[0] * c[2], c[0]))
+    if total <= 0 or container_mb == 0:
+        raise EggoError('worker nodes are too small for any executor')
+    (heap_mb, overhead_mb) = split_container(container_mb,
+                                             profile['overhead_fraction'])
+    return {'profile': profile_name,
+            'num_executors': total,
+            'executor_cores': cores,
+            'executor_memory_mb': heap_mb,
+            'memory_overhead_mb': overhead_mb,
+            'container_mb': container_mb,
+            'driver_memory_mb': profile['driver_memory_mb']}
+
+
+def spark_args(p):
+    return ('--num-executors {0} --executor-cores {1} --executor-memory {2}m '
+            '--driver-memory {3}m '
+            '--conf spark.yarn.executor.memoryOverhead={4}'.format(
+                p['num_executors'], p['executor_cores'],
+                p['executor_memory_mb'], p['driver_memory_mb'],
+                p['memory_overhead_mb']))
@@ -0,0 +1,138 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module runs Fabric tasks on a set of hosts.  Hosts are worked on
+# concurrently (in forked processes, like Fabric's @parallel) with a bounded
+# pool, each host gets a timeout and a number of retries, and a failure on one
+# host doesn't stop the others: the per-host outcomes and timings are gathered
+# and printed as a table, and then any failure is raised.  remote_execute
+# takes the same arguments as Fabric's execute, and returns the same
+# {host: return value}.
+
+
+import time
+import signal
+from functools import wraps
+
+from fabric.api import execute, parallel, settings, env
+
+from eggo.error import EggoError
+
+
+# defaults for all the calls, e.g. from the command line
+DEFAULTS = {'pool_size': 16, 'timeout': None, 'retries': 0}
+
+
+class RemoteTaskFailed(EggoError):
+
+    def __init__(self, task_name, results):
+        failed = sorted(h for (h, r) in results.iteritems() if not r['ok'])
+        EggoError.__init__(self, '{0} failed on {1}: {2}'.format(
+            task_name, ', '.join(failed), results[failed[0]]['error']))
+        self.results = results
+
+
+class TaskTimeout(EggoError):
+    pass
+
+
+class _Abort(Exception):
+    # what Fabric's abort() raises inside a task, instead of exiting
+    pass
+
+
+def configure(pool_size=None, timeout=None, retries=None):
+    for (key, value) in [('pool_size', pool_size), ('timeout', timeout),
+                         ('retries', retries)]:
+        if value is not None:
+            DEFAULTS[key] = value
+
+
+def _on_alarm(signum, frame):
+    raise TaskTimeout('timed out on {0}'.format(env.host_string))
+
+
+def _attempt(task, timeout, args, kwargs):
+    if timeout is not None:
+        previous = signal.signal(signal.SIGALRM, _on_alarm)
+        signal.alarm(int(timeout))
+    try:
+        with settings(abort_exception=_Abort):
+            return task(*args, **kwargs)
+    finally:
+        if timeout is not None:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, previous)
+
+
+def _with_retries(task, timeout, retries):
+    @wraps(task)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        for attempt in xrange(1, retries + 2):
+            try:
+                value = _attempt(task, timeout, args, kwargs)
+                return {'ok': True, 'value': value, 'error': None,
+                        'attempts': attempt, 'seconds': time.time() - start}
+            except Exception as e:
+                error = '{0}: {1}'.format(type(e).__name__, e)
+                if attempt <= retries:
+                    print('[{0}] {1} failed ({2}); retrying'.format(
+                        env.host_string, task.__name__, error))
+        return {'ok': False, 'value': None, 'error': error,
+                'attempts': attempt, 'seconds': time.time() - start}
+    return wrapper
+
+
+def print_results(task_name, results):
+    ts = '{0:<17}{1:<8}{2:>9}{3:>10}  {4}'
+    print('{0} on {1} host(s):'.format(task_name, len(results)))
+    print(ts.format('host', 'outcome', 'attempts', 'seconds', 'error'))
+    for host in sorted(results, key=lambda h: -results[h]['seconds']):
+        r = results[host]
+        print(ts.format(host, 'ok' if r['ok'] else 'FAILED', r['attempts'],
+                        '{0:.1f}'.format(r['seconds']),
+                        r['error'] or '').rstrip())
+
+
+def remote_execute(task, *args, **kwargs):
+    """Run a task on the `hosts`; returns {host: return value}
+
+    Takes `pool_size`, `timeout` (seconds per host and attempt), and
+    `retries` on top of the arguments of Fabric's execute; they default to
+    DEFAULTS (see configure).  Raises RemoteTaskFailed if the task failed on
+    any host.
+    """
+    hosts = kwargs.pop('hosts')
+    (pool_size, timeout, retries) = [
+        kwargs.pop(k, None) for k in ['pool_size', 'timeout', 'retries']]
+    if pool_size is None:
+        pool_size = DEFAULTS['pool_size']
+    if timeout is None:
+        timeout = DEFAULTS['timeout']
+    if retries is None:
+        retries = DEFAULTS['retries']
+    wrapper = _with_retries(task, timeout, retries)
+    if len(hosts) > 1 and pool_size > 1:
+        wrapper = parallel(pool_size=pool_size)(wrapper)
+    results = execute(wrapper, *args, hosts=hosts, **kwargs)
+    failed = [h for (h, r) in results.iteritems() if not r['ok']]
+    if len(hosts) > 1 or failed:
+        print_results(task.__name__, results)
+    if failed:
+        raise RemoteTaskFailed(task.__name__, results)
+    return dict((h, r['value']) for (h, r) in results.iteritems())
@@ -21,10 +21,16 @@ import re
 import os
 import sys
 import json
-from subprocess import check_call
+import shutil
+from subprocess import check_call, Popen, PIPE, CalledProcessError
+from tempfile import mkdtemp
 from os.path import join as pjoin
 from hashlib import md5
 
+# stats.py is shipped next to this script with -files
+sys.path.insert(0, os.getcwd())
+from stats import EditionStats
+
 
 def sanitize(dirty):
     # for sanitizing URIs/filenames
@@ -62,14 +68,35 @@ for line in sys.stdin:
     pipeline = ['curl -L {0}'.format(resource['url'])]
     if resource['compression'] == 'gzip':
         pipeline.append('gunzip')
-    pipeline.append('hadoop fs -put - {0}'.format(dest_path))
 
     # ensure staging path exists
     check_call('hadoop fs -mkdir -p {0}'.format(staging_path), shell=True)
 
-    # execute dnload
-    cmd = ' | '.join(pipeline)
-    check_call(cmd, shell=True)
+    # execute dnload; the bytes go straight into HDFS, and for VCFs `tee` also
+    # feeds the first five columns of each record to the statistics, so they
+    # don't need another pass over the data (nor slow down the upload)
+    stats = EditionStats()
+    pipeline.append('hadoop fs -put - {0}'.format(dest_path))
+    if resource.get('format') == 'vcf':
+        tmp_dir = mkdtemp()
+        try:
+            records = pjoin(tmp_dir, 'records')
+            os.mkfifo(records)
+            pipeline.insert(-1, 'tee {0}'.format(records))
+            fields = Popen(['cut', '-f1-5', records], stdout=PIPE)
+            dnload = Popen(['bash', '-o', 'pipefail', '-c',
+                            ' | '.join(pipeline)])
+            for record in fields.stdout:
+                stats.add_vcf_line(record)
+            for (p, cmd) in [(dnload, ' | '.join(pipeline)),
+                             (fields, 'cut -f1-5 {0}'.format(records))]:
+                if p.wait() != 0:
+                    raise CalledProcessError(p.returncode, cmd)
+        finally:
+            shutil.rmtree(tmp_dir)
+    else:
+        check_call(['bash', '-o', 'pipefail', '-c', ' | '.join(pipeline)])
 
-    # dummy output
-    sys.stdout.write('{0}\t1\n'.format(dest_path))
+    # per-file statistics are merged by the driver
+    sys.stdout.write('{0}\t{1}\n'.format(dest_path,
+                                         json.dumps(stats.to_dict())))
@@ -0,0 +1,196 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module runs a DAG of steps (e.g., the config_cluster installs), starting
+# each step as soon as its dependencies have finished.  Each step runs in its
+# own forked process (like Fabric's @parallel), as Fabric keeps the current
+# host and the SSH connections in global state.  The number of steps running
+# against any one host at a time is bounded.  With a checkpoint, steps that
+# finished in an earlier run are skipped, and steps with an idempotency probe
+# are skipped if the probe finds their work already done.
+
+
+import time
+import traceback
+from multiprocessing import Process, Queue
+
+from eggo.error import EggoError
+from eggo.trace import span
+
+
+class Step(object):
+
+    def __init__(self, name, fn, deps=(), host=None, probe=None, key=''):
+        """A named zero-arg callable that must run after the `deps` steps
+
+        `host` is used to bound the number of concurrent steps per host; steps
+        with no host (e.g., local CM API calls) are not bounded.  `probe` is a
+        cheap zero-arg callable that returns True if the step's work is
+        already in place.  `key` identifies what the step installs (e.g., a
+        fork/branch); a checkpointed step is only skipped for the same key.
+        """
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.host = host
+        self.probe = probe
+        self.key = key
+
+    def __repr__(self):
+        return 'Step({0!r})'.format(self.name)
+
+
+def toposort(steps):
+    """Return the steps in dependency order; raises on unknown deps/cycles"""
+    by_name = dict((s.name, s) for s in steps)
+    if len(by_name) != len(steps):
+        raise EggoError('duplicate step names')
+    for step in steps:
+        for dep in step.deps:
+            if dep not in by_name:
+                raise EggoError(
+                    'step {0} depends on unknown step {1}'.format(step.name,
+                                                                  dep))
+    ordered = []
+    done = set()
+    visiting = set()
+
+    def visit(step):
+        if step.name in done:
+            return
+        if step.name in visiting:
+            raise EggoError('dependency cycle through step {0}'.format(
+                step.name))
+        visiting.add(step.name)
+        for dep in step.deps:
+            visit(by_name[dep])
+        visiting.remove(step.name)
+        done.add(step.name)
+        ordered.append(step)
+
+    for step in steps:
+        visit(step)
+    return ordered
+
+
+def critical_path(steps, durations):
+    """Return (path, seconds) for the longest chain of dependent steps"""
+    finish = {}
+    prev = {}
+    for step in toposort(steps):
+        start = 0.
+        for dep in step.deps:
+            if finish[dep] > start:
+                start = finish[dep]
+                prev[step.name] = dep
+        finish[step.name] = start + durations.get(step.name, 0.)
+    if not finish:
+        return ([], 0.)
+    name = max(finish, key=finish.get)
+    total = finish[name]
+    path = [name]
+    while name in prev:
+        name = prev[name]
+        path.append(name)
+    return (list(reversed(path)), total)
+
+
+def finished_steps(steps, markers):
+    """The steps that can be skipped, given the checkpoint markers
+
+    A step is only skipped if its dependencies are skipped too, so that
+    redoing a step (e.g., for a new branch) redoes whatever builds on it.
+    """
+    skipped = set()
+    for step in toposort(steps):
+        if (markers.get(step.name) == step.key and
+                all(dep in skipped for dep in step.deps)):
+            skipped.add(step.name)
+    return skipped
+
+
+def _run_in_child(step, queue, checkpoint):
+    start = time.time()
+    try:
+        with span('step.{0}'.format(step.name), host=step.host):
+            if step.probe is not None and step.probe():
+                print('Step {0} is already in place'.format(step.name))
+            else:
+                step.fn()
+        if checkpoint is not None:
+            checkpoint.mark(step.name, step.key)
+        queue.put((step.name, True, None, time.time() - start))
+    except BaseException:
+        queue.put((step.name, False, traceback.format_exc(),
+                   time.time() - start))
+
+
+def run_steps(steps, max_parallel_per_host=4, checkpoint=None):
+    """Run the steps concurrently, respecting dependencies
+
+    Returns {step_name: seconds}.  If a step fails, no new steps are started,
+    the running ones are allowed to finish, and an EggoError is raised.
+    `checkpoint` (see eggo.checkpoint) records the finished steps, and the
+    steps it already has are skipped.
+    """
+    pending = toposort(steps)
+    running = {}
+    durations = {}
+    if checkpoint is not None:
+        skipped = finished_steps(steps, checkpoint.load())
+        for step in list(pending):
+            if step.name in skipped:
+                print('Skipping step {0} (finished in an earlier '
+                      'run)'.format(step.name))
+                durations[step.name] = 0.
+                pending.remove(step)
+    failures = {}
+    queue = Queue()
+    while pending or running:
+        if not failures:
+            busy = {}
+            for (step, _) in running.itervalues():
+                busy[step.host] = busy.get(step.host, 0) + 1
+            for step in list(pending):
+                if not all(dep in durations for dep in step.deps):
+                    continue
+                if (step.host is not None and
+                        busy.get(step.host, 0) >= max_parallel_per_host):
+                    continue
+                print('Starting step {0}'.format(step.name))
+                process = Process(target=_run_in_child,
+                                  args=(step, queue, checkpoint))
+                process.start()
+                running[step.name] = (step, process)
+                busy[step.host] = busy.get(step.host, 0) + 1
+                pending.remove(step)
+        if not running:
+            break
+        (name, ok, error, seconds) = queue.get()
+        running.pop(name)[1].join()
+        if ok:
+            durations[name] = seconds
+            print('Finished step {0} in {1:.0f} seconds'.format(name,
+                                                               seconds))
+        else:
+            failures[name] = error
+            print('Step {0} failed:\n{1}'.format(name, error))
+    if failures:
+        raise EggoError('steps failed: {0}; not started: {1}'.format(
+            ', '.join(sorted(failures)),
+            ', '.join(s.name for s in pending) or 'none'))
+    return durations
@@ -0,0 +1,1059 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module simulates the backends that the director functions talk to, so
+# provision/config_cluster/teardown can be run (and timed) in-process, without
+# EC2.  It fakes the boto EC2 and CloudFormation connections, the cm_api
+# ApiResource, the ssh tunnels, and Fabric's run/sudo/put/get (Fabric's
+# execute, and so the forking of eggo.remote and eggo.scheduler, are the real
+# ones).  Every call sleeps for a configurable latency, in simulated seconds
+# that are scaled down to real ones, and can be made to fail at random.
+# Cloud resources change state with the simulated clock (instances boot,
+# stacks get created), as the real ones do.  Each call is recorded as a
+# `sim.<backend>.<call>` span of eggo.trace, which is how the calls made in
+# forked processes are counted.  Simulation.patched swaps the fakes into the
+# loaded eggo modules.  State changes made in a forked process (e.g., CM
+# config updates in a config_cluster step) are not seen by the others.
+
+
+import os
+import re
+import sys
+import time
+import random
+import threading
+from fnmatch import fnmatch
+from itertools import count
+from datetime import datetime
+from contextlib import contextmanager
+
+import fabric.api
+import fabric.contrib.files
+from fabric.api import env, abort
+from boto.exception import BotoServerError
+
+from eggo import aws, cm, util
+from eggo.error import EggoError
+from eggo.trace import span
+from eggo.waiter import Waiter
+
+
+# simulated seconds; roughly what the real calls take
+LATENCIES = {
+    # per API call/round trip
+    'aws_call': 0.3,
+    'cm_call': 0.1,
+    'ssh_command': 1.,
+    'transfer': 2.,
+    'tunnel': 1.,
+    # state changes of the cloud resources
+    'stack_create': 150.,
+    'stack_delete': 120.,
+    'instance_boot': 60.,
+    'instance_checks': 120.,
+    'instance_terminate': 45.,
+    'image_create': 400.,
+    # long running commands
+    'director_bootstrap': 1800.,
+    'director_terminate': 420.,
+    'cm_command': 90.}
+
+# simulated seconds of the commands run on the nodes (on top of ssh_command);
+# the first matching pattern counts
+COMMAND_SECONDS = [
+    (r'xargs -P .* scp ', 30.),
+    (r'yum groupinstall', 300.),
+    (r'yum (-y )?install', 90.),
+    (r'\bmvn ', 600.),
+    (r'^gradle ', 480.),
+    (r'^\./build\.sh', 420.),
+    (r'^git clone', 20.),
+    (r'\b(wget|curl) ', 20.),
+    (r'pip install|get-pip\.py|setup\.py install', 45.),
+    (r'^(tar|unzip) ', 10.),
+    (r'^service ', 15.),
+    (r'hadoop fs ', 5.)]
+
+# (cores, memory GB, instance store disks)
+INSTANCE_TYPES = {
+    'm3.medium': (1, 3.75, 1),
+    'm3.large': (2, 7.5, 1),
+    'm3.xlarge': (4, 15, 2),
+    'm3.2xlarge': (8, 30, 2),
+    'r3.2xlarge': (8, 61, 1),
+    'd2.xlarge': (4, 30.5, 3),
+    'd2.2xlarge': (8, 61, 6),
+    'd2.4xlarge': (16, 122, 12)}
+DEFAULT_INSTANCE_TYPE = (4, 16, 1)
+
+# the roles Director sets up (aws.conf) for each type of node
+CLUSTER_ROLES = [
+    ('HDFS', 'master', ['NAMENODE', 'SECONDARYNAMENODE']),
+    ('HDFS', 'worker', ['DATANODE']),
+    ('YARN', 'master', ['RESOURCEMANAGER', 'JOBHISTORY']),
+    ('YARN', 'worker', ['NODEMANAGER']),
+    ('IMPALA', 'master', ['STATESTORE', 'CATALOGSERVER']),
+    ('IMPALA', 'worker', ['IMPALAD']),
+    ('HIVE', 'master', ['HIVEMETASTORE', 'HIVESERVER2']),
+    ('SPARK_ON_YARN', 'master', ['SPARK_YARN_HISTORY_SERVER'])]
+CONFIG_DEFAULTS = {
+    'HIVESERVER2': {'hs2_thrift_address_port': '10000'},
+    'IMPALAD': {'hs2_port': '21050'},
+    'RESOURCEMANAGER': {'yarn_scheduler_minimum_allocation_mb': '1024',
+                        'yarn_scheduler_maximum_allocation_mb': '8192'},
+    'NODEMANAGER': {'yarn_nodemanager_resource_memory_mb': '8192',
+                    'yarn_nodemanager_resource_cpu_vcores': '8'}}
+
+_active = {'sim': None}
+
+
+class SimulatedFailure(EggoError):
+    pass
+
+
+class _Obj(object):
+    # attribute bag, like the boto and cm_api resource objects
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _aws_error(name):
+    return BotoServerError(503, 'Service Unavailable',
+                           'simulated failure of {0}'.format(name))
+
+
+def instance_facts(instance_type):
+    return INSTANCE_TYPES.get(instance_type, DEFAULT_INSTANCE_TYPE)
+
+
+# EC2 AND CLOUDFORMATION
+
+
+class FakeInstance(object):
+
+    def __init__(self, sim, id_, image_id, instance_type, private_ip,
+                 public_ip, key_name=None):
+        self.sim = sim
+        self.id = id_
+        self.image_id = image_id
+        self.instance_type = instance_type
+        self.private_ip_address = private_ip
+        self._public_ip = public_ip
+        self.key_name = key_name
+        self.tags = {}
+        self.launched_at = sim.clock()
+        self.terminated_at = None
+        self.subnet_id = 'subnet-sim'
+        self.groups = [_Obj(id='sg-sim')]
+        self.root_device_name = '/dev/xvda'
+        self.block_device_mapping = {}
+
+    @property
+    def state(self):
+        now = self.sim.clock()
+        if self.terminated_at is not None:
+            if now < (self.terminated_at +
+                      self.sim.latencies['instance_terminate']):
+                return 'shutting-down'
+            return 'terminated'
+        if now < self.launched_at + self.sim.latencies['instance_boot']:
+            return 'pending'
+        return 'running'
+
+    @property
+    def status_checks(self):
+        if self.state != 'running':
+            return 'not-applicable'
+        ready = (self.launched_at + self.sim.latencies['instance_boot'] +
+                 self.sim.latencies['instance_checks'])
+        return 'ok' if self.sim.clock() >= ready else 'initializing'
+
+    @property
+    def ip_address(self):
+        # public IPs come with the running instance
+        return self._public_ip if self.state == 'running' else None
+
+    def add_tag(self, key, value):
+        self.sim.api('ec2.create_tags', _aws_error)
+        self.tags[key] = value
+
+    def update(self):
+        self.sim.api('ec2.describe_instances', _aws_error)
+
+
+class FakeImage(object):
+
+    def __init__(self, sim, id_, name, tags=None, owner='amazon'):
+        self.sim = sim
+        self.id = id_
+        self.name = name
+        self.tags = dict(tags or {})
+        self.owner = owner
+        self.created_at = sim.clock()
+        self.creationDate = datetime.utcfromtimestamp(
+            self.created_at).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    @property
+    def state(self):
+        if self.sim.clock() < (self.created_at +
+                               self.sim.latencies['image_create']):
+            return 'pending'
+        return 'available'
+
+
+def _matches(obj, filters):
+    # the subset of the EC2 describe filters that eggo uses
+    items = filters.items() if isinstance(filters, dict) else filters
+    for (key, value) in items:
+        values = value if isinstance(value, (list, tuple)) else [value]
+        if key.startswith('tag:'):
+            actual = obj.tags.get(key[len('tag:'):])
+        elif key in ['instance-state-name', 'state']:
+            actual = obj.state
+        elif key in ['instance-id', 'image-id']:
+            actual = obj.id
+        else:
+            raise EggoError('simulated EC2 has no filter {0}'.format(key))
+        if actual not in values:
+            return False
+    return True
+
+
+class FakeEC2Connection(object):
+
+    def __init__(self, sim, region):
+        self.sim = sim
+        self.region = _Obj(name=region)
+
+    def _call(self, name):
+        self.sim.api('ec2.' + name, _aws_error)
+
+    def _instances(self, instance_ids=None):
+        with self.sim.lock:
+            return [i for i in self.sim.instances.values()
+                    if instance_ids is None or i.id in instance_ids]
+
+    def get_only_instances(self, instance_ids=None, filters=None):
+        self._call('describe_instances')
+        instances = self._instances(instance_ids)
+        if filters:
+            instances = [i for i in instances if _matches(i, filters)]
+        return instances
+
+    def get_all_instance_status(self, instance_ids=None,
+                                include_all_instances=False):
+        self._call('describe_instance_status')
+        with self.sim.lock:
+            missing = [id_ for id_ in instance_ids or []
+                       if id_ not in self.sim.instances]
+        if missing:
+            error = BotoServerError(400, 'Bad Request',
+                                    'no instances {0}'.format(missing))
+            error.error_code = 'InvalidInstanceID.NotFound'
+            raise error
+        statuses = []
+        for instance in self._instances(instance_ids):
+            if instance.state != 'running' and not include_all_instances:
+                continue
+            checks = instance.status_checks
+            statuses.append(_Obj(id=instance.id, state_name=instance.state,
+                                 system_status=_Obj(status=checks),
+                                 instance_status=_Obj(status=checks)))
+        return statuses
+
+    def run_instances(self, image_id, min_count=1, max_count=1,
+                      key_name=None, instance_type='m1.small', **kwargs):
+        self._call('run_instances')
+        instances = [self.sim.launch(image_id, instance_type, key_name)
+                     for _ in xrange(max_count)]
+        return _Obj(instances=instances)
+
+    def terminate_instances(self, instance_ids=None):
+        self._call('terminate_instances')
+        return self.sim.terminate(instance_ids)
+
+    def create_tags(self, resource_ids, tags):
+        self._call('create_tags')
+        with self.sim.lock:
+            for id_ in resource_ids:
+                resource = (self.sim.instances.get(id_) or
+                            self.sim.images.get(id_))
+                if resource is None:
+                    raise BotoServerError(400, 'Bad Request',
+                                          'no resource {0}'.format(id_))
+                resource.tags.update(tags)
+
+    def get_all_images(self, image_ids=None, owners=None, filters=None):
+        self._call('describe_images')
+        with self.sim.lock:
+            if image_ids is not None:
+                # e.g. the stock AMIs of the command line
+                for id_ in image_ids:
+                    if id_ not in self.sim.images:
+                        self.sim.images[id_] = FakeImage(
+                            self.sim, id_, id_, owner='amazon')
+                        self.sim.images[id_].created_at -= (
+                            self.sim.latencies['image_create'])
+            images = self.sim.images.values()
+        if image_ids is not None:
+            images = [i for i in images if i.id in image_ids]
+        if owners is not None:
+            images = [i for i in images if i.owner in owners]
+        if filters:
+            images = [i for i in images if _matches(i, filters)]
+        return images
+
+    def create_image(self, instance_id, name, no_reboot=False):
+        self._call('create_image')
+        with self.sim.lock:
+            image = FakeImage(self.sim, self.sim.new_id('ami'), name,
+                              owner='self')
+            self.sim.images[image.id] = image
+        return image.id
+
+
+class FakeStack(object):
+
+    def __init__(self, sim, name):
+        self.sim = sim
+        self.stack_name = name
+        self.created_at = sim.clock()
+        self.deleted_at = None
+
+    @property
+    def stack_status(self):
+        now = self.sim.clock()
+        if self.deleted_at is not None:
+            if now < self.deleted_at + self.sim.latencies['stack_delete']:
+                return 'DELETE_IN_PROGRESS'
+            return 'DELETE_COMPLETE'
+        if now < self.created_at + self.sim.latencies['stack_create']:
+            return 'CREATE_IN_PROGRESS'
+        return 'CREATE_COMPLETE'
+
+
+class FakeCFConnection(object):
+
+    def __init__(self, sim):
+        self.sim = sim
+
+    def _call(self, name):
+        self.sim.api('cf.' + name, _aws_error)
+
+    def _stack(self, name):
+        stack = self.sim.stacks.get(name)
+        # deleted stacks can't be described by name
+        if stack is None or stack.stack_status == 'DELETE_COMPLETE':
+            raise BotoServerError(400, 'Bad Request',
+                                  'Stack with id {0} does not exist'.format(
+                                      name))
+        return stack
+
+    def describe_stacks(self, stack_name_or_id=None):
+        self._call('describe_stacks')
+        return [self._stack(stack_name_or_id)]
+
+    def create_stack(self, stack_name, template_body=None, parameters=(),
+                     tags=None, **kwargs):
+        self._call('create_stack')
+        with self.sim.lock:
+            self.sim.stacks[stack_name] = FakeStack(self.sim, stack_name)
+        return stack_name
+
+    def describe_stack_resources(self, stack_name_or_id):
+        self._call('describe_stack_resources')
+        self._stack(stack_name_or_id)
+        return [_Obj(logical_resource_id='DMZSubnet',
+                     physical_resource_id='subnet-sim'),
+                _Obj(logical_resource_id='ClusterSG',
+                     physical_resource_id='sg-sim')]
+
+    def delete_stack(self, stack_name_or_id):
+        self._call('delete_stack')
+        stack = self._stack(stack_name_or_id)
+        if stack.deleted_at is None:
+            stack.deleted_at = self.sim.clock()
+
+
+# CLOUDERA MANAGER
+
+
+def _config_view(values, defaults):
+    # like the cm_api 'full' view: {name: ApiConfig(value, default)}
+    view = {}
+    for name in set(values) | set(defaults):
+        view[name] = _Obj(name=name, value=values.get(name),
+                          default=defaults.get(name))
+    return view
+
+
+class _CMObject(object):
+
+    def _call(self, name):
+        if not self.sim.call('cm.' + name, self.sim.latencies['cm_call']):
+            raise SimulatedFailure('simulated failure of cm.' + name)
+
+
+class FakeCommand(_CMObject):
+
+    def __init__(self, sim, name, active=True, success=None,
+                 resultMessage=None):
+        self.sim = sim
+        self.name = name
+        self.active = active
+        self.success = success
+        self.resultMessage = resultMessage
+
+    def wait(self):
+        # as in cm_api, the result is a freshly fetched command; this one
+        # keeps its state from when it was submitted
+        if self.sim.call('cm.command.' + self.name,
+                         self.sim.latencies['cm_command']):
+            return FakeCommand(self.sim, self.name, False, True,
+                               'Command finished (simulated)')
+        return FakeCommand(self.sim, self.name, False, False,
+                           'Command failed (simulated)')
+
+
+class FakeRoleConfigGroup(_CMObject):
+
+    def __init__(self, sim, service, name, display_name, role_type,
+                 base=False):
+        self.sim = sim
+        self.service = service
+        self.name = name
+        self.displayName = display_name
+        self.roleType = role_type
+        self.base = base
+        self.config = {}
+
+    def get_config(self, view=None):
+        self._call('get_config')
+        return _config_view(self.config,
+                            CONFIG_DEFAULTS.get(self.roleType, {}))
+
+    def update_config(self, config):
+        self._call('update_config')
+        for (name, value) in config.iteritems():
+            self.config[name] = str(value) if value is not None else None
+        self.service.configStalenessStatus = 'STALE'
+        return self.get_config()
+
+    def move_roles(self, role_names):
+        self._call('move_roles')
+        for role in self.service.roles:
+            if role.name in role_names:
+                role.roleConfigGroupRef = _Obj(roleConfigGroupName=self.name)
+
+
+class FakeRole(_CMObject):
+
+    def __init__(self, sim, service, name, role_type, host_id, group_name):
+        self.sim = sim
+        self.name = name
+        self.type = role_type
+        self.serviceRef = _Obj(serviceName=service.name)
+        self.hostRef = _Obj(hostId=host_id)
+        self.roleConfigGroupRef = _Obj(roleConfigGroupName=group_name)
+        self.config = {}
+
+    def get_config(self, view=None):
+        self._call('get_config')
+        return _config_view(self.config, CONFIG_DEFAULTS.get(self.type, {}))
+
+
+class FakeService(_CMObject):
+
+    def __init__(self, sim, name, service_type):
+        self.sim = sim
+        self.name = name
+        self.type = service_type
+        self.roles = []
+        self.groups = []
+        self.config = {}
+        self.serviceState = 'STARTED'
+        self.configStalenessStatus = 'FRESH'
+
+    def set_state(self, state):
+        # (re)starting a service applies its config changes
+        self.serviceState = state
+        if state == 'STARTED':
+            self.configStalenessStatus = 'FRESH'
+
+    def group(self, role_type):
+        # the base group, made on first use
+        for group in self.groups:
+            if group.base and group.roleType == role_type:
+                return group
+        group = FakeRoleConfigGroup(
+            self.sim, self, '{0}-{1}-BASE'.format(self.name, role_type),
+            '{0} Default Group'.format(role_type), role_type, base=True)
+        self.groups.append(group)
+        return group
+
+    def add_role(self, role_type, host, group_name=None):
+        group_name = group_name or self.group(role_type).name
+        role = FakeRole(self.sim, self, '{0}-{1}-{2}'.format(
+            self.name, role_type, host.hostId[:8]), role_type, host.hostId,
+            group_name)
+        self.roles.append(role)
+        host.roleRefs.append(_Obj(clusterName='cluster',
+                                  serviceName=self.name, roleName=role.name))
+        return role
+
+    def get_all_roles(self):
+        self._call('get_all_roles')
+        return list(self.roles)
+
+    def get_role(self, name):
+        self._call('get_role')
+        for role in self.roles:
+            if role.name == name:
+                return role
+        raise SimulatedFailure('no role {0}'.format(name))
+
+    def delete_role(self, name):
+        self._call('delete_role')
+        self.roles = [r for r in self.roles if r.name != name]
+
+    def get_all_role_config_groups(self):
+        self._call('get_all_role_config_groups')
+        return list(self.groups)
+
+    def create_role_config_group(self, name, display_name, role_type):
+        self._call('create_role_config_group')
+        group = FakeRoleConfigGroup(self.sim, self, name, display_name,
+                                    role_type)
+        self.groups.append(group)
+        return group
+
+    def get_config(self, view=None):
+        self._call('get_config')
+        return (_config_view(self.config, {}), {})
+
+    def update_config(self, config):
+        self._call('update_config')
+        for (name, value) in config.iteritems():
+            self.config[name] = str(value) if value is not None else None
+        self.configStalenessStatus = 'STALE'
+        return self.get_config()
+
+    def _roles_command(self, name, role_names):
+        self._call(name)
+        return [FakeCommand(self.sim, name) for _ in role_names]
+
+    def stop_roles(self, *role_names):
+        return self._roles_command('stop_roles', role_names)
+
+    def start_roles(self, *role_names):
+        return self._roles_command('start_roles', role_names)
+
+    def stop(self):
+        self._call('stop')
+        self.set_state('STOPPED')
+        return FakeCommand(self.sim, 'stop')
+
+    def start(self):
+        self._call('start')
+        self.set_state('STARTED')
+        return FakeCommand(self.sim, 'start')
+
+
+class FakeHostTemplate(_CMObject):
+
+    def __init__(self, sim, cluster, name):
+        self.sim = sim
+        self.cluster = cluster
+        self.name = name
+        self.group_refs = []
+
+    def set_role_config_groups(self, group_refs):
+        self._call('set_role_config_groups')
+        self.group_refs = list(group_refs)
+
+    def apply_host_template(self, host_ids, start_roles=False):
+        self._call('apply_host_template')
+        for host_id in host_ids:
+            host = self.cluster.host(host_id)
+            for ref in self.group_refs:
+                (service, group) = self.cluster.group(ref.roleConfigGroupName)
+                service.add_role(group.roleType, host, group.name)
+        return FakeCommand(self.sim, 'apply_host_template')
+
+
+class FakeCluster(_CMObject):
+    """A CM deployment: the cluster, its hosts, and the mgmt service"""
+
+    def __init__(self, sim, name='cluster'):
+        self.sim = sim
+        self.name = name
+        self.services = []
+        self.hosts = []
+        self.mgmt = FakeService(sim, 'mgmt', 'MGMT')
+
+    def add_host(self, instance):
+        (cores, memory_gb, _) = instance_facts(instance.instance_type)
+        host = _Obj(
+            hostId=instance.id.replace('i-', 'host-'),
+            hostname='ip-{0}.ec2.internal'.format(
+                instance.private_ip_address.replace('.', '-')),
+            ipAddress=instance.private_ip_address, numCores=cores,
+            totalPhysMemBytes=int(memory_gb * 1024 ** 3), roleRefs=[],
+            in_cluster=True)
+        self.hosts.append(host)
+        return host
+
+    def service(self, service_type):
+        for service in self.services:
+            if service.type == service_type:
+                return service
+        service = FakeService(self.sim, service_type.lower(), service_type)
+        self.services.append(service)
+        return service
+
+    def host(self, host_id):
+        for host in self.hosts:
+            if host.hostId == host_id:
+                return host
+        raise SimulatedFailure('no host {0}'.format(host_id))
+
+    def group(self, name):
+        for service in self.services:
+            for group in service.groups:
+                if group.name == name:
+                    return (service, group)
+        raise SimulatedFailure('no role config group {0}'.format(name))
+
+    def get_all_services(self):
+        self._call('get_all_services')
+        return list(self.services)
+
+    def _command(self, name, state=None):
+        self._call(name)
+        if state is not None:
+            for service in self.services:
+                service.set_state(state)
+        return FakeCommand(self.sim, name)
+
+    def deploy_client_config(self):
+        return self._command('deploy_client_config')
+
+    def restart(self):
+        return self._command('restart', 'STARTED')
+
+    def stop(self):
+        return self._command('stop', 'STOPPED')
+
+    def start(self):
+        return self._command('start', 'STARTED')
+
+    def add_hosts(self, host_ids):
+        self._call('add_hosts')
+        for host_id in host_ids:
+            self.host(host_id).in_cluster = True
+
+    def remove_host(self, host_id):
+        self._call('remove_host')
+        self.host(host_id).in_cluster = False
+
+    def create_host_template(self, name):
+        self._call('create_host_template')
+        return FakeHostTemplate(self.sim, self, name)
+
+    def delete_host_template(self, name):
+        self._call('delete_host_template')
+
+
+class FakeApiResource(_CMObject):
+    """Takes the place of cm_api's ApiResource
+
+    The port is that of a simulated tunnel, which leads to the CM of one
+    simulated cluster.
+    """
+
+    def __init__(self, host, username='admin', password='admin',
+                 server_port=7180, version=None):
+        self.sim = _active['sim']
+        self.cluster = self.sim.cm_behind_port(server_port)
+
+    def get_all_clusters(self):
+        self._call('get_all_clusters')
+        return [self.cluster]
+
+    def get_all_hosts(self, view=None):
+        self._call('get_all_hosts')
+        return list(self.cluster.hosts)
+
+    def delete_host(self, host_id):
+        self._call('delete_host')
+        self.cluster.hosts = [h for h in self.cluster.hosts
+                              if h.hostId != host_id]
+
+    def get_cloudera_manager(self):
+        return self
+
+    # the ClouderaManager resource
+
+    def get_config(self, view=None):
+        self._call('get_config')
+        return {}
+
+    def get_service(self):
+        self._call('get_service')
+        return self.cluster.mgmt
+
+    def hosts_decommission(self, hostnames):
+        self._call('hosts_decommission')
+        return FakeCommand(self.sim, 'hosts_decommission')
+
+
+# FABRIC
+
+
+class SimResult(str):
+    """Like the string (with status attributes) that Fabric's run returns"""
+
+    def __new__(cls, stdout, command, return_code):
+        result = str.__new__(cls, stdout)
+        result.stdout = stdout
+        result.stderr = ''
+        result.command = command
+        result.return_code = return_code
+        result.succeeded = return_code == 0
+        result.failed = not result.succeeded
+        return result
+
+
+class SimTransfer(list):
+    # what Fabric's put and get return
+
+    def __init__(self, paths):
+        list.__init__(self, paths)
+        self.failed = []
+        self.succeeded = True
+
+
+class SimWaiter(Waiter):
+    """Waiter on the simulated clock"""
+
+    def __init__(self, describe, **kwargs):
+        sim = _active['sim']
+        kwargs.setdefault('clock', sim.clock)
+        kwargs.setdefault('sleep', sim.sleep)
+        Waiter.__init__(self, describe, **kwargs)
+
+
+# THE SIMULATION
+
+
+class Simulation(object):
+
+    def __init__(self, latencies=None, failures=None, time_scale=0.01,
+                 seed=0):
+        """`latencies` override LATENCIES; `failures` is [(pattern, rate)]
+
+        A call fails at random with the rate of the first pattern (e.g.
+        'ec2.run_instances', 'ssh.*') that matches its name.  `time_scale` is
+        the real seconds per simulated second.
+        """
+        self.latencies = dict(LATENCIES, **(latencies or {}))
+        self.failures = list(failures or [])
+        self.time_scale = time_scale
+        self.seed = seed
+        self.start = time.time()
+        self.lock = threading.RLock()
+        self.instances = {}
+        self.images = {}
+        self.stacks = {}
+        self.files = {}
+        self.clusters = {}
+        self.tunnels = {}
+        self._ids = count(1)
+        self._ports = count(17180)
+        self._rng = (None, None)
+
+    # time
+
+    def clock(self):
+        """The simulated time (seconds since the epoch)"""
+        return self.start + (time.time() - self.start) / self.time_scale
+
+    def sleep(self, seconds):
+        time.sleep(seconds * self.time_scale)
+
+    def sleep_progressive(self, start_time):
+        # eggo.util.sleep_progressive, on the simulated clock
+        elapsed = (datetime.now() - start_time).seconds / self.time_scale
+        self.sleep(5 if elapsed < 30 else min(60, elapsed / 10.))
+
+    # calls and failures
+
+    def _fails(self, name):
+        for (pattern, rate) in self.failures:
+            if fnmatch(name, pattern):
+                (pid, rng) = self._rng
+                if pid != os.getpid():
+                    # forked processes don't repeat each other's draws
+                    rng = random.Random(self.seed * 1000003 + os.getpid())
+                    self._rng = (os.getpid(), rng)
+                return rng.random() < rate
+        return False
+
+    def call(self, name, seconds, host=None, **attrs):
+        """Record a backend call and wait out its latency
+
+        Returns False if a failure was injected (the span records it as
+        failed), else True.
+        """
+        try:
+            with span('sim.' + name, host=host, **attrs):
+                self.sleep(seconds)
+                if self._fails(name):
+                    raise SimulatedFailure('simulated failure of ' + name)
+        except SimulatedFailure:
+            return False
+        return True
+
+    def api(self, name, error):
+        if not self.call(name, self.latencies['aws_call']):
+            raise error(name)
+
+    # EC2 state
+
+    def new_id(self, prefix):
+        # unique across forked processes too
+        return '{0}-{1:05x}{2:06x}'.format(prefix, os.getpid() & 0xfffff,
+                                           next(self._ids))
+
+    def launch(self, image_id, instance_type, key_name=None, tags=None):
+        with self.lock:
+            n = len(self.instances) + 1
+            instance = FakeInstance(
+                self, self.new_id('i'), image_id, instance_type,
+                '10.0.{0}.{1}'.format(n // 250, n % 250 + 4),
+                '54.0.{0}.{1}'.format(n // 250, n % 250 + 4), key_name)
+            instance.tags.update(tags or {})
+            self.instances[instance.id] = instance
+        return instance
+
+    def terminate(self, instance_ids):
+        terminated = []
+        with self.lock:
+            for id_ in instance_ids:
+                instance = self.instances.get(id_)
+                if instance is None:
+                    raise BotoServerError(400, 'Bad Request',
+                                          'no instance {0}'.format(id_))
+                if instance.terminated_at is None:
+                    instance.terminated_at = self.clock()
+                terminated.append(instance)
+        return terminated
+
+    def instance_by_ip(self, ip_address):
+        with self.lock:
+            for instance in self.instances.values():
+                if ip_address in [instance.ip_address,
+                                  instance.private_ip_address]:
+                    return instance
+        raise EggoError('simulated EC2 has no instance at {0}'.format(
+            ip_address))
+
+    # connections
+
+    def ec2_connection(self, region):
+        return FakeEC2Connection(self, region)
+
+    def cf_connection(self, region):
+        return FakeCFConnection(self)
+
+    @contextmanager
+    def tunnel_ctx(self, tunnel_host, remote_host, remote_port,
+                   local_port=None, user=None, private_key=None):
+        self.call('ssh.tunnel', self.latencies['tunnel'], host=tunnel_host)
+        port = next(self._ports) if local_port is None else local_port
+        self.tunnels[port] = remote_host
+        try:
+            yield port
+        finally:
+            self.tunnels.pop(port, None)
+
+    def cm_behind_port(self, port):
+        if port not in self.tunnels or self.tunnels[port] not in self.clusters:
+            raise EggoError('no simulated CM behind port {0}'.format(port))
+        return self.clusters[self.tunnels[port]]
+
+    # the commands run on the nodes
+
+    def director_bootstrap(self, host, conf_path):
+        """Launch the nodes and set up CM as in the director.conf"""
+        launcher = self.instance_by_ip(host)
+        conf = self.files.get((host, conf_path), '')
+
+        def value(pattern, default):
+            match = re.search(pattern, conf)
+            return match.group(1) if match else default
+        # the instance type of the nodes, not the provider's type
+        instance_type = value(r'\btype:\s*([a-z][0-9]\.\w+)', 'd2.xlarge')
+        image = value(r'\bimage:\s*(\S+)', 'ami-sim')
+        num_workers = int(value(r'workers\s*\{\s*count:\s*(\d+)', '3'))
+        tags = {'eggo_stack_name': launcher.tags['eggo_stack_name'],
+                'owner': launcher.tags.get('owner')}
+        nodes = {}
+        for node_type in ['manager', 'master'] + ['worker'] * num_workers:
+            nodes.setdefault(node_type, []).append(self.launch(
+                image, instance_type, launcher.key_name,
+                dict(tags, eggo_node_type=node_type)))
+
+        cluster = FakeCluster(self)
+        hosts = {}
+        for instances in nodes.itervalues():
+            for instance in instances:
+                hosts[instance.id] = cluster.add_host(instance)
+        for (service_type, node_type, role_types) in CLUSTER_ROLES:
+            service = cluster.service(service_type)
+            for instance in nodes[node_type]:
+                for role_type in role_types:
+                    service.add_role(role_type, hosts[instance.id])
+        disks = instance_facts(instance_type)[2]
+        cluster.service('HDFS').group('DATANODE').config[
+            'dfs_data_dir_list'] = ','.join(
+                '/data{0}/dfs/dn'.format(i) for i in xrange(disks))
+        self.clusters[nodes['manager'][0].private_ip_address] = cluster
+        return self.latencies['director_bootstrap']
+
+    def director_terminate(self, host):
+        # Director only knows about the nodes it launched
+        stack_name = self.instance_by_ip(host).tags['eggo_stack_name']
+        with self.lock:
+            self.terminate([
+                i.id for i in self.instances.values()
+                if i.tags.get('eggo_stack_name') == stack_name and
+                i.tags.get('eggo_node_type') in ['manager', 'master',
+                                                 'worker'] and
+                not i.tags.get('eggo_autoscaled')])
+        return self.latencies['director_terminate']
+
+    def handle(self, command, host):
+        """Return (simulated seconds, output, return code) of a command"""
+        match = re.search(r'cloudera-director bootstrap (\S+)', command)
+        if match:
+            return (self.director_bootstrap(host, match.group(1)), '', 0)
+        if 'cloudera-director terminate' in command:
+            return (self.director_terminate(host), '', 0)
+        if command.startswith('df -P'):
+            disks = instance_facts(self.instance_by_ip(host).instance_type)[2]
+            return (0., '\n'.join('/data{0}'.format(i)
+                                  for i in xrange(disks)), 0)
+        # probes find fresh nodes, without markers or tools
+        if re.match(r'(test|which|rpm -q|python -c|unzip -tq) |'
+                    r'hadoop fs -test|grep -q \S+ \.bash_profile$', command):
+            return (0., '', 1)
+        if command.startswith('for f in '):
+            return (0., '', 0)
+        if command.startswith('wc -l'):
+            return (0., '0', 0)
+        for (pattern, seconds) in COMMAND_SECONDS:
+            if re.search(pattern, command):
+                return (seconds, '', 0)
+        return (0., '', 0)
+
+    def _remote(self, kind, command, warn_only=False):
+        host = env.host_string
+        (seconds, output, return_code) = self.handle(command, host)
+        if not self.call('ssh.' + kind,
+                         self.latencies['ssh_command'] + seconds,
+                         host=host, command=command[:80]):
+            (output, return_code) = ('simulated failure', 1)
+        result = SimResult(output, command, return_code)
+        if result.failed and not (warn_only or env.warn_only):
+            abort('{0}() received nonzero return code {1} while executing '
+                  '(simulated)!\n\n{2}'.format(kind, return_code, command))
+        return result
+
+    def run(self, command, warn_only=False, **kwargs):
+        return self._remote('run', command, warn_only)
+
+    def sudo(self, command, warn_only=False, **kwargs):
+        return self._remote('sudo', command, warn_only)
+
+    def put(self, local_path=None, remote_path=None, **kwargs):
+        host = env.host_string
+        # only what eggo generates (e.g. director.conf) is kept
+        content = local_path.read() if hasattr(local_path, 'read') else ''
+        if not self.call('ssh.put', self.latencies['transfer'], host=host):
+            abort('put {0} failed (simulated)'.format(remote_path))
+        self.files[(host, remote_path)] = content
+        return SimTransfer([remote_path])
+
+    def get(self, remote_path, local_path=None, **kwargs):
+        host = env.host_string
+        if not self.call('ssh.get', self.latencies['transfer'], host=host):
+            abort('get {0} failed (simulated)'.format(remote_path))
+        local_path = local_path or os.path.basename(remote_path)
+        with open(local_path, 'w') as op:
+            op.write(self.files.get((host, remote_path), ''))
+        return SimTransfer([local_path])
+
+    def exists(self, path, use_sudo=False, verbose=False):
+        result = self._remote('run', 'test -e "{0}"'.format(path), True)
+        return result.succeeded
+
+    def append(self, filename, text, use_sudo=False, **kwargs):
+        self._remote('sudo' if use_sudo else 'run',
+                     'echo >> {0}'.format(filename))
+
+    # patching
+
+    def _replacements(self):
+        return [(aws.create_ec2_connection, self.ec2_connection),
+                (aws.create_cf_connection, self.cf_connection),
+                (cm.ApiResource, FakeApiResource),
+                (util.tunnel_ctx, self.tunnel_ctx),
+                (util.sleep_progressive, self.sleep_progressive),
+                (Waiter, SimWaiter),
+                (fabric.api.run, self.run),
+                (fabric.api.sudo, self.sudo),
+                (fabric.api.put, self.put),
+                (fabric.api.get, self.get),
+                (fabric.contrib.files.exists, self.exists),
+                (fabric.contrib.files.append, self.append)]
+
+    @contextmanager
+    def patched(self):
+        """Swap the fakes in for the real backends in the loaded eggo modules
+
+        Modules imported later are not patched, so import what is used first.
+        """
+        replacements = self._replacements()
+        fakes = dict((id(real), fake) for (real, fake) in replacements)
+        swapped = []
+        for (name, module) in sys.modules.items():
+            if (module is None or name == __name__ or
+                    not (name == 'eggo' or name.startswith('eggo.'))):
+                continue
+            for (attr, value) in vars(module).items():
+                if id(value) in fakes:
+                    swapped.append((module, attr, value))
+                    setattr(module, attr, fakes[id(value)])
+        _active['sim'] = self
+        try:
+            yield self
+        finally:
+            _active['sim'] = None
+            for (module, attr, value) in swapped:
+                setattr(module, attr, value)
@@ -0,0 +1,210 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module contains the per-edition statistics that are accumulated while
+# data flows through the ingest stages.  It only uses the standard library, as
+# it is shipped to the Hadoop streaming tasks along with download_mapper.py.
+# All the sketches are mergeable, so each task accumulates its own and the
+# driver merges them into a single JSON sidecar per edition.
+
+
+import math
+import base64
+from hashlib import md5
+
+
+STATS_VERSION = 1
+
+# name of the sidecar written next to the data; the leading underscore makes
+# Hadoop input formats (and therefore ADAM/Hive/Impala) skip it
+SIDECAR_NAME = '_eggo_stats.json'
+
+
+class HyperLogLog(object):
+    """Mergeable distinct-count sketch (~1.6% std error at p=12)"""
+
+    def __init__(self, p=12, registers=None):
+        self.p = p
+        self.m = 1 << p
+        if registers is None:
+            registers = bytearray(self.m)
+        self.registers = registers
+
+    def add(self, value):
+        h = int(md5(value).hexdigest()[:16], 16)
+        idx = h >> (64 - self.p)
+        w = (h << self.p) & 0xFFFFFFFFFFFFFFFF
+        rho = 1
+        while rho <= 64 - self.p and not (w & (1 << 63)):
+            w <<= 1
+            rho += 1
+        if rho > self.registers[idx]:
+            self.registers[idx] = rho
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError('cannot merge HLLs with different precision')
+        for i in xrange(self.m):
+            if other.registers[i] > self.registers[i]:
+                self.registers[i] = other.registers[i]
+        return self
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m ** 2 / sum(2. ** -r for r in self.registers)
+        zeros = sum(1 for r in self.registers if r == 0)
+        if estimate <= 2.5 * self.m and zeros > 0:
+            # small range correction (linear counting)
+            estimate = self.m * math.log(float(self.m) / zeros)
+        return int(round(estimate))
+
+    def to_dict(self):
+        return {'p': self.p,
+                'registers': base64.b64encode(bytes(self.registers))}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['p'], bytearray(base64.b64decode(d['registers'])))
+
+
+class QuantileSketch(object):
+    """Mergeable quantile sketch with bounded relative error
+
+    Values are counted in logarithmically sized buckets (as in DDSketch), so
+    any quantile is within `relative_accuracy` of the true value and merging
+    is just summing bucket counts.
+    """
+
+    def __init__(self, relative_accuracy=0.01, buckets=None, zeros=0):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.buckets = buckets if buckets is not None else {}
+        self.zeros = zeros
+
+    @property
+    def count(self):
+        return self.zeros + sum(self.buckets.itervalues())
+
+    def add(self, value, n=1):
+        if value <= 0:
+            self.zeros += n
+            return
+        k = int(math.ceil(math.log(value, self.gamma)))
+        self.buckets[k] = self.buckets.get(k, 0) + n
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('cannot merge sketches with different accuracy')
+        for (k, n) in other.buckets.iteritems():
+            self.buckets[k] = self.buckets.get(k, 0) + n
+        self.zeros += other.zeros
+        return self
+
+    def quantile(self, q):
+        total = self.count
+        if total == 0:
+            return None
+        rank = q * (total - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0
+        for k in sorted(self.buckets):
+            seen += self.buckets[k]
+            if rank < seen:
+                return 2 * self.gamma ** k / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def summary(self, qs=(0., 0.05, 0.25, 0.5, 0.75, 0.95, 1.)):
+        return dict(('p{0:g}'.format(100 * q), self.quantile(q)) for q in qs)
+
+    def to_dict(self):
+        # JSON object keys must be strings
+        return {'relative_accuracy': self.relative_accuracy,
+                'zeros': self.zeros,
+                'buckets': dict((str(k), n)
+                                for (k, n) in self.buckets.iteritems())}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['relative_accuracy'],
+                   dict((int(k), n) for (k, n) in d['buckets'].iteritems()),
+                   d['zeros'])
+
+
+class EditionStats(object):
+    """Row, contig, and partition statistics for a single dataset edition"""
+
+    def __init__(self):
+        self.row_count = 0
+        self.contig_counts = {}
+        self.distinct_variants = HyperLogLog()
+        self.partition_files = QuantileSketch()
+        self.partition_bytes = QuantileSketch()
+
+    def add_variant(self, contig, position, ref, alt):
+        self.row_count += 1
+        self.contig_counts[contig] = self.contig_counts.get(contig, 0) + 1
+        self.distinct_variants.add(
+            '{0}:{1}:{2}:{3}'.format(contig, position, ref, alt))
+
+    def add_vcf_line(self, line):
+        if line.startswith('#'):
+            return
+        fields = line.split('\t', 5)
+        if len(fields) < 5:
+            return
+        self.add_variant(fields[0], fields[1], fields[3], fields[4])
+
+    def add_partition(self, num_files, num_bytes):
+        self.partition_files.add(num_files)
+        self.partition_bytes.add(num_bytes)
+
+    def merge(self, other):
+        self.row_count += other.row_count
+        for (contig, n) in other.contig_counts.iteritems():
+            self.contig_counts[contig] = self.contig_counts.get(contig, 0) + n
+        self.distinct_variants.merge(other.distinct_variants)
+        self.partition_files.merge(other.partition_files)
+        self.partition_bytes.merge(other.partition_bytes)
+        return self
+
+    def to_dict(self):
+        return {'version': STATS_VERSION,
+                'row_count': self.row_count,
+                'contig_counts': self.contig_counts,
+                'distinct_variants': self.distinct_variants.count(),
+                'num_partitions': self.partition_bytes.count,
+                'partition_files': self.partition_files.summary(),
+                'partition_bytes': self.partition_bytes.summary(),
+                'sketches': {
+                    'distinct_variants': self.distinct_variants.to_dict(),
+                    'partition_files': self.partition_files.to_dict(),
+                    'partition_bytes': self.partition_bytes.to_dict()}}
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls()
+        stats.row_count = d['row_count']
+        stats.contig_counts = dict(d['contig_counts'])
+        sketches = d['sketches']
+        stats.distinct_variants = HyperLogLog.from_dict(
+            sketches['distinct_variants'])
+        stats.partition_files = QuantileSketch.from_dict(
+            sketches['partition_files'])
+        stats.partition_bytes = QuantileSketch.from_dict(
+            sketches['partition_bytes'])
+        return stats
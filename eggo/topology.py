@@ -0,0 +1,157 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module keeps a snapshot of the nodes of a stack (launcher, manager,
+# master, workers), built from a single tag-filtered describe call and grouped
+# by the eggo_node_type tag.  Snapshots are cached on disk for a short time, so
+# the director functions (and the config_cluster steps, which run in separate
+# processes) share one lookup.  Anything that adds or removes nodes should
+# invalidate the snapshot.
+
+
+import os
+import json
+import time
+import os.path as osp
+from os.path import join as pjoin
+
+from eggo.error import EggoError
+from eggo.config import get_eggo_cache_dir
+
+
+TOPOLOGY_TTL = 60
+
+
+class Node(object):
+    """The parts of an EC2 instance that eggo uses"""
+
+    FIELDS = ['id', 'ip_address', 'private_ip_address', 'image_id',
+              'instance_type', 'state', 'tags']
+
+    def __init__(self, **kwargs):
+        for field in self.FIELDS:
+            setattr(self, field, kwargs.get(field))
+
+    @classmethod
+    def from_instance(cls, instance):
+        return cls(**dict((f, getattr(instance, f)) for f in cls.FIELDS))
+
+    def to_dict(self):
+        return dict((f, getattr(self, f)) for f in self.FIELDS)
+
+    @property
+    def node_type(self):
+        return self.tags.get('eggo_node_type')
+
+    def __eq__(self, other):
+        return isinstance(other, Node) and self.id == other.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return 'Node({0!r}, {1!r})'.format(self.node_type, self.id)
+
+
+class Topology(object):
+
+    def __init__(self, stack_name, nodes, fetched_at=None):
+        self.stack_name = stack_name
+        self.nodes = list(nodes)
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+
+    def of_type(self, node_type):
+        return [n for n in self.nodes if n.node_type == node_type]
+
+    def _one(self, node_type):
+        nodes = self.of_type(node_type)
+        if len(nodes) == 0:
+            raise EggoError('stack {0} has no {1} node'.format(
+                self.stack_name, node_type))
+        return nodes[0]
+
+    @property
+    def launcher(self):
+        return self._one('launcher')
+
+    @property
+    def manager(self):
+        return self._one('manager')
+
+    @property
+    def master(self):
+        return self._one('master')
+
+    @property
+    def workers(self):
+        return self.of_type('worker')
+
+    @property
+    def cluster_nodes(self):
+        """The nodes that are part of the CDH cluster (not the launcher)"""
+        return self.workers + [self.manager, self.master]
+
+    def to_dict(self):
+        return {'stack_name': self.stack_name,
+                'fetched_at': self.fetched_at,
+                'nodes': [n.to_dict() for n in self.nodes]}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['stack_name'], [Node(**n) for n in d['nodes']],
+                   d['fetched_at'])
+
+
+def fetch_topology(ec2_conn, stack_name):
+    instances = ec2_conn.get_only_instances(
+        filters={'tag:eggo_stack_name': stack_name})
+    return Topology(stack_name, [
+        Node.from_instance(i) for i in instances
+        if i.state not in ['shutting-down', 'terminated']])
+
+
+def topology_cache_path(region, stack_name):
+    return pjoin(get_eggo_cache_dir(), 'topology',
+                 '{0}.{1}.json'.format(region, stack_name))
+
+
+def get_topology(ec2_conn, stack_name, ttl=TOPOLOGY_TTL):
+    """Return the stack's topology, from the disk cache if fresh enough"""
+    path = topology_cache_path(ec2_conn.region.name, stack_name)
+    if osp.isfile(path):
+        with open(path) as ip:
+            topology = Topology.from_dict(json.load(ip))
+        if time.time() - topology.fetched_at < ttl:
+            return topology
+    topology = fetch_topology(ec2_conn, stack_name)
+    if not osp.isdir(osp.dirname(path)):
+        os.makedirs(osp.dirname(path))
+    # write-then-rename, as concurrent steps may be reading it
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as op:
+        json.dump(topology.to_dict(), op)
+    os.rename(tmp_path, path)
+    return topology
+
+
+def invalidate_topology(ec2_conn, stack_name):
+    path = topology_cache_path(ec2_conn.region.name, stack_name)
+    if osp.isfile(path):
+        os.remove(path)
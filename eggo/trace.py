@@ -0,0 +1,188 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module records tracing spans for the cluster operations (provision,
+# config_cluster, teardown, and the steps, AWS calls, and Fabric tasks they are
+# made of).  Each span is a JSON object on its own line: name, host, start,
+# duration, outcome, pid, and parent span.  Forked processes (Fabric's
+# @parallel, the scheduler's steps) inherit the trace file and append to it;
+# each line is a single write to a file opened with O_APPEND, so lines from
+# concurrent processes don't interleave.  A finished trace can be converted to
+# the Chrome trace format (chrome://tracing, Perfetto) or summarized per span
+# name to compare runs.  Tracing is off unless start_trace is called, and then
+# only uses the standard library.
+
+
+import os
+import json
+import time
+import threading
+from itertools import count
+from functools import wraps
+from contextlib import contextmanager
+
+
+_state = {'path': None}
+_ids = count(1)
+# the open spans, innermost last; per thread, so concurrent callers (e.g., a
+# ThreadPool) get their own parents
+_local = threading.local()
+
+
+def start_trace(path):
+    """Record spans to `path` (truncated) from now on"""
+    with open(path, 'w'):
+        pass
+    _state['path'] = path
+
+
+def stop_trace():
+    _state['path'] = None
+
+
+def tracing():
+    return _state['path'] is not None
+
+
+def _current_host():
+    # inside a Fabric task, the host it runs against
+    try:
+        from fabric.api import env
+    except ImportError:
+        return None
+    return env.get('host_string') or None
+
+
+def _write(record):
+    line = json.dumps(record) + '\n'
+    fd = os.open(_state['path'], os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def span(name, host=None, **attrs):
+    """Record the enclosed block as a span (if tracing)"""
+    if not tracing():
+        yield
+        return
+    pid = os.getpid()
+    span_id = '{0}.{1}'.format(pid, next(_ids))
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    stack = _local.stack
+    parent = stack[-1] if stack else None
+    stack.append(span_id)
+    outcome = 'ok'
+    start = time.time()
+    try:
+        yield
+    except BaseException as e:
+        outcome = type(e).__name__
+        raise
+    finally:
+        end = time.time()
+        stack.pop()
+        if tracing():
+            _write({'name': name, 'id': span_id, 'parent': parent,
+                    'host': host or _current_host(), 'start': start,
+                    'duration': end - start, 'outcome': outcome, 'pid': pid,
+                    'tid': threading.current_thread().ident, 'attrs': attrs})
+
+
+def traced(fn=None, name=None):
+    """Decorator to record each call of a function as a span
+
+    The span is named `module.function` unless `name` is given.
+    """
+    if fn is None:
+        return lambda f: traced(f, name)
+    span_name = name or '{0}.{1}'.format(fn.__module__.rsplit('.', 1)[-1],
+                                         fn.__name__)
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with span(span_name):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def read_trace(path):
+    with open(path) as ip:
+        return [json.loads(line) for line in ip if line.strip()]
+
+
+def to_chrome(records):
+    """Convert spans to the Chrome trace event format"""
+    events = []
+    hosts = {}
+    for r in records:
+        if r['host']:
+            hosts[r['pid']] = r['host']
+        args = dict(r['attrs'], outcome=r['outcome'], host=r['host'])
+        # each thread is its own lane; nested spans stack up within it
+        events.append({'name': r['name'], 'ph': 'X', 'pid': r['pid'],
+                       'tid': r.get('tid', r['pid']),
+                       'ts': int(r['start'] * 1e6),
+                       'dur': int(r['duration'] * 1e6), 'args': args})
+    for (pid, host) in hosts.iteritems():
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                       'args': {'name': '{0} ({1})'.format(host, pid)}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_chrome_trace(path, chrome_path=None):
+    """Write the Chrome trace for a trace file; returns its path"""
+    if chrome_path is None:
+        chrome_path = '{0}.chrome.json'.format(path.rsplit('.', 1)[0]
+                                               if path.endswith('.jsonl')
+                                               else path)
+    with open(chrome_path, 'w') as op:
+        json.dump(to_chrome(read_trace(path)), op)
+    return chrome_path
+
+
+def summarize(records):
+    """Return {span name: (count, total seconds, max seconds, failures)}"""
+    summary = {}
+    for r in records:
+        (count, total, max_, failures) = summary.get(r['name'],
+                                                     (0, 0., 0., 0))
+        summary[r['name']] = (count + 1, total + r['duration'],
+                              max(max_, r['duration']),
+                              failures + (r['outcome'] != 'ok'))
+    return summary
+
+
+def print_summary(path, baseline_path=None):
+    """Print the per-span totals of a trace, next to a baseline run's"""
+    summary = summarize(read_trace(path))
+    baseline = {}
+    if baseline_path is not None:
+        baseline = summarize(read_trace(baseline_path))
+    ts = '{0:<40}{1:>6}{2:>10}{3:>10}{4:>6}{5:>12}'
+    print(ts.format('span', 'count', 'total_s', 'max_s', 'fail',
+                    'baseline_s' if baseline else ''))
+    for name in sorted(summary, key=lambda n: -summary[n][1]):
+        (count, total, max_, failures) = summary[name]
+        base = ''
+        if name in baseline:
+            base = '{0:.1f}'.format(baseline[name][1])
+        print(ts.format(name[:39], count, '{0:.1f}'.format(total),
+                        '{0:.1f}'.format(max_), failures, base))
@@ -23,6 +23,7 @@ import os
 import re
 import time
 import random
+import socket
 import string
 import os.path as osp
 from os.path import join as pjoin
@@ -32,8 +33,10 @@ from shutil import rmtree
 from hashlib import md5
 from tempfile import mkdtemp
 from datetime import datetime
-from subprocess import check_call, Popen, CalledProcessError
+from subprocess import call, check_call, Popen
 from contextlib import contextmanager
+from httplib import HTTPException
+from urllib2 import urlopen, HTTPError, URLError
 
 
 def uuid():
@@ -99,6 +102,13 @@ def make_local_tmp(prefix='tmp_eggo_', dir_=None):
         rmtree(tmpdir)
 
 
+# replication of the files that only live in a make_hdfs_tmp dir; HDFS has no
+# per-dir replication, so the writers pass SCRATCH_HDFS_OPTS; losing a node
+# only fails the job that wrote them
+SCRATCH_REPLICATION = 1
+SCRATCH_HDFS_OPTS = '-D dfs.replication={0}'.format(SCRATCH_REPLICATION)
+
+
 @contextmanager
 def make_hdfs_tmp(prefix='tmp_eggo', dir_='/tmp', permissions='755'):
     tmpdir = pjoin(dir_, '_'.join([prefix, uuid()]))
@@ -134,25 +144,127 @@ def non_blocking_tunnel(tunnel_host, remote_host, remote_port, local_port=None,
     return p
 
 
+def _control_path(tunnel_host, user):
+    # unix socket paths are limited to ~100 chars, so keep the name short
+    from eggo.config import get_eggo_cache_dir
+    control_dir = pjoin(get_eggo_cache_dir(), 'ssh')
+    if not osp.isdir(control_dir):
+        os.makedirs(control_dir, 0700)
+    name = md5('{0}@{1}'.format(user, tunnel_host)).hexdigest()[:12]
+    return pjoin(control_dir, name)
+
+
+def _ssh_args(tunnel_host, user, private_key):
+    args = ['ssh', '-S', _control_path(tunnel_host, user),
+            '-o', 'UserKnownHostsFile=/dev/null',
+            '-o', 'StrictHostKeyChecking=no']
+    if private_key:
+        args.extend(['-i', private_key])
+    return args + ['{0}@{1}'.format(user, tunnel_host)]
+
+
+def control_master_alive(tunnel_host, user=None, private_key=None):
+    if user is None:
+        user = getuser()
+    args = _ssh_args(tunnel_host, user, private_key)
+    with open(os.devnull, 'w') as devnull:
+        return call(args[:1] + ['-O', 'check'] + args[1:], stdout=devnull,
+                    stderr=devnull) == 0
+
+
+def ensure_control_master(tunnel_host, user=None, private_key=None,
+                          persist='10m'):
+    """Start (or reuse) a multiplexed ssh connection to the tunnel host
+
+    The connection outlives the process that started it by `persist`, so
+    later eggo commands reuse it instead of doing another SSH handshake.
+    It also exits once it has been idle (no sessions, and no open forwarded
+    connections) that long, which takes its forwards down with it.
+    """
+    if user is None:
+        user = getuser()
+    if control_master_alive(tunnel_host, user, private_key):
+        return
+    args = _ssh_args(tunnel_host, user, private_key)
+    # -f returns once the connection is authenticated
+    persist_opt = 'ControlPersist={0}'.format(persist)
+    check_call(args[:1] + ['-fNM', '-o', persist_opt] + args[1:])
+
+
+def free_local_port():
+    s = socket.socket()
+    try:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+def wait_for_http(port, host='localhost', timeout=300, max_delay=5.):
+    """Wait until an HTTP server answers on host:port (with any status)
+
+    Through an ssh forward, a plain TCP connect proves nothing: ssh accepts
+    it locally whether or not the remote service is up.
+    """
+    start = time.time()
+    delay = 0.1
+    while True:
+        try:
+            urlopen('http://{0}:{1}/'.format(host, port), timeout=10).close()
+            return
+        except HTTPError:
+            # an error page is still an answer
+            return
+        except (URLError, HTTPException, socket.error):
+            if time.time() - start > timeout:
+                raise
+            time.sleep(delay)
+            delay = min(2 * delay, max_delay)
+
+
+def add_forward(tunnel_host, remote_host, remote_port, local_port=None,
+                user=None, private_key=None):
+    """Forward localhost:local_port to remote_host:remote_port
+
+    The forward is carried by the multiplexed connection to the tunnel host.
+    Picks a free local port if none is given; returns the local port.
+    """
+    if user is None:
+        user = getuser()
+    if local_port is None:
+        local_port = free_local_port()
+    ensure_control_master(tunnel_host, user, private_key)
+    args = _ssh_args(tunnel_host, user, private_key)
+    spec = '{0}:{1}:{2}'.format(local_port, remote_host, remote_port)
+    check_call(args[:1] + ['-O', 'forward', '-L', spec] + args[1:])
+    return local_port
+
+
+def cancel_forward(tunnel_host, remote_host, remote_port, local_port,
+                   user=None, private_key=None):
+    if user is None:
+        user = getuser()
+    args = _ssh_args(tunnel_host, user, private_key)
+    spec = '{0}:{1}:{2}'.format(local_port, remote_host, remote_port)
+    with open(os.devnull, 'w') as devnull:
+        # the master may have gone away already
+        call(args[:1] + ['-O', 'cancel', '-L', spec] + args[1:],
+             stdout=devnull, stderr=devnull)
+
+
 @contextmanager
 def tunnel_ctx(tunnel_host, remote_host, remote_port, local_port=None,
                user=None, private_key=None):
-    tunnel_process = non_blocking_tunnel(tunnel_host, remote_host, remote_port,
-                                         local_port, user, private_key)
-    # ssh may take a bit to open up the connection, so we wait until we get a
-    # successful curl command to the local port
-    print('Attempting to curl to SSH tunnel; may take a few attempts')
-    start_time = datetime.now()
-    while True:
-        try:
-            check_call('curl http://localhost:{0}'.format(local_port),
-                       shell=True)
-            # only reach this point if the curl cmd succeeded.
-            print('...success!')
-            break
-        except CalledProcessError:
-            sleep_progressive(start_time)
+    """Forward a local port for the duration of the context; yields the port
+
+    The ssh connection to the tunnel host is kept for reuse afterwards.
+    """
+    local_port = add_forward(tunnel_host, remote_host, remote_port,
+                             local_port, user, private_key)
     try:
+        # the services eggo tunnels to (CM, the YARN RM) all speak HTTP
+        wait_for_http(local_port)
         yield local_port
     finally:
-        tunnel_process.terminate()
+        cancel_forward(tunnel_host, remote_host, remote_port, local_port,
+                       user, private_key)
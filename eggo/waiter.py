@@ -0,0 +1,100 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module waits for many cloud resources (instances, stacks, images) to
+# reach a state.  All the resources still being waited on are looked up with a
+# single batched describe call per tick, and the delay between ticks grows
+# exponentially up to a cap (with jitter), so a state change is never noticed
+# more than `max_delay` seconds late.  The describe call, clock, and sleep are
+# injectable, so the waiter can be run against a simulated backend; the boto
+# describe calls are in eggo.aws.
+
+
+import sys
+import time
+import random
+
+from eggo.error import EggoError
+
+
+class WaitTimeout(EggoError):
+    pass
+
+
+class WaitFailed(EggoError):
+    pass
+
+
+class Waiter(object):
+
+    def __init__(self, describe, base_delay=2., max_delay=15., jitter=0.25,
+                 timeout=None, clock=time.time, sleep=time.sleep,
+                 out=sys.stdout):
+        """`describe(ids)` returns {id: observed state} for the given ids
+
+        Ids missing from the result are passed to the predicates as None.
+        """
+        self.describe = describe
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.timeout = timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.out = out
+        self.num_calls = 0
+
+    def delay(self, tick):
+        delay = min(self.max_delay, self.base_delay * 2 ** tick)
+        # spread out the polls of concurrent waiters
+        return delay * (1 - self.jitter * random.random())
+
+    def wait(self, ids, done, failed=None):
+        """Wait until `done(observed)` for all ids; return {id: seconds}
+
+        Raises WaitFailed as soon as `failed(observed)` for any id, and
+        WaitTimeout if the timeout passes first.
+        """
+        start = self.clock()
+        pending = list(ids)
+        reached = {}
+        tick = 0
+        while True:
+            observed = self.describe(pending)
+            self.num_calls += 1
+            now = self.clock()
+            for id_ in list(pending):
+                state = observed.get(id_)
+                if failed is not None and failed(state):
+                    raise WaitFailed('{0} reached state {1}'.format(id_,
+                                                                    state))
+                if done(state):
+                    reached[id_] = now - start
+                    pending.remove(id_)
+            if not pending:
+                break
+            if self.timeout is not None and now - start > self.timeout:
+                raise WaitTimeout('timed out waiting for {0}'.format(
+                    ', '.join(str(i) for i in pending)))
+            if self.out is not None:
+                self.out.write('.')
+                self.out.flush()
+            self.sleep(self.delay(tick))
+            tick += 1
+        if self.out is not None:
+            self.out.write('\n')
+        return reached
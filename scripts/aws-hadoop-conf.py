@@ -17,6 +17,10 @@
 
 """Generate necessary S3 properties for Hadoop client config.
 
+The S3A connector can also be tuned with one of the named performance
+profiles (connection pool, threads, multipart sizes, fast upload); the
+benchmark command measures the S3A throughput of each profile.
+
 Requires these environment variables to be set:
     AWS_ACCESS_KEY_ID
     AWS_SECRET_ACCESS_KEY
@@ -25,13 +29,75 @@ Requires these environment variables to be set:
 from __future__ import print_function
 
 import os
+import time
+from shutil import copytree
+from os.path import join as pjoin
+from subprocess import Popen, check_call
 from xml.etree.ElementTree import parse, fromstring, tostring
 
-from click import group, option
-from cm_api.api_client import ApiResource
+from click import group, option, Choice
+
+from eggo.cm import CMSession
+from eggo.util import make_local_tmp
+
+
+MB = 1024 * 1024
+
+# S3A settings on top of the Hadoop defaults (15 connections, 100 MB parts,
+# no multipart below 2 GB, uploads buffered on local disk)
+S3A_PROFILES = {
+    'default': [],
+    # bulk distcp and Spark scans; fast upload buffers each stream's parts in
+    # memory (threads * multipart size at most)
+    'throughput': [
+        ('fs.s3a.connection.maximum', 100),
+        ('fs.s3a.threads.max', 64),
+        ('fs.s3a.threads.core', 32),
+        ('fs.s3a.max.total.tasks', 128),
+        ('fs.s3a.multipart.size', 64 * MB),
+        ('fs.s3a.multipart.threshold', 128 * MB),
+        ('fs.s3a.fast.upload', 'true'),
+        ('fs.s3a.fast.buffer.size', 8 * MB),
+        ('fs.s3a.connection.timeout', 200000),
+        ('fs.s3a.attempts.maximum', 20)],
+    # for executors that are tight on memory: more parallelism than the
+    # defaults, but parts are still buffered on disk
+    'low-memory': [
+        ('fs.s3a.connection.maximum', 40),
+        ('fs.s3a.threads.max', 16),
+        ('fs.s3a.threads.core', 8),
+        ('fs.s3a.max.total.tasks', 32),
+        ('fs.s3a.multipart.size', 32 * MB),
+        ('fs.s3a.multipart.threshold', 64 * MB),
+        ('fs.s3a.attempts.maximum', 20)]}
+DEFAULT_PROFILE = 'default'
+
+option_profile = option(
+    '--profile', type=Choice(sorted(S3A_PROFILES)), default=DEFAULT_PROFILE,
+    show_default=True, help='S3A performance profile')
+option_endpoint = option(
+    '--endpoint', default=None,
+    help='S3A endpoint, e.g. for another region or an S3-compatible store '
+         '(http://host:port disables SSL)')
 
 
-def generate_xml_elements():
+def s3a_settings(profile=DEFAULT_PROFILE, endpoint=None):
+    settings = list(S3A_PROFILES[profile])
+    if endpoint is not None:
+        if endpoint.startswith('http://'):
+            settings.append(('fs.s3a.connection.ssl.enabled', 'false'))
+        settings.append(('fs.s3a.endpoint', endpoint.split('://')[-1]))
+    return settings
+
+
+def property_element(name, value):
+    return fromstring('<property>\n'
+                      '    <name>{0}</name>\n'
+                      '    <value>{1}</value>\n'
+                      '</property>'.format(name, value))
+
+
+def generate_xml_elements(profile=DEFAULT_PROFILE, endpoint=None):
     s3_1 = ('<property>\n'
             '    <name>fs.s3.impl</name>\n'
             '    <value>org.apache.hadoop.fs.s3.S3FileSystem</value>\n'
@@ -61,22 +127,28 @@ def generate_xml_elements():
              '    <value>org.apache.hadoop.fs.s3a.S3AFileSystem</value>\n'
              '</property>')
     s3a_2 = ('<property>\n'
-             '    <name>fs.s3a.awsAccessKeyId</name>\n'
+             '    <name>fs.s3a.access.key</name>\n'
              '    <value>{AWS_ACCESS_KEY_ID}</value>\n'
              '</property>').format(**os.environ)
     s3a_3 = ('<property>\n'
-             '    <name>fs.s3a.awsSecretAccessKey</name>\n'
+             '    <name>fs.s3a.secret.key</name>\n'
              '    <value>{AWS_SECRET_ACCESS_KEY}</value>\n'
              '</property>').format(**os.environ)
 
     s = [s3_1, s3_2, s3_3, s3n_1, s3n_2, s3n_3, s3a_1, s3a_2, s3a_3]
     p = [fromstring(x) for x in s]
+    p += [property_element(name, value)
+          for (name, value) in s3a_settings(profile, endpoint)]
     return p
 
 
 def get_s3_properties():
-    elts = generate_xml_elements()
-    return [e.find('name').text for e in elts]
+    names = [e.find('name').text for e in generate_xml_elements()]
+    # the S3A credentials used to be set under these (ignored) names
+    names += ['fs.s3a.awsAccessKeyId', 'fs.s3a.awsSecretAccessKey']
+    for profile in S3A_PROFILES:
+        names += [name for (name, _) in s3a_settings(profile, 'http://x')]
+    return names
 
 
 @group(context_settings={'help_option_names': ['-h', '--help']})
@@ -89,9 +161,11 @@ def main():
 
 
 @main.command()
-def dump():
+@option_profile
+@option_endpoint
+def dump(profile, endpoint):
     """Dump XML to stdout (note: this will print AWS credentials)"""
-    elts = generate_xml_elements()
+    elts = generate_xml_elements(profile, endpoint)
     for e in elts:
         print(tostring(e))
 
@@ -100,9 +174,11 @@ def dump():
 @option('-p', '--path',
         help='The path to the XML file; typically '
              '$HADOOP_HOME/etc/hadoop/core-site.xml')
-def update_xml(path):
+@option_profile
+@option_endpoint
+def update_xml(path, profile, endpoint):
     """Update config by modifying XML config file"""
-    elts = generate_xml_elements()
+    elts = generate_xml_elements(profile, endpoint)
     tree = parse(path)
     root = tree.getroot()
     for e in elts:
@@ -116,21 +192,19 @@ def update_xml(path):
         help='Port for Cloudera Manager')
 @option('--username', default='admin', show_default=True, help='CM username')
 @option('--password', default='admin', show_default=True, help='CM password')
-def update_cm(cm_host, cm_port, username, password):
+@option_profile
+@option_endpoint
+def update_cm(cm_host, cm_port, username, password, profile, endpoint):
     """Update config using the CM API (note: will restart service)"""
-    elts = generate_xml_elements()
-    cm_api = ApiResource(cm_host, username=username, password=password,
-                         server_port=cm_port, version=9)
-    cluster = list(cm_api.get_all_clusters())[0]
-    hdfs = filter(lambda x: x.type == 'HDFS',
-                  list(cluster.get_all_services()))[0]
+    elts = generate_xml_elements(profile, endpoint)
+    session = CMSession(cm_host, cm_port, username, password)
     print("Updating HFDS core-site.xml safety valve...")
-    _ = hdfs.update_config({
+    session.update_service_config('HDFS', {
         'core_site_safety_valve': '\n'.join(tostring(e) for e in elts)})
     print("Deploying client config across the cluster...")
-    cluster.deploy_client_config().wait()
+    session.deploy_client_config()
     print("Restarting necessary services...")
-    cluster.restart().wait()
+    session.restart()
     print("Done!")
 
 
@@ -143,24 +217,111 @@ def update_cm(cm_host, cm_port, username, password):
 def reset_cm(cm_host, cm_port, username, password):
     """Elim S3 config from CM API safety valve (service restart necessary)"""
     s3_props = set(get_s3_properties())
-    cm_api = ApiResource(cm_host, username=username, password=password,
-                         server_port=cm_port, version=9)
-    cluster = list(cm_api.get_all_clusters())[0]
-    hdfs = filter(lambda x: x.type == 'HDFS',
-                  list(cluster.get_all_services()))[0]
+    session = CMSession(cm_host, cm_port, username, password)
     print("Getting current safety valve config")
-    current_config = hdfs.get_config('full')[0]['core_site_safety_valve'].value
+    current_config = session.service_config('HDFS')[0][
+        'core_site_safety_valve'].value
     # need the "<foo>...</foo>" to make it valid XML (bc it requires root elt)
     elts = list(fromstring('<foo>' + current_config + '</foo>'))
     new_elts = filter(lambda x: x.find('name').text not in s3_props, elts)
     print("Updating safety valve and deleting S3 config")
-    _ = hdfs.update_config({
+    session.update_service_config('HDFS', {
         'core_site_safety_valve': '\n'.join(tostring(e) for e in new_elts)})
     print("Deploying client config across the cluster...")
-    cluster.deploy_client_config().wait()
+    session.deploy_client_config()
     print("Restarting necessary services...")
-    cluster.restart().wait()
+    session.restart()
     print("Done!")
 
+
+def credentials_conf_dir(tmp_dir):
+    """A copy of the client config with the S3A credentials in core-site.xml
+
+    This keeps the secret key off the command line, where any user on the
+    node could see it with `ps`.
+    """
+    conf_dir = pjoin(tmp_dir, 'conf')
+    copytree(os.environ.get('HADOOP_CONF_DIR', '/etc/hadoop/conf'), conf_dir)
+    os.chmod(conf_dir, 0700)
+    core_site = pjoin(conf_dir, 'core-site.xml')
+    tree = parse(core_site)
+    tree.getroot().extend([
+        property_element('fs.s3a.access.key', os.environ['AWS_ACCESS_KEY_ID']),
+        property_element('fs.s3a.secret.key',
+                         os.environ['AWS_SECRET_ACCESS_KEY'])])
+    os.chmod(core_site, 0600)
+    tree.write(core_site)
+    return conf_dir
+
+
+def hadoop_fs(conf_dir, settings, *args):
+    """The `hadoop fs` command with the given config dir and S3A settings"""
+    cmd = ['hadoop', '--config', conf_dir, 'fs']
+    for (name, value) in settings:
+        cmd += ['-D', '{0}={1}'.format(name, value)]
+    return cmd + list(args)
+
+
+def timed_streams(cmds, stdout=None):
+    """Run the commands concurrently; return the seconds until all finish"""
+    start = time.time()
+    processes = [Popen(cmd, stdout=stdout) for cmd in cmds]
+    for (cmd, process) in zip(cmds, processes):
+        if process.wait() != 0:
+            raise RuntimeError('failed: {0}'.format(' '.join(cmd[-3:])))
+    return time.time() - start
+
+
+@main.command()
+@option('--bucket', required=True, help='Bucket to write the test files to')
+@option('--prefix', default='tmp/eggo-s3a-benchmark', show_default=True,
+        help='Key prefix for the test files (deleted afterwards)')
+@option_endpoint
+@option('--profiles', default=','.join(sorted(S3A_PROFILES)),
+        show_default=True, help='Comma-separated profiles to benchmark')
+@option('--size-mb', default=512, show_default=True,
+        help='Size of each test file')
+@option('--streams', default=4, show_default=True,
+        help='Number of files to write/read concurrently')
+def benchmark(bucket, prefix, endpoint, profiles, size_mb, streams):
+    """Measure S3A write/read throughput for each profile (run on a node)"""
+    for profile in profiles.split(','):
+        if profile not in S3A_PROFILES:
+            raise ValueError("Unknown S3A profile: {0}".format(profile))
+    results = []
+    with make_local_tmp() as tmp_dir:
+        conf_dir = credentials_conf_dir(tmp_dir)
+        local_path = pjoin(tmp_dir, 'data')
+        with open(local_path, 'wb') as op:
+            # random data, so nothing along the way can compress it
+            for _ in xrange(size_mb):
+                op.write(os.urandom(MB))
+        with open(os.devnull, 'w') as devnull:
+            for profile in profiles.split(','):
+                settings = s3a_settings(profile, endpoint)
+                base = 's3a://{0}/{1}/{2}'.format(bucket, prefix.strip('/'),
+                                                  profile)
+                paths = ['{0}/{1}'.format(base, i) for i in xrange(streams)]
+                print("Benchmarking profile {0}...".format(profile))
+                try:
+                    write_s = timed_streams(
+                        [hadoop_fs(conf_dir, settings, '-put', '-f',
+                                   local_path, path) for path in paths])
+                    read_s = timed_streams(
+                        [hadoop_fs(conf_dir, settings, '-cat', path)
+                         for path in paths], stdout=devnull)
+                finally:
+                    check_call(hadoop_fs(conf_dir, settings, '-rm', '-r',
+                                         '-f', '-skipTrash', base),
+                               stdout=devnull)
+                results.append((profile, size_mb * streams / write_s,
+                                size_mb * streams / read_s))
+    ts = '{0:<14}{1:>14}{2:>14}'
+    print(ts.format('profile', 'write MB/s', 'read MB/s'))
+    for (profile, write_mbps, read_mbps) in results:
+        print(ts.format(profile, '{0:.1f}'.format(write_mbps),
+                        '{0:.1f}'.format(read_mbps)))
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,188 @@
+#! /usr/bin/env python
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark provision, config_cluster, and teardown on simulated backends.
+
+The director functions run against the in-process fakes of eggo.sim (EC2,
+CloudFormation, Cloudera Manager, and the commands on the nodes), so a run
+takes seconds and costs nothing.  Reports the wall time and the backend calls
+of each phase.  The latencies are in simulated seconds (see eggo.sim
+LATENCIES), which are scaled down by --time-scale; --fail makes calls fail at
+random, e.g. to see what --retries buys.  The traces of the phases can be
+kept and compared with `eggo-cluster trace_report`.
+"""
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import traceback
+from functools import partial
+from tempfile import mkdtemp
+from os.path import join as pjoin
+
+# eggo reads these at import; the simulation doesn't use them
+for var in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'EC2_KEY_PAIR',
+            'EC2_PRIVATE_KEY_FILE']:
+    os.environ.setdefault(var, 'sim')
+
+from click import command, option
+
+from eggo import director, remote, trace, sim
+from eggo.cli.cluster import (
+    options_install_choices, DEFAULT_CF_TEMPLATE_PATH,
+    DEFAULT_DIRECTOR_CONF_PATH)
+
+
+REGION = 'us-east-1'
+STOCK_AMI = 'ami-00a11e68'
+
+
+def parse_pairs(pairs):
+    """Parse NAME=NUMBER options into [(name, float)]"""
+    parsed = []
+    for pair in pairs:
+        (name, _, value) = pair.rpartition('=')
+        parsed.append((name, float(value)))
+    return parsed
+
+
+def count_calls(records):
+    """Return {backend call: (count, failures)} from a trace"""
+    calls = {}
+    for r in records:
+        if r['name'].startswith('sim.'):
+            name = r['name'][len('sim.'):]
+            (num, failures) = calls.get(name, (0, 0))
+            calls[name] = (num + 1, failures + (r['outcome'] != 'ok'))
+    return calls
+
+
+def run_phase(name, fn, trace_path):
+    trace.start_trace(trace_path)
+    start = time.time()
+    outcome = 'ok'
+    try:
+        fn()
+    except Exception as e:
+        outcome = type(e).__name__
+        traceback.print_exc()
+    finally:
+        seconds = time.time() - start
+        trace.stop_trace()
+    return {'phase': name, 'outcome': outcome, 'seconds': seconds,
+            'calls': count_calls(trace.read_trace(trace_path))}
+
+
+def print_report(results, time_scale):
+    ts = '{0:<16}{1:<18}{2:>8}{3:>9}{4:>8}{5:>8}'
+    print(ts.format('phase', 'outcome', 'real_s', 'sim_min', 'calls',
+                    'failed'))
+    for r in results:
+        print(ts.format(r['phase'], r['outcome'][:17],
+                        '{0:.1f}'.format(r['seconds']),
+                        '{0:.1f}'.format(r['seconds'] / time_scale / 60),
+                        sum(n for (n, _) in r['calls'].itervalues()),
+                        sum(f for (_, f) in r['calls'].itervalues())))
+    print()
+    names = set()
+    for r in results:
+        names.update(r['calls'])
+    ts = '{0:<36}' + ''.join('{%d:>16}' % (i + 1)
+                             for i in xrange(len(results)))
+    print(ts.format('call', *[r['phase'] for r in results]))
+    for name in sorted(names):
+        cells = []
+        for r in results:
+            (num, failures) = r['calls'].get(name, (0, 0))
+            cells.append('{0}{1}'.format(
+                num, ' ({0} failed)'.format(failures) if failures else ''))
+        print(ts.format(name[:35], *cells))
+
+
+@command()
+@option('-n', '--num-workers', default=3, show_default=True,
+        help='Number of worker instances to simulate')
+@option('--worker-instance-type', default='d2.xlarge', show_default=True,
+        help='Instance type of the nodes (sets their cores, memory, disks)')
+@options_install_choices
+@option('--max-parallel', default=4, show_default=True,
+        help='Max number of install steps to run at once on a host')
+@option('--mirror/--no-mirror', default=True, show_default=True,
+        help='Download packages/artifacts once, through the launcher')
+@option('--pool-size', default=16, show_default=True,
+        help='Max number of hosts to run a remote task on at once')
+@option('--retries', default=0, show_default=True,
+        help='Times to retry a remote task that failed on a host')
+@option('--time-scale', default=0.01, show_default=True,
+        help='Real seconds per simulated second')
+@option('--latency', multiple=True, metavar='NAME=SECONDS',
+        help='Override a simulated latency, e.g. director_bootstrap=600')
+@option('--fail', multiple=True, metavar='PATTERN=RATE',
+        help='Fail the matching calls at random, e.g. "ssh.*=0.01"')
+@option('--seed', default=0, show_default=True,
+        help='Seed for the failures')
+@option('--trace-dir', default=None,
+        help='Keep the trace of each phase in this dir')
+@option('--output', default=None, help='Also write the report as JSON')
+def main(num_workers, worker_instance_type, adam, adam_fork, adam_branch,
+         opencb, gatk, quince, quince_fork, quince_branch, max_parallel,
+         mirror, pool_size, retries, time_scale, latency, fail, seed,
+         trace_dir, output):
+    remote.configure(pool_size=pool_size, retries=retries)
+    # the topology cache of the simulated stack stays out of the real one
+    os.environ['EGGO_CACHE_DIR'] = mkdtemp(prefix='eggo-sim-cache-')
+    if trace_dir is None:
+        trace_dir = mkdtemp(prefix='eggo-sim-trace-')
+    elif not os.path.isdir(trace_dir):
+        os.makedirs(trace_dir)
+    simulation = sim.Simulation(dict(parse_pairs(latency)), parse_pairs(fail),
+                                time_scale, seed)
+    stack_name = 'eggo-sim-{0}'.format(os.getpid())
+    phases = [
+        ('provision', partial(
+            director.provision, REGION, 'us-east-1b', stack_name,
+            DEFAULT_CF_TEMPLATE_PATH, STOCK_AMI, 'm3.medium',
+            worker_instance_type, DEFAULT_DIRECTOR_CONF_PATH, STOCK_AMI,
+            num_workers)),
+        ('config_cluster', partial(
+            director.config_cluster, REGION, stack_name, adam, adam_fork,
+            adam_branch, opencb, gatk, quince, quince_fork, quince_branch,
+            max_parallel, mirror=mirror)),
+        ('teardown', partial(director.teardown, REGION, stack_name))]
+
+    results = []
+    with simulation.patched():
+        for (name, fn) in phases:
+            # a cluster that failed to come up is still torn down
+            if (name != 'teardown' and results and
+                    results[-1]['outcome'] != 'ok'):
+                continue
+            results.append(run_phase(name, fn,
+                                     pjoin(trace_dir, name + '.jsonl')))
+    print()
+    print_report(results, time_scale)
+    print('Traces are in {0}'.format(trace_dir))
+    if output is not None:
+        with open(output, 'w') as op:
+            json.dump({'time_scale': time_scale, 'phases': results}, op,
+                      indent=2)
+
+
+if __name__ == '__main__':
+    main()
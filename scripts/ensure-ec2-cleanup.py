@@ -15,20 +15,36 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import sys
+"""Terminate any instances still tagged with an eggo stack.
 
-from boto.ec2 import connect_to_region
+Sweeps up what a failed teardown left behind, with one describe call and
+batched terminate calls.
+"""
 
-from eggo.config import eggo_config
+from __future__ import print_function
 
+from click import command, option
 
-exec_ctx = eggo_config.get('execution', 'context')
-# check that we're running on EC2
-if exec_ctx not in ['spark_ec2', 'director']:
-    sys.exit()
-conn = connect_to_region(eggo_config.get(exec_ctx, 'region'))
-instances = conn.get_only_instances(
-    filters={'tag:stack_name': [eggo_config.get(exec_ctx, 'stack_name')]})
-for instance in instances:
-    print instance
-    instance.terminate()
+from eggo.aws import (
+    create_ec2_connection, get_stack_instances, terminate_instances)
+
+
+@command()
+@option('--region', default='us-east-1', show_default=True,
+        help='AWS Region')
+@option('--stack-name', default='bdg-eggo', show_default=True,
+        help='Stack name for CloudFormation and cluster name')
+@option('--wait/--no-wait', default=False, show_default=True,
+        help='Wait for the instances to terminate')
+def main(region, stack_name, wait):
+    ec2_conn = create_ec2_connection(region)
+    instances = get_stack_instances(ec2_conn, stack_name)
+    for instance in instances:
+        print(instance.id, instance.tags.get('eggo_node_type', '?'),
+              instance.state)
+    terminate_instances(ec2_conn, instances, wait)
+    print('Terminated {0} instance(s)'.format(len(instances)))
+
+
+if __name__ == '__main__':
+    main()
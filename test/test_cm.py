@@ -0,0 +1,143 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+from eggo.cm import CMSession
+from eggo.error import EggoError
+
+
+# Fakes of the cm_api resources.  As in cm_api, a command is a snapshot:
+# wait() returns a new, finished ApiCommand and leaves the submitted one as it
+# was (active, with no outcome yet).
+
+class FakeCommand(object):
+
+    def __init__(self, log, name, success=True, resultMessage='done'):
+        self.log = log
+        self.name = name
+        self.active = True
+        self.success = None
+        self.resultMessage = None
+        self._outcome = (success, resultMessage)
+
+    def wait(self):
+        self.log.append(('wait', self.name))
+        finished = FakeCommand(self.log, self.name)
+        finished.active = False
+        (finished.success, finished.resultMessage) = self._outcome
+        return finished
+
+
+class FakeService(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeCluster(object):
+
+    def __init__(self, log, services):
+        self.log = log
+        self.services = services
+
+    def get_all_services(self):
+        self.log.append(('get_all_services',))
+        return list(self.services)
+
+    def _command(self, name):
+        self.log.append((name,))
+        return FakeCommand(self.log, name)
+
+    def restart(self):
+        return self._command('restart')
+
+    def stop(self):
+        return self._command('stop')
+
+    def start(self):
+        return self._command('start')
+
+    def deploy_client_config(self):
+        return self._command('deploy_client_config')
+
+
+class FakeClouderaManager(object):
+
+    def __init__(self, log, decommission_outcome):
+        self.log = log
+        self.decommission_outcome = decommission_outcome
+
+    def hosts_decommission(self, hostnames):
+        self.log.append(('hosts_decommission', list(hostnames)))
+        (success, message) = self.decommission_outcome
+        return FakeCommand(self.log, 'hosts_decommission', success, message)
+
+
+class FakeApiResource(object):
+
+    def __init__(self, services=(), decommission_outcome=(True, 'done')):
+        self.log = []
+        self.cluster = FakeCluster(self.log, services)
+        self.manager = FakeClouderaManager(self.log, decommission_outcome)
+
+    def get_all_clusters(self):
+        return [self.cluster]
+
+    def get_cloudera_manager(self):
+        return self.manager
+
+
+def make_session(api):
+    session = CMSession('localhost')
+    session.api = api
+    return session
+
+
+class CommandTest(unittest.TestCase):
+
+    def test_decommission_checks_the_waited_command(self):
+        api = FakeApiResource()
+        make_session(api).decommission_hosts(['w1', 'w2'])
+        self.assertEqual(api.log, [('hosts_decommission', ['w1', 'w2']),
+                                   ('wait', 'hosts_decommission')])
+
+    def test_decommission_failure(self):
+        api = FakeApiResource(decommission_outcome=(False, 'w1 is down'))
+        with self.assertRaises(EggoError) as cm:
+            make_session(api).decommission_hosts(['w1'])
+        self.assertTrue('w1 is down' in str(cm.exception))
+
+    def test_restart_returns_the_finished_command(self):
+        api = FakeApiResource()
+        session = make_session(api)
+        result = session.restart()
+        self.assertFalse(result.active)
+        self.assertTrue(result.success)
+
+    def test_commands_drop_cached_services(self):
+        api = FakeApiResource([FakeService('hdfs')])
+        session = make_session(api)
+        session.services()
+        session.services()
+        session.stop()
+        session.services()
+        self.assertEqual(api.log.count(('get_all_services',)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from eggo.error import EggoError
+from eggo.merge import (UnsortedInputError, check_sorted, contig_key,
+                        external_sort, merge_sorted, merge_vcfs, split_header,
+                        vcf_record_key)
+
+
+def record(contig, pos):
+    return '{0}\t{1}\t.\tA\tG\n'.format(contig, pos)
+
+
+class ContigKeyTest(unittest.TestCase):
+
+    def test_order(self):
+        contigs = ['GL000192.1', 'chrM', 'X', '10', 'chr2', '1', 'Y']
+        self.assertEqual(sorted(contigs, key=contig_key),
+                         ['1', 'chr2', '10', 'X', 'Y', 'chrM', 'GL000192.1'])
+
+    def test_record_key(self):
+        self.assertTrue(vcf_record_key(record('2', 900)) <
+                        vcf_record_key(record('10', 100)))
+        self.assertTrue(vcf_record_key(record('1', 99)) <
+                        vcf_record_key(record('1', 100)))
+
+
+class SplitHeaderTest(unittest.TestCase):
+
+    def test_split(self):
+        lines = ['##fileformat=VCFv4.1\n', '#CHROM\tPOS\n',
+                 record('1', 1), record('1', 2)]
+        (header, records) = split_header(lines)
+        self.assertEqual(header, lines[:2])
+        self.assertEqual(list(records), lines[2:])
+
+    def test_header_only(self):
+        (header, records) = split_header(['#CHROM\tPOS\n'])
+        self.assertEqual(header, ['#CHROM\tPOS\n'])
+        self.assertEqual(list(records), [])
+
+
+class MergeSortedTest(unittest.TestCase):
+
+    def test_merge(self):
+        merged = merge_sorted([[1, 4, 7], [], [2, 5], [3, 6, 8]],
+                              key=lambda x: x)
+        self.assertEqual(list(merged), range(1, 9))
+
+    def test_ties_keep_iterable_order(self):
+        merged = merge_sorted([[(1, 'a'), (2, 'a')], [(1, 'b'), (2, 'b')]],
+                              key=lambda x: x[0])
+        self.assertEqual(list(merged),
+                         [(1, 'a'), (1, 'b'), (2, 'a'), (2, 'b')])
+
+    def test_lazy(self):
+        def source():
+            yield 1
+            raise AssertionError('read past the head record')
+        merged = merge_sorted([source(), [0, 2]], key=lambda x: x)
+        self.assertEqual(next(merged), 0)
+
+
+class CheckSortedTest(unittest.TestCase):
+
+    def test_sorted_passes_through(self):
+        self.assertEqual(list(check_sorted([1, 1, 2], lambda x: x)),
+                         [1, 1, 2])
+
+    def test_unsorted_raises(self):
+        checked = check_sorted([1, 3, 2], lambda x: x, 'f.vcf')
+        with self.assertRaises(UnsortedInputError):
+            list(checked)
+
+
+class ExternalSortTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_sort_with_many_runs(self):
+        records = [record('1', p) for p in xrange(1000, 0, -7)]
+        # a tiny buffer makes a run every few records
+        sorted_records = list(external_sort(
+            records, vcf_record_key, buffer_bytes=100, tmp_dir=self.tmp_dir))
+        self.assertEqual(sorted_records,
+                         sorted(records, key=vcf_record_key))
+        # the runs are removed
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+
+class MergeVcfsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_vcf(self, name, header, records):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as op:
+            op.writelines(header + records)
+        return path
+
+    def test_merge_presorted(self):
+        header = ['##fileformat=VCFv4.1\n', '#CHROM\tPOS\tsample\n']
+        paths = [self.write_vcf('a.vcf', header,
+                                [record('1', 5), record('2', 1)]),
+                 self.write_vcf('b.vcf', header,
+                                [record('1', 7), record('X', 1)])]
+        output = StringIO()
+        merge_vcfs(paths, output)
+        self.assertEqual(output.getvalue(), ''.join(
+            header + [record('1', 5), record('1', 7), record('2', 1),
+                      record('X', 1)]))
+
+    def test_unsorted_input(self):
+        header = ['#CHROM\tPOS\tsample\n']
+        paths = [self.write_vcf('a.vcf', header,
+                                [record('2', 1), record('1', 5)])]
+        with self.assertRaises(UnsortedInputError):
+            merge_vcfs(paths, StringIO())
+        output = StringIO()
+        merge_vcfs(paths, output, presorted=False, tmp_dir=self.tmp_dir)
+        self.assertEqual(output.getvalue(), ''.join(
+            header + [record('1', 5), record('2', 1)]))
+
+    def test_different_samples(self):
+        paths = [self.write_vcf('a.vcf', ['#CHROM\tPOS\ts1\n'], []),
+                 self.write_vcf('b.vcf', ['#CHROM\tPOS\ts2\n'], [])]
+        with self.assertRaises(EggoError):
+            merge_vcfs(paths, StringIO())
+
+
+if __name__ == '__main__':
+    unittest.main()
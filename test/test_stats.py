@@ -0,0 +1,151 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import unittest
+
+from eggo.stats import EditionStats, HyperLogLog, QuantileSketch
+
+
+class HyperLogLogTest(unittest.TestCase):
+
+    def test_count_is_close(self):
+        hll = HyperLogLog()
+        for i in xrange(20000):
+            hll.add(str(i))
+        # duplicates don't count
+        for i in xrange(1000):
+            hll.add(str(i))
+        self.assertTrue(abs(hll.count() - 20000) < 20000 * 0.05)
+
+    def test_small_counts_are_exact_enough(self):
+        hll = HyperLogLog()
+        for i in xrange(10):
+            hll.add(str(i))
+        self.assertEqual(hll.count(), 10)
+
+    def test_merge_is_a_union(self):
+        (a, b, both) = (HyperLogLog(), HyperLogLog(), HyperLogLog())
+        for i in xrange(5000):
+            a.add(str(i))
+            both.add(str(i))
+        for i in xrange(2500, 7500):
+            b.add(str(i))
+            both.add(str(i))
+        self.assertEqual(a.merge(b).registers, both.registers)
+
+    def test_merge_needs_same_precision(self):
+        with self.assertRaises(ValueError):
+            HyperLogLog(p=10).merge(HyperLogLog(p=12))
+
+    def test_round_trip(self):
+        hll = HyperLogLog()
+        for i in xrange(100):
+            hll.add(str(i))
+        copy = HyperLogLog.from_dict(json.loads(json.dumps(hll.to_dict())))
+        self.assertEqual(copy.registers, hll.registers)
+
+
+class QuantileSketchTest(unittest.TestCase):
+
+    def assertWithin(self, value, expected, relative_accuracy):
+        self.assertTrue(abs(value - expected) <= expected * relative_accuracy,
+                        '{0} not within {1} of {2}'.format(
+                            value, relative_accuracy, expected))
+
+    def test_quantiles_within_accuracy(self):
+        sketch = QuantileSketch(relative_accuracy=0.01)
+        for i in xrange(1, 1001):
+            sketch.add(i)
+        self.assertEqual(sketch.count, 1000)
+        self.assertWithin(sketch.quantile(0.), 1, 0.01)
+        self.assertWithin(sketch.quantile(0.5), 500, 0.01)
+        self.assertWithin(sketch.quantile(1.), 1000, 0.01)
+
+    def test_zeros_and_empty(self):
+        sketch = QuantileSketch()
+        self.assertEqual(sketch.quantile(0.5), None)
+        sketch.add(0, n=3)
+        sketch.add(10)
+        self.assertEqual(sketch.quantile(0.5), 0)
+        self.assertWithin(sketch.quantile(1.), 10, 0.01)
+
+    def test_merge_sums_counts(self):
+        (a, b) = (QuantileSketch(), QuantileSketch())
+        for i in xrange(1, 501):
+            a.add(i)
+        for i in xrange(501, 1001):
+            b.add(i)
+        b.add(0)
+        a.merge(b)
+        self.assertEqual(a.count, 1001)
+        self.assertEqual(a.zeros, 1)
+        self.assertWithin(a.quantile(0.5), 500, 0.01)
+
+    def test_merge_needs_same_accuracy(self):
+        with self.assertRaises(ValueError):
+            QuantileSketch(0.01).merge(QuantileSketch(0.02))
+
+    def test_round_trip(self):
+        sketch = QuantileSketch()
+        for i in xrange(100):
+            sketch.add(i)
+        copy = QuantileSketch.from_dict(
+            json.loads(json.dumps(sketch.to_dict())))
+        self.assertEqual(copy.buckets, sketch.buckets)
+        self.assertEqual(copy.zeros, sketch.zeros)
+
+
+class EditionStatsTest(unittest.TestCase):
+
+    def test_vcf_lines(self):
+        stats = EditionStats()
+        stats.add_vcf_line('##fileformat=VCFv4.1\n')
+        stats.add_vcf_line('#CHROM\tPOS\tID\tREF\tALT\n')
+        stats.add_vcf_line('1\t100\t.\tA\tG\t.\n')
+        stats.add_vcf_line('1\t200\t.\tC\tT\t.\n')
+        stats.add_vcf_line('X\t300\t.\tG\tA\t.\n')
+        stats.add_vcf_line('truncated\n')
+        self.assertEqual(stats.row_count, 3)
+        self.assertEqual(stats.contig_counts, {'1': 2, 'X': 1})
+
+    def test_merge(self):
+        (a, b) = (EditionStats(), EditionStats())
+        a.add_variant('1', 100, 'A', 'G')
+        b.add_variant('1', 100, 'A', 'G')
+        b.add_variant('2', 100, 'A', 'G')
+        a.add_partition(2, 1000)
+        b.add_partition(4, 3000)
+        a.merge(b)
+        self.assertEqual(a.row_count, 3)
+        self.assertEqual(a.contig_counts, {'1': 2, '2': 1})
+        self.assertEqual(a.distinct_variants.count(), 2)
+        self.assertEqual(a.partition_bytes.count, 2)
+
+    def test_round_trip(self):
+        stats = EditionStats()
+        stats.add_variant('1', 100, 'A', 'G')
+        stats.add_partition(2, 1000)
+        d = json.loads(json.dumps(stats.to_dict()))
+        self.assertEqual(d['row_count'], 1)
+        self.assertEqual(d['distinct_variants'], 1)
+        self.assertEqual(d['num_partitions'], 1)
+        self.assertEqual(EditionStats.from_dict(d).to_dict(), d)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+# Licensed to Big Data Genomics (BDG) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The BDG licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+from eggo.waiter import Waiter, WaitFailed, WaitTimeout
+
+
+class FakeClock(object):
+    # sleeping just moves the clock forward
+
+    def __init__(self):
+        self.now = 0.
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class ScriptedDescribe(object):
+    # each call returns the next observation, restricted to the asked ids
+
+    def __init__(self, observations):
+        self.observations = list(observations)
+        self.calls = []
+
+    def __call__(self, ids):
+        self.calls.append(list(ids))
+        observed = self.observations.pop(0)
+        return dict((i, s) for (i, s) in observed.iteritems() if i in ids)
+
+
+def make_waiter(describe, **kwargs):
+    clock = FakeClock()
+    waiter = Waiter(describe, jitter=0., clock=clock.time,
+                    sleep=clock.sleep, out=None, **kwargs)
+    return (waiter, clock)
+
+
+class WaiterTest(unittest.TestCase):
+
+    def test_waits_until_all_done(self):
+        describe = ScriptedDescribe([{'a': 'pending', 'b': 'pending'},
+                                     {'a': 'running', 'b': 'pending'},
+                                     {'b': 'running'}])
+        (waiter, clock) = make_waiter(describe)
+        reached = waiter.wait(['a', 'b'], lambda s: s == 'running')
+        self.assertEqual(reached, {'a': 2., 'b': 6.})
+        self.assertEqual(waiter.num_calls, 3)
+        # ids that are done are not asked for again
+        self.assertEqual(describe.calls, [['a', 'b'], ['a', 'b'], ['b']])
+
+    def test_delay_backs_off_to_the_cap(self):
+        describe = ScriptedDescribe([{}] * 6 + [{'a': 'running'}])
+        (waiter, clock) = make_waiter(describe, base_delay=2., max_delay=15.)
+        waiter.wait(['a'], lambda s: s == 'running')
+        self.assertEqual(clock.sleeps, [2., 4., 8., 15., 15., 15.])
+
+    def test_jitter_only_shortens_the_delay(self):
+        waiter = Waiter(None, base_delay=2., max_delay=15., jitter=0.25)
+        for tick in xrange(10):
+            delay = waiter.delay(tick)
+            cap = min(15., 2. * 2 ** tick)
+            self.assertTrue(0.75 * cap <= delay <= cap)
+
+    def test_missing_ids_are_observed_as_none(self):
+        describe = ScriptedDescribe([{'a': 'shutting-down'}, {}])
+        (waiter, clock) = make_waiter(describe)
+        observed = []
+
+        def done(state):
+            observed.append(state)
+            return state is None
+
+        waiter.wait(['a'], done)
+        self.assertEqual(observed, ['shutting-down', None])
+
+    def test_failed_state_raises(self):
+        describe = ScriptedDescribe([{'a': 'pending'}, {'a': 'failed'}])
+        (waiter, clock) = make_waiter(describe)
+        with self.assertRaises(WaitFailed):
+            waiter.wait(['a'], lambda s: s == 'available',
+                        lambda s: s == 'failed')
+
+    def test_timeout(self):
+        describe = ScriptedDescribe([{'a': 'pending'}] * 10)
+        (waiter, clock) = make_waiter(describe, timeout=10.)
+        with self.assertRaises(WaitTimeout):
+            waiter.wait(['a'], lambda s: s == 'running')
+        self.assertTrue(clock.now <= 10. + waiter.max_delay)
+
+
+if __name__ == '__main__':
+    unittest.main()